@@ -1,32 +1,214 @@
-from fastapi import FastAPI, UploadFile, BackgroundTasks, HTTPException
+from fastapi import FastAPI, UploadFile, HTTPException, File, Form, Request
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import os
+import asyncio
+import struct
+import time
 import uuid
 from uuid import UUID
-import hashlib
 import json
-from typing import Dict, Any
-from dna2music.tasks import process_dna_task
+from typing import Dict, Any, List, Optional
+from dna2music.mapping import composer
+from dna2music.mapping.parser import parse_region
+from dna2music import admission
+from dna2music.cache import LOCK_SECONDS, ResultCache, cache_key, model_version
+from dna2music.jobs import AsyncJobStore, async_redis_from_url, batch_summary, redis_from_url
+from dna2music.uploads import (ALLOWED_TYPES, ARCHIVE_TYPES, MAX_BATCH_FILES, MAX_UPLOAD_BYTES, UPLOAD_CHUNK, Spool,
+                               UploadTooLarge, allowed_file, spool_archive)
+from dna2music.pipeline import preview_head
+from dna2music.tasks import TRANSCODE_LOCK, TRANSCODE_LOCK_SECONDS, dna_task_arguments
+from dna2music.utils.audio import AUDIO_FORMATS
 from fastapi.staticfiles import StaticFiles
 from dotenv import load_dotenv
-import redis
+from celery import Celery
 
 load_dotenv()
 BACKEND_URL = os.environ.get("BACKEND_URL", "http://localhost:8000")
 REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
-redis_client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+REDIS_POOL_SIZE = int(os.environ.get("REDIS_POOL_SIZE", 64))
+# Handlers use the pooled asyncio client; the blocking one backs the result
+# cache, whose calls run in worker threads
+redis_client = redis_from_url(REDIS_URL)
+async_redis = async_redis_from_url(REDIS_URL, REDIS_POOL_SIZE)
+UPLOAD_DIR = os.environ.get("UPLOAD_DIR", "uploads")  # shared with the workers
+SMALL_UPLOAD_BYTES = int(os.environ.get("SMALL_UPLOAD_BYTES", 1 << 20))
+MAX_BATCH_BYTES = int(os.environ.get("MAX_BATCH_BYTES", 8 << 30))
+FORM_OVERHEAD = 1 << 16  # multipart boundaries and the other form fields
+# Largest request body of each upload endpoint
+BODY_LIMITS = {"/api/submit": MAX_UPLOAD_BYTES + FORM_OVERHEAD, "/api/batch": MAX_BATCH_BYTES}
+BATCH_CHUNK = int(os.environ.get("BATCH_CHUNK", 8))  # samples per worker task
+BUSY_DETAIL = "Too much work queued; please retry later."
+# Queues of the admission lanes; interactive jobs are queued by upload size
+LANE_QUEUES = {"bulk": "dna_processing_bulk", "preview": "dna_preview"}
+STREAM_CHUNK = 1 << 16  # bytes per read when streaming audio
+STREAM_POLL_SECONDS = 0.25
+OUTPUT_FORMATS = (*AUDIO_FORMATS, "midi")
+STATUS_CACHE_SECONDS = float(os.environ.get("STATUS_CACHE_SECONDS", 0.5))
+STATUS_CACHE_SIZE = 10000
+EVENTS_KEEPALIVE_SECONDS = 15
+ENCODE_RETRY_SECONDS = 5
+MEDIA_TYPES = {".wav": "audio/wav", ".flac": "audio/flac", ".ogg": "audio/ogg", ".mid": "audio/midi"}
+result_cache = ResultCache(redis_client)
+jobs = AsyncJobStore(async_redis)
+batches = AsyncJobStore(async_redis, prefix="batch")
+_job_cache = {}  # job_id -> (fetched at, job), for clients polling the same job
+celery_app = Celery('dna2music')
+celery_app.config_from_object('celeryconfig')
 
-def save_job(job_id, data):
-    redis_client.hset(f"job:{job_id}", mapping=data)
+class JobEvents:
+    """Fans job progress events out to this process's subscribers.
 
-def get_job(job_id):
-    return redis_client.hgetall(f"job:{job_id}")
+    All event streams share one pub/sub connection: a channel is
+    subscribed while at least one client listens to it, and a single
+    reader task hands each message to the queues of its listeners.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.pubsub = None
+        self.reader = None
+        self.listeners = {}  # channel -> set of asyncio.Queue
+
+    async def listen(self, channel):
+        if self.pubsub is None:
+            self.pubsub = self.client.pubsub()
+        queue = asyncio.Queue()
+        if channel not in self.listeners:
+            self.listeners[channel] = set()
+            await self.pubsub.subscribe(channel)
+        self.listeners[channel].add(queue)
+        if self.reader is None:
+            self.reader = asyncio.create_task(self._read())
+        return queue
+
+    async def stop(self, channel, queue):
+        queues = self.listeners.get(channel, set())
+        queues.discard(queue)
+        if not queues and channel in self.listeners:
+            del self.listeners[channel]
+            await self.pubsub.unsubscribe(channel)
+
+    async def _read(self):
+        while True:
+            try:
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except Exception:
+                # The client reconnects and resubscribes on the next read
+                await asyncio.sleep(1)
+                continue
+            if message and message.get("type") == "message":
+                for queue in self.listeners.get(message["channel"], ()):
+                    queue.put_nowait(message["data"])
+
+    async def close(self):
+        if self.reader is not None:
+            self.reader.cancel()
+        if self.pubsub is not None:
+            await self.pubsub.aclose()
+
+job_events = JobEvents(async_redis)
+
+async def get_job(job_id, max_age=STATUS_CACHE_SECONDS):
+    """The job's hash, reused for up to ``max_age`` seconds within this process."""
+    now = time.monotonic()
+    cached = _job_cache.get(job_id)
+    if cached and now - cached[0] < max_age:
+        return cached[1]
+    job = await jobs.get(job_id)
+    if job and job.get("status") == "pending" and job.get("cache_key"):
+        # A follower whose leader died (its lock expired) would wait forever
+        orphans = await asyncio.to_thread(result_cache.reap, job["cache_key"])
+        if orphans:
+            await fail_jobs(orphans, "The identical job this one was waiting for was lost; please resubmit.")
+            job = await jobs.get(job_id)
+    if job:
+        if len(_job_cache) >= STATUS_CACHE_SIZE:
+            for stale in [k for k, (fetched, _) in _job_cache.items() if now - fetched >= max_age]:
+                del _job_cache[stale]
+            if len(_job_cache) >= STATUS_CACHE_SIZE:
+                _job_cache.clear()
+        _job_cache[job_id] = (now, job)
+    return job
+
+async def fail_jobs(job_ids, error):
+    await jobs.update(job_ids, {"status": "failed", "error": error},
+                      event={"stage": "failed", "status": "failed", "error": error})
+
+async def abandon(key, job_ids, error):
+    """Give up computing ``key``: drop its lock and fail ``job_ids`` and the jobs queued behind it."""
+    await fail_jobs(list(job_ids) + await asyncio.to_thread(result_cache.release, key), error)
 
 app = FastAPI(title="dna2music API", version="1.0.0")
 
+@app.on_event("shutdown")
+async def close_redis():
+    await job_events.close()
+    await async_redis.aclose()
+
 # Serve audio files
 app.mount("/files", StaticFiles(directory="outputs"), name="files")
 
+class BodyLimit:
+    """Refuses request bodies over their path's limit before they are received.
+
+    The form parser reads the whole body before a handler runs, so the size
+    is checked here: from Content-Length up front, or, for chunked bodies,
+    by counting them as they arrive.
+    """
+
+    def __init__(self, app, limits):
+        self.app = app
+        self.limits = limits
+
+    async def __call__(self, scope, receive, send):
+        limit = self.limits.get(scope["path"]) if scope["type"] == "http" else None
+        if limit is None:
+            return await self.app(scope, receive, send)
+        detail = f"Request body exceeds the {limit} byte limit"
+        length = dict(scope["headers"]).get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > limit:
+            return await JSONResponse({"detail": detail}, status_code=413)(scope, receive, send)
+        received = 0
+
+        async def counted():
+            nonlocal received
+            message = await receive()
+            received += len(message.get("body", b""))
+            if received > limit:
+                raise HTTPException(413, detail)
+            return message
+
+        await self.app(scope, counted, send)
+
+app.add_middleware(BodyLimit, limits=BODY_LIMITS)
+
+class AdmitByLength:
+    """Refuses an upload the backlog has no room for before its body is received.
+
+    Only Content-Length is known here, so the upload is costed as if it were
+    composed whole and uncompressed; the handler decides again from the
+    form. Identical uploads whose result is cached are refused as well
+    while the service is this busy, since they can't be told apart yet.
+    """
+
+    def __init__(self, app, path):
+        self.app = app
+        self.path = path
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == self.path:
+            length = dict(scope["headers"]).get(b"content-length", b"")
+            if length.isdigit():
+                decision = admission.admit(admission.estimate_cost(int(length)), await queued_backlog())
+                if decision.action == 'reject':
+                    response = JSONResponse({"detail": BUSY_DETAIL}, status_code=429,
+                                            headers={"Retry-After": str(decision.retry_after)})
+                    return await response(scope, receive, send)
+        await self.app(scope, receive, send)
+
+app.add_middleware(AdmitByLength, path="/api/submit")
+
 # CORS for frontend
 app.add_middleware(
     CORSMiddleware,
@@ -36,63 +218,344 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+async def spool_upload(file, path):
+    """spool_file for an UploadFile, without blocking the event loop."""
+    try:
+        with Spool(path) as spool:
+            while chunk := await file.read(UPLOAD_CHUNK):
+                await asyncio.to_thread(spool.write, chunk)
+    except UploadTooLarge as e:
+        raise HTTPException(413, str(e))
+    return spool.sha256, spool.size
+
+def check_options(region, layout, format):
+    if region:
+        try:
+            parse_region(region)
+        except ValueError as e:
+            raise HTTPException(400, str(e))
+    if layout not in ("stitched", "tracks"):
+        raise HTTPException(400, "Invalid layout. Supported: stitched, tracks")
+    if format not in OUTPUT_FORMATS:
+        raise HTTPException(400, f"Invalid format. Supported: {', '.join(OUTPUT_FORMATS)}")
+
+MAX_NOTE_BEATS = 16
+
+def check_style(mode, rhythm):
+    """Validate the composing options; returns the rhythm rules, or None for the defaults.
+
+    ``rhythm`` is JSON giving the note length in beats for each GC level,
+    e.g. ``{"low": 0.5, "medium": 1, "high": 2}``.
+    """
+    if mode not in composer.MODE_SCALES:
+        raise HTTPException(400, f"Invalid mode. Supported: {', '.join(composer.MODE_SCALES)}")
+    if not rhythm:
+        return None
+    try:
+        beats = json.loads(rhythm)
+        rules = {"gc_content": {level: float(beats[level]) for level in composer.RHYTHM_BY_BIN}}
+    except (ValueError, TypeError, KeyError):
+        rules = None
+    if rules is None or not all(0 < v <= MAX_NOTE_BEATS for v in rules["gc_content"].values()):
+        raise HTTPException(400, f"Invalid rhythm. Expected JSON beats, up to {MAX_NOTE_BEATS}, for each of "
+                                 f"{', '.join(composer.RHYTHM_BY_BIN)}")
+    return rules
+
+def job_cache_key(file_hash, region, layout, stream, format, mode='beautiful', rhythm_rules=None,
+                  preview_only=False):
+    params = dict(region=region or "", layout=layout, stream=stream, format=format)
+    if rhythm_rules:
+        params["rhythm_rules"] = rhythm_rules
+    if preview_only:
+        params["preview_only"] = True
+    return cache_key(file_hash, mode=mode, model_version=model_version(), **params)
+
+async def register_job(job_id, key, file_hash, filename, region, wait=0.0, **extra):
+    """Create a job for a spooled upload and resolve it against the result cache.
+
+    Returns ``'hit'`` (the job is already completed), ``'follower'`` (it
+    waits for an identical computation in flight) or ``'leader'`` (it must
+    be queued). ``wait`` estimates the seconds a leader spends queued and
+    running, which its lock has to last until the worker holds it.
+    """
+    job_data = {
+        "status": "pending",
+        "file_hash": file_hash,
+        "filename": filename,
+        "region": region or "",
+        "result": "",
+        "error": "",
+        "cache_key": key,
+        **extra
+    }
+    # Saved first: a running computation may complete this job as soon
+    # as it has joined the queue below
+    await jobs.create(job_id, job_data)
+    # Identical uploads resolve to the cached result, or wait for the
+    # computation already running for them
+    cached = await asyncio.to_thread(result_cache.get, key)
+    role = 'hit'
+    if cached is None:
+        role = await asyncio.to_thread(result_cache.join, key, job_id, wait + LOCK_SECONDS)
+    if role == 'hit':
+        cached = cached if cached is not None else await asyncio.to_thread(result_cache.get, key)
+        await jobs.update(job_id, {"status": "completed", "result": json.dumps(cached)})
+    return role
+
+def save_preview_head(upload_path, head_path):
+    with open(head_path, "wb") as f:
+        f.write(preview_head(upload_path))
+
+def upload_queue(size):
+    return "dna_processing" if size <= SMALL_UPLOAD_BYTES else "dna_processing_large"
+
+async def queued_backlog():
+    """Estimated seconds of queued work per admission lane."""
+    return {lane: max(float(v), 0.0) for lane, v in (await async_redis.hgetall(admission.BACKLOG_KEY)).items()}
+
+def upload_cost(size, filename, region):
+    return admission.estimate_cost(size, filename.endswith(('.gz', '.bgz')), parse_region(region) if region else None)
+
+def admit_upload(size, filename, region, backlog):
+    """Admission decision for an upload, from its estimated cost and the current backlog."""
+    # Previews cover the start of the whole upload, so region requests can't be downgraded
+    return admission.admit(upload_cost(size, filename, region), backlog, can_preview=not region)
+
 @app.post("/api/submit")
-async def submit_dna(file: UploadFile, background_tasks: BackgroundTasks):
-    allowed_types = ['.fasta', '.fastq', '.txt', '.fa']
-    if not any(file.filename.endswith(ext) for ext in allowed_types):
-        raise HTTPException(400, "Invalid file type. Supported: .fasta, .fastq, .txt, .fa")
+async def submit_dna(
+    file: UploadFile,
+    region: Optional[str] = Form(None),
+    layout: str = Form("stitched"),
+    stream: bool = Form(False),
+    format: str = Form("wav"),
+    mode: str = Form("beautiful"),
+    rhythm: Optional[str] = Form(None)
+):
+    if not allowed_file(file.filename):
+        raise HTTPException(400, "Invalid file type. Supported: .fasta, .fastq, .txt, .fa, .fq, .vcf (optionally .gz)")
+    check_options(region, layout, format)
+    rhythm_rules = check_style(mode, rhythm)
+    job_id = str(uuid.uuid4())
+    # Spooled under the job id where the workers can read it; only the path
+    # is handed on, so memory per upload stays at one chunk
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    upload_path = os.path.join(UPLOAD_DIR, job_id)
+    file_hash, size = await spool_upload(file, upload_path)
+    head_path = f"{upload_path}.head"
+    handed_over = set()  # spools a queued task removes when done
+    queued = False  # the task that completes the job is queued
+    role = None
     try:
-        job_id = str(uuid.uuid4())
-        file_content = await file.read()
-        file_hash = hashlib.sha256(file_content).hexdigest()
-        job_data = {
-            "status": "pending",
-            "file_hash": file_hash,
-            "filename": file.filename,
-            "created_at": str(uuid.uuid4().time),
-            "result": None,
-            "error": None
-        }
-        save_job(job_id, job_data)
-        background_tasks.add_task(process_dna_task, job_id, file_content, redis_client)
+        key = job_cache_key(file_hash, region, layout, stream, format, mode, rhythm_rules)
+        # Cached results cost nothing (the default is only used if the entry
+        # is evicted meanwhile); anything else has to be admitted
+        backlog = await queued_backlog()
+        decision = admission.Decision('admit', "interactive", upload_cost(size, file.filename, region), 0)
+        if await asyncio.to_thread(result_cache.get, key) is None:
+            decision = admit_upload(size, file.filename, region, backlog)
+        if decision.action == 'reject':
+            raise HTTPException(429, BUSY_DETAIL, headers={"Retry-After": str(decision.retry_after)})
+        preview_only = decision.action == 'preview'
+        if preview_only:
+            key = job_cache_key(file_hash, region, layout, stream, format, mode, rhythm_rules, preview_only=True)
+        role = await register_job(job_id, key, file_hash, file.filename, region,
+                                  wait=backlog.get(decision.lane, 0.0) + decision.cost,
+                                  lane=decision.lane, cost=decision.cost)
+        if role == 'hit':
+            return {
+                "job_id": job_id,
+                "status": "completed",
+                "message": "Identical upload already processed; result reused."
+            }
+        if role == 'leader':
+            # Charged before queueing, as the worker may finish (and refund)
+            # first; refunded below if queueing fails
+            pipe = async_redis.pipeline(transaction=True)
+            admission.charge(pipe, jobs.key(job_id), decision.lane, decision.cost)
+            await pipe.execute()
+            if not region:
+                # The preview is rendered from a copy of the upload's head on
+                # its own queue, instead of waiting for the job to be dequeued
+                await asyncio.to_thread(save_preview_head, upload_path, head_path)
+                await asyncio.to_thread(
+                    celery_app.send_task,
+                    "worker.tasks.process_preview_task",
+                    args=[job_id, head_path, key, preview_only, mode, rhythm_rules],
+                    queue=LANE_QUEUES["preview"]
+                )
+                handed_over.add(head_path)
+                queued = preview_only
+            if not preview_only:
+                await asyncio.to_thread(
+                    celery_app.send_task,
+                    "worker.tasks.process_dna_task",
+                    kwargs=dna_task_arguments(job_id, upload_path, key, region, layout, stream, format, mode,
+                                              rhythm_rules, with_preview=False),
+                    queue=LANE_QUEUES.get(decision.lane) or upload_queue(size)
+                )
+                handed_over.add(upload_path)
+                queued = True
+        if preview_only:
+            return {
+                "job_id": job_id,
+                "status": "submitted",
+                "preview_only": True,
+                "message": "The service is busy: only a preview of this upload will be rendered."
+            }
         return {
             "job_id": job_id,
             "status": "submitted",
             "message": "DNA file uploaded successfully. Processing started."
         }
-    except UnicodeDecodeError:
-        raise HTTPException(400, "File could not be decoded. Please upload a valid text file.")
+    except HTTPException:
+        raise
+    except Exception as e:
+        if role == 'leader' and not queued:
+            # Nothing will compute the key: free it for the next upload
+            await asyncio.to_thread(admission.release, redis_client, jobs.key(job_id))
+            await abandon(key, [job_id], f"Could not queue the job: {e}")
+        raise HTTPException(500, f"Unexpected error: {str(e)}")
+    finally:
+        # The workers remove the spools once they are done with them
+        for path in (upload_path, head_path):
+            if path not in handed_over and os.path.exists(path):
+                os.remove(path)
+
+@app.post("/api/batch")
+async def submit_batch(
+    files: List[UploadFile] = File(...),
+    region: Optional[str] = Form(None),
+    layout: str = Form("stitched"),
+    stream: bool = Form(False),
+    format: str = Form("wav"),
+    mode: str = Form("beautiful"),
+    rhythm: Optional[str] = Form(None)
+):
+    """Submit several sequence files, or zip/tar archives of them, as one batch.
+
+    Each sample becomes a job of its own; the ones that need computing are
+    queued in groups of BATCH_CHUNK so a worker sets up once per group.
+    """
+    for file in files:
+        if not (allowed_file(file.filename) or file.filename.endswith(ARCHIVE_TYPES)):
+            raise HTTPException(400, f"Invalid file type: {file.filename}. Supported: sequence files "
+                                     f"({', '.join(ALLOWED_TYPES)}, optionally .gz) and {', '.join(ARCHIVE_TYPES)}")
+    check_options(region, layout, format)
+    rhythm_rules = check_style(mode, rhythm)
+    batch_id = str(uuid.uuid4())
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    samples, skipped, leaders, queued = [], [], [], set()
+    try:
+        for file in files:
+            path = os.path.join(UPLOAD_DIR, str(uuid.uuid4()))
+            sample = (os.path.basename(path), file.filename, path, *await spool_upload(file, path))
+            if allowed_file(file.filename):
+                samples.append(sample)
+            else:
+                try:
+                    found, ignored = await asyncio.to_thread(spool_archive, path, UPLOAD_DIR)
+                except UploadTooLarge as e:
+                    raise HTTPException(413, str(e))
+                except ValueError as e:
+                    raise HTTPException(400, str(e))
+                finally:
+                    os.remove(path)
+                samples += found
+                skipped += ignored
+            if len(samples) > MAX_BATCH_FILES:
+                raise HTTPException(413, f"Batches are limited to {MAX_BATCH_FILES} files")
+        if not samples:
+            raise HTTPException(400, "No sequence files in the batch")
+        await batches.create(batch_id, {
+            "children": json.dumps([job_id for job_id, *_ in samples]),
+            "filenames": json.dumps([name for _, name, *_ in samples]),
+        })
+        # The batch's groups queue behind the interactive backlog and each other
+        wait = (await queued_backlog()).get("interactive", 0.0) + sum(
+            upload_cost(size, name, region) for _, name, _, _, size in samples)
+        children = []
+        for job_id, name, path, file_hash, size in samples:
+            key = job_cache_key(file_hash, region, layout, stream, format, mode, rhythm_rules)
+            role = await register_job(job_id, key, file_hash, name, region, wait=wait, batch_id=batch_id)
+            children.append({"job_id": job_id, "filename": name,
+                             "status": "completed" if role == 'hit' else "submitted"})
+            if role == 'leader':
+                leaders.append((size, dna_task_arguments(job_id, path, key, region, layout, stream, format, mode,
+                                                         rhythm_rules, with_preview=False)))
+        # Similar sizes share a group, and a group goes to the queue of its largest upload
+        leaders.sort(key=lambda leader: leader[0])
+        for i in range(0, len(leaders), BATCH_CHUNK):
+            group = leaders[i:i + BATCH_CHUNK]
+            await asyncio.to_thread(
+                celery_app.send_task,
+                "worker.tasks.process_batch_task",
+                args=[batch_id, [arguments for _, arguments in group]],
+                queue=upload_queue(group[-1][0])
+            )
+            queued.update(arguments["upload_path"] for _, arguments in group)
+        return {"batch_id": batch_id, "status": "submitted", "jobs": children, "skipped": skipped}
+    except HTTPException:
+        raise
     except Exception as e:
+        for _, arguments in leaders:
+            if arguments["upload_path"] not in queued:
+                await abandon(arguments["cache_key"], [arguments["job_id"]], f"Could not queue the job: {e}")
         raise HTTPException(500, f"Unexpected error: {str(e)}")
+    finally:
+        # The worker removes the spools it was handed
+        for _, _, path, *_ in samples:
+            if path not in queued and os.path.exists(path):
+                os.remove(path)
+
+@app.get("/api/batch/{batch_id}")
+async def get_batch(batch_id: str):
+    """One document for the whole batch: overall status, counts and each job's outcome."""
+    batch = await batches.get(batch_id)
+    if not batch:
+        raise HTTPException(404, "Batch not found")
+    children = json.loads(batch["children"])
+    summary = batch_summary(children, json.loads(batch["filenames"]), await jobs.get_many(children))
+    return {"batch_id": batch_id, **summary, "created_at": batch.get("created_at")}
 
 @app.get("/api/result/{job_id}")
 async def get_result(job_id: str):
-    job = get_job(job_id)
+    job = await get_job(job_id)
     if not job:
         raise HTTPException(404, "Job not found")
+    result = json.loads(job["result"]) if job.get("result") else None
+    # The preview is stored on the job as soon as it is rendered, and kept in
+    # the final result so cached jobs have one too
+    preview = json.loads(job["preview"]) if job.get("preview") else (result or {}).get("preview")
     if job.get("status") == "completed":
         return {
             "job_id": job_id,
             "status": "completed",
-            "result": json.loads(job["result"]) if job["result"] else None,
+            "result": result,
+            "preview": preview,
             "download_url": f"/api/download/{job_id}"
         }
     elif job.get("status") == "failed":
         return {
             "job_id": job_id,
             "status": "failed",
-            "error": job.get("error")
+            "error": job.get("error"),
+            "preview": preview
         }
     else:
-        return {
+        response = {
             "job_id": job_id,
             "status": job.get("status"),
-            "message": "Processing in progress..."
+            "message": "Processing in progress...",
+            "preview": preview
         }
+        # Streaming jobs expose the audio rendered so far
+        if job.get("audio_path"):
+            response["partial_audio_path"] = job["audio_path"]
+        return response
 
 @app.get("/api/status/{job_id}")
 async def get_status(job_id: str):
-    job = get_job(job_id)
+    job = await get_job(job_id)
     if not job:
         raise HTTPException(404, "Job not found")
     return {
@@ -102,20 +565,198 @@ async def get_status(job_id: str):
     }
 
 @app.get("/api/download/{job_id}")
-async def download_result(job_id: str):
-    job = get_job(job_id)
+async def download_result(job_id: str, format: Optional[str] = None):
+    job = await get_job(job_id)
     if not job or job.get("status") != "completed":
         raise HTTPException(404, "Result not available")
-    result_path = f"outputs/{job_id}.wav"
-    if not os.path.exists(result_path):
-        raise HTTPException(404, "Audio file not found")
-    return {"download_url": f"/files/{job_id}.wav"}
+    if format is not None and format not in OUTPUT_FORMATS:
+        raise HTTPException(400, f"Invalid format. Supported: {', '.join(OUTPUT_FORMATS)}")
+    # Files are named by cache key, shared by identical jobs
+    result = json.loads(job["result"]) if job.get("result") else {}
+    if format == "midi":
+        url = result.get("midi_path", "")
+    else:
+        url = result.get("audio_path", "")
+        if url and format and not url.endswith(f".{format}"):
+            # Other audio encodings are made by a worker on first request
+            source = os.path.join("outputs", os.path.basename(url))
+            url = f"{os.path.splitext(url)[0]}.{format}"
+            target = os.path.join("outputs", os.path.basename(url))
+            if os.path.exists(source) and not os.path.exists(target):
+                await encode_download(source, target)
+                message = f"The {format} file is being encoded; please retry shortly."
+                return JSONResponse({"status": "encoding", "message": message}, status_code=202,
+                                    headers={"Retry-After": str(ENCODE_RETRY_SECONDS)})
+    if not url or not os.path.exists(os.path.join("outputs", os.path.basename(url))):
+        raise HTTPException(404, "File not found in this format")
+    return {"download_url": url}
+
+async def encode_download(source, target):
+    """Queue encoding ``source`` into ``target``, unless a worker is already at it."""
+    lock = TRANSCODE_LOCK.format(target)
+    if not await async_redis.set(lock, 1, nx=True, ex=TRANSCODE_LOCK_SECONDS):
+        return
+    try:
+        await asyncio.to_thread(celery_app.send_task, "worker.tasks.transcode_task", args=[source, target])
+    except Exception as e:
+        await async_redis.delete(lock)
+        raise HTTPException(500, f"Could not queue the encoding: {e}")
+
+def _audio_file(job):
+    """Local path of a job's audio, final or still being rendered."""
+    if job.get("status") == "completed" and job.get("result"):
+        audio_url = json.loads(job["result"]).get("audio_path", "")
+    else:
+        audio_url = job.get("audio_path", "")
+    path = os.path.join("outputs", os.path.basename(audio_url)) if audio_url else ""
+    return path if path and os.path.exists(path) else None
+
+def _read_range(path, start, end):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            data = f.read(min(STREAM_CHUNK, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+def _range_response(path, range_header):
+    """The file, or the single ``bytes=start-end`` range asked for."""
+    size = os.path.getsize(path)
+    media_type = MEDIA_TYPES.get(os.path.splitext(path)[1], "application/octet-stream")
+    headers = {"Accept-Ranges": "bytes"}
+    if not range_header:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(_read_range(path, 0, size - 1), media_type=media_type, headers=headers)
+    try:
+        unit, spec = range_header.split("=", 1)
+        first, last = spec.split(",")[0].strip().split("-")
+        if unit.strip() != "bytes":
+            raise ValueError(unit)
+        if first:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        else:
+            # Suffix range: the last ``last`` bytes
+            start, end = max(size - int(last), 0), size - 1
+    except ValueError:
+        raise HTTPException(400, "Invalid Range header")
+    if start >= size or start > end:
+        raise HTTPException(416, "Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(_read_range(path, start, end), status_code=206, media_type=media_type, headers=headers)
+
+async def _follow_audio(job_id, path):
+    """Stream an audio file that is still being written, until its job finishes."""
+    with open(path, "rb") as f:
+        header = bytearray(f.read(44))
+        # The sizes in the header are only final once rendering ends, so
+        # advertise an open-ended stream as live WAV streams do
+        data_at = header.find(b"data")
+        if header[:4] == b"RIFF" and data_at >= 0:
+            header[4:8] = header[data_at + 4:data_at + 8] = struct.pack("<I", 0xFFFFFFFF)
+        yield bytes(header)
+        while True:
+            data = f.read(STREAM_CHUNK)
+            if data:
+                yield data
+                continue
+            if (await get_job(job_id)).get("status") not in ("pending", "rendering"):
+                # Pick up anything flushed between the last read and the end
+                rest = f.read()
+                if rest:
+                    yield rest
+                return
+            await asyncio.sleep(STREAM_POLL_SECONDS)
+
+@app.get("/api/stream/{job_id}")
+async def stream_audio(job_id: str, request: Request):
+    """Play a job's audio: byte ranges once rendered, a live stream while rendering."""
+    job = await get_job(job_id)
+    if not job:
+        raise HTTPException(404, "Job not found")
+    path = _audio_file(job)
+    if path is None:
+        raise HTTPException(404, "Audio not available yet")
+    if job.get("status") == "completed":
+        return _range_response(path, request.headers.get("range"))
+    media_type = MEDIA_TYPES.get(os.path.splitext(path)[1], "application/octet-stream")
+    return StreamingResponse(_follow_audio(job_id, path), media_type=media_type)
+
+def _sse(event):
+    return f"data: {json.dumps(event)}\n\n"
+
+def _job_snapshot(job):
+    """The current state of a job as an event, for clients that just connected."""
+    status = job.get("status")
+    event = {"stage": {"completed": "done"}.get(status, status), "status": status}
+    if status == "completed":
+        event["result"] = json.loads(job["result"]) if job.get("result") else None
+    elif status == "failed":
+        event["error"] = job.get("error")
+    if job.get("preview"):
+        event["preview"] = json.loads(job["preview"])
+    if job.get("note_count"):
+        event["note_count"] = int(job["note_count"])
+    return event
+
+async def _follow_events(job_id):
+    channel = jobs.channel(job_id)
+    queue = await job_events.listen(channel)
+    try:
+        # Read after subscribing, so nothing published in between is missed
+        event = _job_snapshot(await jobs.get(job_id))
+        yield _sse(event)
+        while event["stage"] not in ("done", "failed"):
+            try:
+                event = json.loads(await asyncio.wait_for(queue.get(), EVENTS_KEEPALIVE_SECONDS))
+            except asyncio.TimeoutError:
+                # Quiet for a while: keep proxies from closing the stream and
+                # catch a job that ended without us hearing of it
+                job = await get_job(job_id, max_age=0)
+                if not job or job.get("status") in ("completed", "failed"):
+                    event = _job_snapshot(job) if job else {"stage": "failed", "error": "Job expired"}
+                    yield _sse(event)
+                else:
+                    yield ": keep-alive\n\n"
+                continue
+            yield _sse(event)
+    finally:
+        await job_events.stop(channel, queue)
+
+@app.get("/api/events/{job_id}")
+async def job_progress(job_id: str):
+    """Server-Sent Events with the job's progress, ending with ``done`` or ``failed``."""
+    if not await get_job(job_id):
+        raise HTTPException(404, "Job not found")
+    return StreamingResponse(_follow_events(job_id), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/api/jobs")
+async def list_jobs(offset: int = 0, limit: int = 50, status: Optional[str] = None):
+    """Jobs newest first, a page at a time."""
+    if offset < 0 or not 0 < limit <= 500:
+        raise HTTPException(400, "offset must be >= 0 and limit between 1 and 500")
+    page = await jobs.list(offset, limit, status)
+    return {
+        "offset": offset,
+        "limit": limit,
+        "jobs": [
+            {"job_id": job_id, "status": job.get("status"), "filename": job.get("filename"),
+             "created_at": job.get("created_at")}
+            for job_id, job in page
+        ]
+    }
 
 @app.get("/api/health")
 async def health_check():
-    # Count jobs in Redis (optional, can be slow for large sets)
-    jobs_count = len(redis_client.keys("job:*"))
-    return {"status": "healthy", "jobs_count": jobs_count}
+    # Read from the job indexes, so the cost doesn't grow with the number of jobs
+    jobs_count, by_status = await jobs.counts()
+    return {"status": "healthy", "jobs_count": jobs_count, "jobs_by_status": by_status,
+            "backlog_seconds": await queued_backlog()}
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,5 +1,8 @@
 # Celery configuration
 import os
+from kombu import Queue
+from dna2music.admission import LANE_LIMITS, estimate_cost
+from dna2music.uploads import MAX_UPLOAD_BYTES
 
 # Broker settings
 broker_url = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
@@ -18,9 +21,29 @@ enable_utc = True
 worker_prefetch_multiplier = 1
 worker_max_tasks_per_child = 1000
 
-# Task routing
+# Task routing: the API picks the queue per upload size, so small files
+# are never stuck behind genome-scale jobs (see docker-compose.yml workers)
 task_routes = {
-    'worker.tasks.process_dna_task': {'queue': 'dna_processing'}
+    'worker.tasks.process_dna_task': {'queue': 'dna_processing'},
+    'worker.tasks.process_preview_task': {'queue': 'dna_preview'},
+    'worker.tasks.transcode_task': {'queue': 'dna_processing'}
+}
+task_queues = (
+    Queue('dna_processing'),        # uploads up to SMALL_UPLOAD_BYTES
+    Queue('dna_processing_large'),  # everything bigger
+    Queue('dna_processing_bulk'),   # jobs admission control estimates as long-running
+    Queue('dna_preview'),           # quick previews, and jobs downgraded to one under load
+    Queue('default'),
+)
+
+# Redeliver a job if its worker dies mid-render
+task_acks_late = True
+task_reject_on_worker_lost = True
+# Redis redelivers any task left unacknowledged this long, even to a live
+# worker, so it must outlast the longest job: a whole bulk backlog plus the
+# largest (compressed) upload, doubled for estimates that run short
+broker_transport_options = {
+    'visibility_timeout': int(2 * (LANE_LIMITS['bulk'] + estimate_cost(MAX_UPLOAD_BYTES, compressed=True)))
 }
 
 # Queue settings
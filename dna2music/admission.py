@@ -0,0 +1,70 @@
+import collections
+import math
+import os
+
+BACKLOG_KEY = "admission:backlog"  # hash: lane -> estimated seconds of queued work
+BASES_PER_SECOND = float(os.environ.get("ADMISSION_BASES_PER_SECOND", 1e6))
+JOB_SECONDS = float(os.environ.get("ADMISSION_JOB_SECONDS", 1.0))  # fixed cost of any job
+GZIP_RATIO = 4  # bases per compressed byte, roughly, for .gz uploads
+PREVIEW_SECONDS = 0.1
+# Jobs estimated above this go to the bulk lane, away from interactive ones
+BULK_SECONDS = float(os.environ.get("ADMISSION_BULK_SECONDS", 120))
+# How much queued work each lane accepts before new jobs are downgraded or refused
+LANE_LIMITS = {
+    "interactive": float(os.environ.get("ADMISSION_INTERACTIVE_BACKLOG", 600)),
+    "bulk": float(os.environ.get("ADMISSION_BULK_BACKLOG", 4 * 3600)),
+    "preview": float(os.environ.get("ADMISSION_PREVIEW_BACKLOG", 60)),
+}
+# Workers draining each lane, to turn excess backlog into a Retry-After
+LANE_WORKERS = {"interactive": 2, "bulk": 1, "preview": 2}
+
+Decision = collections.namedtuple('Decision', 'action lane cost retry_after')
+
+def estimate_cost(size, compressed=False, region=None):
+    """Estimated worker seconds for an upload of ``size`` bytes.
+
+    The sequence length is taken from ``region`` (a parsed ``(name, start,
+    end)``) when it is bounded, otherwise from the upload size.
+    """
+    if region is not None and region[2] is not None:
+        bases = region[2] - region[1]
+    else:
+        bases = size * (GZIP_RATIO if compressed else 1)
+    return JOB_SECONDS + bases / BASES_PER_SECOND
+
+def retry_after(excess, lane):
+    return max(1, math.ceil(excess / LANE_WORKERS[lane]))
+
+def admit(cost, backlog, can_preview=True, limits=LANE_LIMITS):
+    """Decide what to do with a job of estimated ``cost`` seconds.
+
+    ``backlog`` maps each lane to the seconds of work already queued on it.
+    The job is admitted to its lane while that stays under its limit (an
+    idle lane takes any job); otherwise it is downgraded to a preview-only
+    render when ``can_preview``, and refused if even that lane is full.
+    """
+    lane = "bulk" if cost > BULK_SECONDS else "interactive"
+    queued = max(backlog.get(lane, 0.0), 0.0)
+    if queued == 0 or queued + cost <= limits[lane]:
+        return Decision('admit', lane, cost, 0)
+    queued_previews = max(backlog.get("preview", 0.0), 0.0)
+    if can_preview and queued_previews + PREVIEW_SECONDS <= limits["preview"]:
+        return Decision('preview', "preview", PREVIEW_SECONDS, 0)
+    return Decision('reject', lane, cost, retry_after(queued + cost - limits[lane], lane))
+
+def charge(pipe, job_key, lane, cost):
+    """Queue adding a job's cost to its lane's backlog, marking its hash as charged."""
+    pipe.hset(job_key, "charged", 1)
+    pipe.hincrbyfloat(BACKLOG_KEY, lane, cost)
+
+def release(redis_client, job_key):
+    """Take a charged job's cost back off the backlog of its lane.
+
+    Only the call that clears the job's ``charged`` mark refunds it, so a
+    redelivered task or a second release cannot drive the backlog negative.
+    """
+    if not redis_client.hdel(job_key, "charged"):
+        return
+    lane, cost = redis_client.hmget(job_key, "lane", "cost")
+    if lane and cost:
+        redis_client.hincrbyfloat(BACKLOG_KEY, lane, -float(cost))
@@ -0,0 +1,262 @@
+import glob
+import hashlib
+import json
+import os
+import time
+import numpy as np
+from dna2music.mapping import composer
+
+MODEL_VERSION = "rules-1"  # bump whenever composing changes the output for the same input
+LSTM_CHECKPOINT = "dna2music/models/checkpoints/lstm/final_model.pt"
+CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", 2 << 30))
+# An in-flight computation is presumed dead once its lock goes this long
+# without being held again; running jobs hold it every HOLD_SECONDS
+LOCK_SECONDS = 600
+HOLD_SECONDS = 60
+
+def model_version(checkpoint=LSTM_CHECKPOINT):
+    """MODEL_VERSION, plus the identity of the LSTM checkpoint when the worker has one."""
+    try:
+        stat = os.stat(checkpoint)
+    except FileNotFoundError:
+        return MODEL_VERSION
+    return f"{MODEL_VERSION}+lstm-{stat.st_size}-{int(stat.st_mtime)}"
+
+def source_digest(source, block=1 << 20):
+    """sha256 of an upload given as bytes or as a path to the spooled file."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return hashlib.sha256(source).hexdigest()
+    digest = hashlib.sha256()
+    with open(source, 'rb') as f:
+        for data in iter(lambda: f.read(block), b''):
+            digest.update(data)
+    return digest.hexdigest()
+
+def cache_key(file_hash, mode='beautiful', config_digest=None, model_version=MODEL_VERSION, **params):
+    """Content address of a result: upload hash, mapping config, model and request options."""
+    if config_digest is None:
+        config_digest = composer.compile_mapping().digest
+    fields = dict(params, file=file_hash, mode=mode, config=config_digest, model=model_version)
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+
+class ResultCache:
+    """Redis-indexed cache of finished results and their audio files.
+
+    Entries live in ``{prefix}:{key}`` hashes and a ``{prefix}:lru`` sorted set
+    scored by last use; the audio files they reference are deleted, least
+    recently used first, once their total size exceeds ``max_bytes``.
+
+    Identical submissions are coalesced: the first to ``join`` a key holds
+    its lock and computes, later ones queue behind it and are handed the
+    same result (or error) by ``release``. Jobs left queued when a lock
+    expires are taken back by ``reap``.
+    """
+
+    def __init__(self, redis_client, output_dir="outputs", max_bytes=CACHE_MAX_BYTES, prefix="cache"):
+        self.redis = redis_client
+        self.output_dir = output_dir
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+
+    def _entry(self, key):
+        return f"{self.prefix}:{key}"
+
+    def _lock(self, key):
+        return f"{self.prefix}:lock:{key}"
+
+    def _waiters(self, key):
+        return f"{self.prefix}:waiters:{key}"
+
+    def artifact_paths(self, result):
+        """Local paths of the audio and MIDI files a result refers to."""
+        entries = [result, result.get("preview") or {}] + result.get("tracks", [])
+        urls = [e.get(field) for e in entries for field in ("audio_path", "midi_path")]
+        return sorted({os.path.join(self.output_dir, os.path.basename(u)) for u in urls if u})
+
+    def _files(self, result):
+        """The result's files plus any other encodings of them made on download."""
+        stems = {os.path.splitext(p)[0] for p in self.artifact_paths(result)}
+        return sorted({p for stem in stems for p in glob.glob(glob.escape(stem) + ".*")})
+
+    def get(self, key):
+        """The cached result for ``key``, or None. Marks the entry as recently used."""
+        raw = self.redis.hget(self._entry(key), "result")
+        if raw is None:
+            return None
+        result = json.loads(raw)
+        if not all(os.path.exists(p) for p in self.artifact_paths(result)):
+            self.discard(key)
+            return None
+        self.redis.zadd(f"{self.prefix}:lru", {key: time.time()})
+        return result
+
+    def put(self, key, result):
+        size = sum(os.path.getsize(p) for p in self.artifact_paths(result) if os.path.exists(p))
+        pipe = self.redis.pipeline()
+        pipe.hset(self._entry(key), mapping={"result": json.dumps(result), "size": size})
+        pipe.zadd(f"{self.prefix}:lru", {key: time.time()})
+        pipe.incrby(f"{self.prefix}:bytes", size)
+        pipe.execute()
+        self.evict(keep=key)
+
+    def discard(self, key):
+        raw, size = self.redis.hmget(self._entry(key), "result", "size")
+        if raw is not None:
+            for path in self._files(json.loads(raw)):
+                if os.path.exists(path):
+                    os.remove(path)
+        pipe = self.redis.pipeline()
+        pipe.delete(self._entry(key))
+        pipe.zrem(f"{self.prefix}:lru", key)
+        if size:
+            pipe.decrby(f"{self.prefix}:bytes", int(size))
+        pipe.execute()
+
+    def evict(self, keep=None):
+        """Drop least recently used entries until the files fit in ``max_bytes``."""
+        while int(self.redis.get(f"{self.prefix}:bytes") or 0) > self.max_bytes:
+            oldest = self.redis.zrange(f"{self.prefix}:lru", 0, 1)
+            oldest = [k for k in oldest if k != keep]
+            if not oldest:
+                break
+            self.discard(oldest[0])
+
+    def join(self, key, job_id, seconds=LOCK_SECONDS):
+        """Register ``job_id`` for ``key``.
+
+        Returns ``'leader'`` if this job should compute the result, otherwise
+        ``'follower'`` (it will be handed the leader's outcome by ``release``)
+        or ``'hit'`` (the result became available in the meantime). A new
+        lock lasts ``seconds``, which should cover the leader's wait in its
+        queue; once running, the leader keeps it with ``hold``.
+        """
+        while True:
+            if self.redis.set(self._lock(key), job_id, nx=True, ex=int(seconds)):
+                return 'leader'
+            # Queue and check the lock atomically, so release() either sees
+            # this job or has already removed the lock
+            pipe = self.redis.pipeline(transaction=True)
+            pipe.rpush(self._waiters(key), job_id)
+            pipe.expire(self._waiters(key), int(seconds) + LOCK_SECONDS)
+            pipe.ttl(self._lock(key))
+            _, _, ttl = pipe.execute()
+            if ttl != -2:
+                # Kept past the lock, however long the leader was given, so
+                # reap can still find them
+                self.redis.expire(self._waiters(key), max(ttl, int(seconds)) + LOCK_SECONDS)
+                return 'follower'
+            self.redis.lrem(self._waiters(key), 0, job_id)
+            if self.get(key) is not None:
+                return 'hit'
+            # The leader failed; try to take over
+
+    def hold(self, key, seconds=LOCK_SECONDS):
+        """Keep the lock on ``key``, and its waiters, for another ``seconds``."""
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.expire(self._lock(key), seconds)
+        pipe.expire(self._waiters(key), seconds + LOCK_SECONDS)
+        pipe.execute()
+
+    def waiters(self, key):
+        """Job ids currently queued behind the computation of ``key``."""
+        return self.redis.lrange(self._waiters(key), 0, -1)
+
+    def release(self, key):
+        """Drop the lock on ``key`` and return the job ids queued behind it."""
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.lrange(self._waiters(key), 0, -1)
+        pipe.delete(self._waiters(key), self._lock(key))
+        waiters, _ = pipe.execute()
+        return waiters
+
+    def reap(self, key):
+        """Take the jobs queued behind ``key`` if its lock is gone.
+
+        A lock disappears with its waiters on ``release``, so waiters left
+        without one belong to a leader that died and whose lock expired;
+        nothing will hand them a result.
+        """
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.exists(self._lock(key))
+        pipe.lrange(self._waiters(key), 0, -1)
+        locked, waiters = pipe.execute()
+        if locked:
+            return []
+        # Removed one at a time, so concurrent callers never both take a job
+        return [job_id for job_id in waiters if self.redis.lrem(self._waiters(key), 1, job_id)]
+
+STAGE_DIR = os.environ.get("STAGE_CACHE_DIR", "cache/stages")
+STAGE_MAX_BYTES = int(os.environ.get("STAGE_CACHE_MAX_BYTES", 1 << 30))
+STAGE_GRACE_SECONDS = 600  # entries used this recently are never evicted
+
+class StageCache:
+    """Intermediate arrays of each pipeline stage, stored as ``.npz`` files.
+
+    An entry lives at ``{directory}/{stage}/{key}.npz`` where the key hashes
+    the inputs of that stage, so a re-render recomputes only the stages
+    whose inputs changed. A file's mtime is its last use; ``evict`` deletes
+    least recently used files once they total more than ``max_bytes``,
+    sparing those used in the last ``grace`` seconds, which a job running
+    alongside may be about to read.
+    """
+
+    def __init__(self, directory=STAGE_DIR, max_bytes=STAGE_MAX_BYTES, grace=STAGE_GRACE_SECONDS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.grace = grace
+
+    @staticmethod
+    def key(stage, *parts):
+        return hashlib.sha256(json.dumps([stage, *parts], sort_keys=True).encode()).hexdigest()
+
+    def path(self, stage, key):
+        return os.path.join(self.directory, stage, f"{key}.npz")
+
+    def has(self, stage, key):
+        return os.path.exists(self.path(stage, key))
+
+    def load(self, stage, key):
+        """The arrays saved for ``key``, or None."""
+        path = self.path(stage, key)
+        try:
+            with np.load(path) as data:
+                arrays = {name: data[name] for name in data.files}
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return arrays
+
+    def save(self, stage, key, **arrays):
+        path = self.path(stage, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written aside and renamed so readers never see a partial file
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, path)
+        return arrays
+
+    def cached(self, stage, key, compute):
+        """Load ``key`` or compute, save and return its arrays."""
+        arrays = self.load(stage, key)
+        return arrays if arrays is not None else self.save(stage, key, **compute())
+
+    def evict(self):
+        """Drop least recently used files until the cache fits in ``max_bytes``."""
+        entries = []
+        for path in glob.glob(os.path.join(glob.escape(self.directory), '*', '*.npz')):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        cutoff = time.time() - self.grace
+        for used, size, path in sorted(entries):
+            if total <= self.max_bytes or used > cutoff:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
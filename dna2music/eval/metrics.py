@@ -1,90 +1,64 @@
 import numpy as np
 import pandas as pd
-from collections import Counter
 from scipy.stats import pearsonr
 from sklearn.metrics.pairwise import cosine_similarity
+from dna2music.mapping.events import as_note_events
+from dna2music.mapping.parser import sliding_features
 
 def pitch_class_histogram_entropy(notes):
     """Calculate pitch-class histogram entropy"""
-    if not notes:
+    notes = as_note_events(notes)
+    if not len(notes):
         return 0.0
     
-    # Extract pitch classes (0-11)
-    pitch_classes = [note['pitch'] % 12 for note in notes]
-    
-    # Count occurrences
-    pc_counts = Counter(pitch_classes)
-    total_notes = len(pitch_classes)
+    # Count pitch classes (0-11)
+    pc_counts = np.bincount(notes.pitch % 12, minlength=12)
     
     # Calculate entropy
-    entropy = 0.0
-    for count in pc_counts.values():
-        p = count / total_notes
-        if p > 0:
-            entropy -= p * np.log2(p)
-    
-    return entropy
+    p = pc_counts[pc_counts > 0] / len(notes)
+    return float(-(p * np.log2(p)).sum())
 
 def n_gram_novelty(notes, training_notes, n=3):
     """Calculate n-gram novelty compared to training set"""
-    if not notes or not training_notes:
+    notes = as_note_events(notes)
+    training_notes = as_note_events(training_notes)
+    if not len(notes) or not len(training_notes):
         return 0.0
     
-    # Extract n-grams from generated notes
-    generated_ngrams = []
-    for i in range(len(notes) - n + 1):
-        ngram = tuple(notes[j]['pitch'] for j in range(i, i + n))
-        generated_ngrams.append(ngram)
-    
-    # Extract n-grams from training notes
-    training_ngrams = []
-    for i in range(len(training_notes) - n + 1):
-        ngram = tuple(training_notes[j]['pitch'] for j in range(i, i + n))
-        training_ngrams.append(ngram)
-    
-    # Calculate novelty
-    generated_set = set(generated_ngrams)
-    training_set = set(training_ngrams)
+    # Distinct n-grams as rows of a (count, n) pitch matrix
+    def ngrams(pitches):
+        if len(pitches) < n:
+            return np.empty((0, n), dtype=pitches.dtype)
+        return np.unique(np.lib.stride_tricks.sliding_window_view(pitches, n), axis=0)
     
-    novel_ngrams = generated_set - training_set
-    novelty = len(novel_ngrams) / len(generated_set) if generated_set else 0.0
+    generated = ngrams(notes.pitch)
+    training = ngrams(training_notes.pitch)
+    if not len(generated):
+        return 0.0
     
-    return novelty
+    # Calculate novelty: share of generated n-grams absent from training
+    combined = np.concatenate([training, generated])
+    _, first_seen = np.unique(combined, axis=0, return_index=True)
+    novel = np.count_nonzero(first_seen >= len(training))
+    return novel / len(generated)
 
 def gc_content_rhythm_correlation(dna_seq, notes):
     """Calculate correlation between GC content and rhythm"""
-    if not dna_seq or not notes:
+    notes = as_note_events(notes)
+    if not len(dna_seq) or not len(notes):
         return 0.0
     
-    # Calculate GC content for DNA windows
+    # Calculate GC content for non-overlapping DNA windows
     window_size = 100
-    gc_contents = []
-    for i in range(0, len(dna_seq) - window_size + 1, window_size):
-        window = dna_seq[i:i + window_size]
-        gc_count = window.count('G') + window.count('C')
-        gc_content = gc_count / len(window)
-        gc_contents.append(gc_content)
+    gc_contents = sliding_features(dna_seq, window=window_size, step=window_size)['gc'].to_numpy()
     
     # Calculate rhythm density (notes per time unit)
     if len(notes) < 2:
         return 0.0
     
-    rhythm_density = []
     time_window = 1.0  # 1 second windows
-    current_time = 0.0
-    notes_in_window = 0
-    
-    for note in notes:
-        if note['start'] >= current_time + time_window:
-            rhythm_density.append(notes_in_window)
-            current_time += time_window
-            notes_in_window = 1
-        else:
-            notes_in_window += 1
-    
-    # Add final window
-    if notes_in_window > 0:
-        rhythm_density.append(notes_in_window)
+    window_index = np.floor(notes.start / time_window).astype(np.int64)
+    rhythm_density = np.bincount(window_index)
     
     # Ensure same length
     min_len = min(len(gc_contents), len(rhythm_density))
@@ -104,13 +78,15 @@ def musical_coherence(notes):
     if len(notes) < 2:
         return 0.0
     
+    notes = as_note_events(notes)
+    
     # Extract features
-    pitches = [note['pitch'] for note in notes]
-    velocities = [note['velocity'] for note in notes]
-    durations = [note['duration'] for note in notes]
+    pitches = notes.pitch
+    velocities = notes.velocity
+    durations = notes.duration
     
     # Pitch coherence (smoothness)
-    pitch_changes = np.diff(pitches)
+    pitch_changes = np.diff(pitches.astype(np.int64))
     pitch_coherence = 1.0 / (1.0 + np.std(pitch_changes))
     
     # Velocity coherence
@@ -122,11 +98,12 @@ def musical_coherence(notes):
     # Overall coherence
     coherence = (pitch_coherence + velocity_coherence + duration_coherence) / 3.0
     
-    return coherence
+    return float(coherence)
 
 def evaluate_dna_music(dna_seq, notes, training_notes=None):
     """Comprehensive evaluation of DNA-to-music conversion"""
     results = {}
+    notes = as_note_events(notes)
     
     # Basic metrics
     results['note_count'] = len(notes)
@@ -137,7 +114,7 @@ def evaluate_dna_music(dna_seq, notes, training_notes=None):
     results['musical_coherence'] = musical_coherence(notes)
     
     # Novelty (if training data available)
-    if training_notes:
+    if training_notes is not None and len(training_notes):
         results['novelty_3gram'] = n_gram_novelty(notes, training_notes, n=3)
         results['novelty_5gram'] = n_gram_novelty(notes, training_notes, n=5)
     
@@ -145,11 +122,11 @@ def evaluate_dna_music(dna_seq, notes, training_notes=None):
     results['gc_rhythm_correlation'] = gc_content_rhythm_correlation(dna_seq, notes)
     
     # Pitch range
-    if notes:
-        pitches = [note['pitch'] for note in notes]
-        results['pitch_range'] = max(pitches) - min(pitches)
-        results['avg_pitch'] = np.mean(pitches)
-        results['pitch_std'] = np.std(pitches)
+    if len(notes):
+        pitches = notes.pitch
+        results['pitch_range'] = int(pitches.max()) - int(pitches.min())
+        results['avg_pitch'] = float(np.mean(pitches))
+        results['pitch_std'] = float(np.std(pitches))
     
     return results
 
@@ -0,0 +1,530 @@
+import asyncio
+import collections
+import json
+import math
+import os
+import threading
+import time
+
+JOB_TTL = int(os.environ.get("JOB_TTL_SECONDS", 7 * 24 * 3600))
+
+class JobStore:
+    """Job hashes in Redis, indexed so that counting and listing never scan.
+
+    Each job lives in a ``{prefix}:{job_id}`` hash that expires ``ttl``
+    seconds after it was created. ``{prefix}s:index`` scores job ids by
+    creation time for paginated listing, and one ``{prefix}s:status:{status}``
+    sorted set per status (same scores) gives per-status counts with ZCARD.
+    Index entries of expired jobs are trimmed whenever the indexes are read.
+
+    Updates can carry a progress event, published on the job's
+    ``{prefix}:{job_id}:events`` channel in the same round trip.
+    """
+
+    def __init__(self, redis_client, ttl=JOB_TTL, prefix="job"):
+        self.redis = redis_client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _job(self, job_id):
+        return f"{self.prefix}:{job_id}"
+
+    def _index(self):
+        return f"{self.prefix}s:index"
+
+    def _status(self, status):
+        return f"{self.prefix}s:status:{status}"
+
+    def _statuses(self):
+        return f"{self.prefix}s:statuses"
+
+    def key(self, job_id):
+        """Redis key of the job's hash."""
+        return self._job(job_id)
+
+    def channel(self, job_id):
+        """Pub/sub channel of the job's progress events."""
+        return f"{self.prefix}:{job_id}:events"
+
+    # Each operation queues its commands on a pipeline in these helpers, so
+    # JobStore and AsyncJobStore only differ in how they run the pipelines
+
+    def _queue_create(self, pipe, job_id, data):
+        created = time.time()
+        data = dict(data, created_at=str(created))
+        pipe.hset(self._job(job_id), mapping=data)
+        pipe.expireat(self._job(job_id), int(created + self.ttl))
+        pipe.zadd(self._index(), {job_id: created})
+        if "status" in data:
+            pipe.sadd(self._statuses(), data["status"])
+            pipe.zadd(self._status(data["status"]), {job_id: created})
+
+    def _queue_lookup(self, pipe, job_ids):
+        for job_id in job_ids:
+            pipe.zscore(self._index(), job_id)
+        pipe.smembers(self._statuses())
+
+    def _queue_update(self, pipe, job_ids, found, mapping, event=None):
+        *created, statuses = found
+        status = mapping.get("status")
+        if status:
+            pipe.sadd(self._statuses(), status)
+        cutoff = time.time() - self.ttl
+        for job_id, score in zip(job_ids, created):
+            if score is None or score <= cutoff:
+                # Expired or never created; don't bring the hash back
+                continue
+            if mapping:
+                pipe.hset(self._job(job_id), mapping=mapping)
+            pipe.expireat(self._job(job_id), int(score + self.ttl))
+            if status:
+                for other in statuses:
+                    if other != status:
+                        pipe.zrem(self._status(other), job_id)
+                pipe.zadd(self._status(status), {job_id: score})
+            if event is not None:
+                pipe.publish(self.channel(job_id), json.dumps(event))
+
+    def _queue_trim(self, pipe, statuses):
+        cutoff = time.time() - self.ttl
+        for key in [self._index()] + [self._status(s) for s in statuses]:
+            pipe.zremrangebyscore(key, "-inf", cutoff)
+
+    def _queue_counts(self, pipe, statuses):
+        statuses = sorted(statuses)
+        self._queue_trim(pipe, statuses)
+        pipe.zcard(self._index())
+        for status in statuses:
+            pipe.zcard(self._status(status))
+        return statuses
+
+    def _queue_page(self, pipe, offset, limit, status):
+        self._queue_trim(pipe, [status] if status else [])
+        key = self._status(status) if status else self._index()
+        pipe.zrevrange(key, offset, offset + limit - 1)
+
+    def _queue_get(self, pipe, job_ids):
+        for job_id in job_ids:
+            pipe.hgetall(self._job(job_id))
+
+    def create(self, job_id, data):
+        pipe = self.redis.pipeline(transaction=True)
+        self._queue_create(pipe, job_id, data)
+        pipe.execute()
+
+    def update(self, job_ids, mapping, event=None):
+        """Write ``mapping`` to each job in ``job_ids``, moving them between status sets.
+
+        ``event`` (a dict with at least a ``stage``) is published to each of them.
+        """
+        job_ids = [job_ids] if isinstance(job_ids, str) else list(job_ids)
+        pipe = self.redis.pipeline()
+        self._queue_lookup(pipe, job_ids)
+        found = pipe.execute()
+        pipe = self.redis.pipeline(transaction=True)
+        self._queue_update(pipe, job_ids, found, mapping, event)
+        pipe.execute()
+
+    def get(self, job_id):
+        return self.redis.hgetall(self._job(job_id))
+
+    def get_many(self, job_ids):
+        """The hashes of several jobs in one round trip ({} for missing ones)."""
+        pipe = self.redis.pipeline()
+        self._queue_get(pipe, job_ids)
+        return pipe.execute()
+
+    def counts(self):
+        """Number of live jobs in total and per status."""
+        pipe = self.redis.pipeline()
+        statuses = self._queue_counts(pipe, self.redis.smembers(self._statuses()))
+        total, *per_status = pipe.execute()[len(statuses) + 1:]
+        return total, dict(zip(statuses, per_status))
+
+    def list(self, offset=0, limit=50, status=None):
+        """``(job_id, job)`` pairs, newest first."""
+        pipe = self.redis.pipeline()
+        self._queue_page(pipe, offset, limit, status)
+        job_ids = pipe.execute()[-1]
+        return [(job_id, job) for job_id, job in zip(job_ids, self.get_many(job_ids)) if job]
+
+class AsyncJobStore(JobStore):
+    """JobStore over a ``redis.asyncio`` client, for the API's async handlers."""
+
+    async def create(self, job_id, data):
+        pipe = self.redis.pipeline(transaction=True)
+        self._queue_create(pipe, job_id, data)
+        await pipe.execute()
+
+    async def update(self, job_ids, mapping, event=None):
+        job_ids = [job_ids] if isinstance(job_ids, str) else list(job_ids)
+        pipe = self.redis.pipeline()
+        self._queue_lookup(pipe, job_ids)
+        found = await pipe.execute()
+        pipe = self.redis.pipeline(transaction=True)
+        self._queue_update(pipe, job_ids, found, mapping, event)
+        await pipe.execute()
+
+    async def get(self, job_id):
+        return await self.redis.hgetall(self._job(job_id))
+
+    async def get_many(self, job_ids):
+        pipe = self.redis.pipeline()
+        self._queue_get(pipe, job_ids)
+        return await pipe.execute()
+
+    async def counts(self):
+        pipe = self.redis.pipeline()
+        statuses = self._queue_counts(pipe, await self.redis.smembers(self._statuses()))
+        total, *per_status = (await pipe.execute())[len(statuses) + 1:]
+        return total, dict(zip(statuses, per_status))
+
+    async def list(self, offset=0, limit=50, status=None):
+        pipe = self.redis.pipeline()
+        self._queue_page(pipe, offset, limit, status)
+        job_ids = (await pipe.execute())[-1]
+        return [(job_id, job) for job_id, job in zip(job_ids, await self.get_many(job_ids)) if job]
+
+FINAL_STATUSES = ("completed", "failed", "expired")
+
+def batch_summary(children, filenames, child_jobs):
+    """Overall status, counts per status and each job's outcome for a batch.
+
+    ``child_jobs`` are the hashes of the ``children`` job ids, empty once
+    expired. ``expired`` is final like ``completed`` and ``failed``: the
+    batch is done when all its jobs are, and completed if any job completed.
+    """
+    entries, counts = [], {}
+    for job_id, filename, job in zip(children, filenames, child_jobs):
+        status = job.get("status", "expired")
+        counts[status] = counts.get(status, 0) + 1
+        entry = {"job_id": job_id, "filename": filename, "status": status}
+        if status == "completed":
+            entry["result"] = json.loads(job["result"]) if job.get("result") else None
+            entry["download_url"] = f"/api/download/{job_id}"
+        elif status == "failed":
+            entry["error"] = job.get("error")
+        entries.append(entry)
+    if sum(counts.get(status, 0) for status in FINAL_STATUSES) < len(children):
+        status = "processing"
+    else:
+        status = "completed" if counts.get("completed") else "failed"
+    return {"status": status, "total": len(children), "counts": counts, "jobs": entries}
+
+class MemoryRedis:
+    """In-process stand-in for the subset of the Redis API used here.
+
+    For running the backend and the tasks without a Redis server (one
+    process only) and for tests. Keys expire lazily on access.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.expiry = {}
+        self.subscribers = collections.defaultdict(set)  # channel -> MemoryPubSub
+        self.lock = threading.RLock()
+
+    def _live(self, key):
+        if key in self.expiry and self.expiry[key] <= time.time():
+            self.data.pop(key, None)
+            self.expiry.pop(key, None)
+        return self.data.get(key)
+
+    def _get(self, key, kind):
+        value = self._live(key)
+        if value is None:
+            value = self.data[key] = kind()
+        return value
+
+    def _drop_empty(self, key):
+        if not self.data.get(key, True):
+            self.delete(key)
+
+    def pipeline(self, transaction=True):
+        return MemoryPipeline(self)
+
+    def exists(self, *keys):
+        with self.lock:
+            return sum(self._live(k) is not None for k in keys)
+
+    def delete(self, *keys):
+        with self.lock:
+            found = self.exists(*keys)
+            for key in keys:
+                self.data.pop(key, None)
+                self.expiry.pop(key, None)
+            return found
+
+    def expire(self, key, seconds):
+        return self.expireat(key, time.time() + seconds)
+
+    def expireat(self, key, when):
+        with self.lock:
+            if self._live(key) is None:
+                return False
+            self.expiry[key] = when
+            return True
+
+    def ttl(self, key):
+        with self.lock:
+            if self._live(key) is None:
+                return -2
+            return math.ceil(self.expiry[key] - time.time()) if key in self.expiry else -1
+
+    def get(self, key):
+        with self.lock:
+            return self._live(key)
+
+    def set(self, key, value, nx=False, ex=None):
+        with self.lock:
+            if nx and self._live(key) is not None:
+                return None
+            self.data[key] = str(value)
+            self.expiry.pop(key, None)
+            if ex is not None:
+                self.expire(key, ex)
+            return True
+
+    def incrby(self, key, amount=1):
+        with self.lock:
+            value = int(self._live(key) or 0) + amount
+            self.data[key] = str(value)
+            return value
+
+    def decrby(self, key, amount=1):
+        return self.incrby(key, -amount)
+
+    def hincrbyfloat(self, key, field, amount=1.0):
+        with self.lock:
+            h = self._get(key, dict)
+            value = float(h.get(field, 0)) + amount
+            h[field] = repr(value)
+            return value
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        with self.lock:
+            h = self._get(key, dict)
+            items = dict(mapping or {}, **({field: value} if field is not None else {}))
+            added = sum(f not in h for f in items)
+            h.update({f: str(v) for f, v in items.items()})
+            return added
+
+    def hdel(self, key, *fields):
+        with self.lock:
+            h = self._live(key) or {}
+            removed = sum(h.pop(f, None) is not None for f in fields)
+            self._drop_empty(key)
+            return removed
+
+    def hget(self, key, field):
+        with self.lock:
+            return (self._live(key) or {}).get(field)
+
+    def hmget(self, key, *fields):
+        with self.lock:
+            h = self._live(key) or {}
+            return [h.get(f) for f in fields]
+
+    def hgetall(self, key):
+        with self.lock:
+            return dict(self._live(key) or {})
+
+    def sadd(self, key, *members):
+        with self.lock:
+            s = self._get(key, set)
+            added = len(set(members) - s)
+            s.update(members)
+            return added
+
+    def smembers(self, key):
+        with self.lock:
+            return set(self._live(key) or ())
+
+    def rpush(self, key, *values):
+        with self.lock:
+            values_list = self._get(key, list)
+            values_list.extend(str(v) for v in values)
+            return len(values_list)
+
+    def lrange(self, key, start, end):
+        with self.lock:
+            values = self._live(key) or []
+            return values[start:len(values) if end == -1 else end + 1]
+
+    def lrem(self, key, count, value):
+        with self.lock:
+            values = self._live(key) or []
+            kept = [v for v in values if v != value]
+            removed = len(values) - len(kept)
+            if values:
+                self.data[key] = kept
+                self._drop_empty(key)
+            return removed
+
+    def zadd(self, key, mapping):
+        with self.lock:
+            z = self._get(key, dict)
+            added = sum(m not in z for m in mapping)
+            z.update({m: float(s) for m, s in mapping.items()})
+            return added
+
+    def zrem(self, key, *members):
+        with self.lock:
+            z = self._live(key) or {}
+            removed = sum(z.pop(m, None) is not None for m in members)
+            self._drop_empty(key)
+            return removed
+
+    def zscore(self, key, member):
+        with self.lock:
+            return (self._live(key) or {}).get(member)
+
+    def zcard(self, key):
+        with self.lock:
+            return len(self._live(key) or {})
+
+    def _ordered(self, key):
+        z = self._live(key) or {}
+        return sorted(z, key=lambda m: (z[m], m))
+
+    def zrange(self, key, start, end):
+        with self.lock:
+            members = self._ordered(key)
+            return members[start:len(members) if end == -1 else end + 1]
+
+    def zrevrange(self, key, start, end):
+        with self.lock:
+            members = self._ordered(key)[::-1]
+            return members[start:len(members) if end == -1 else end + 1]
+
+    def publish(self, channel, message):
+        with self.lock:
+            receivers = list(self.subscribers.get(channel, ()))
+        for pubsub in receivers:
+            pubsub.messages.append({"type": "message", "channel": channel, "data": str(message)})
+        return len(receivers)
+
+    def pubsub(self):
+        return MemoryPubSub(self)
+
+    def zremrangebyscore(self, key, low, high):
+        with self.lock:
+            z = self._live(key) or {}
+            gone = [m for m, s in z.items() if float(low) <= s <= float(high)]
+            for m in gone:
+                del z[m]
+            self._drop_empty(key)
+            return len(gone)
+
+class MemoryPipeline:
+    """Queues MemoryRedis calls and runs them together on ``execute``."""
+
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+        def queue(*args, **kwargs):
+            self.calls.append((method, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        with self.client.lock:
+            calls, self.calls = self.calls, []
+            return [method(*args, **kwargs) for method, args, kwargs in calls]
+
+class MemoryPubSub:
+    """Channel subscriptions on a MemoryRedis (subscribe, get_message, unsubscribe)."""
+
+    def __init__(self, client):
+        self.client = client
+        self.channels = set()
+        self.messages = collections.deque()
+
+    def subscribe(self, *channels):
+        with self.client.lock:
+            for channel in channels:
+                self.channels.add(channel)
+                self.client.subscribers[channel].add(self)
+
+    def unsubscribe(self, *channels):
+        with self.client.lock:
+            for channel in channels or list(self.channels):
+                self.channels.discard(channel)
+                self.client.subscribers[channel].discard(self)
+                if not self.client.subscribers[channel]:
+                    del self.client.subscribers[channel]
+
+    def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        deadline = time.monotonic() + (timeout or 0)
+        while not self.messages and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self.messages.popleft() if self.messages else None
+
+    def close(self):
+        self.unsubscribe()
+
+class AsyncMemoryPubSub(MemoryPubSub):
+    async def subscribe(self, *channels):
+        super().subscribe(*channels)
+
+    async def unsubscribe(self, *channels):
+        super().unsubscribe(*channels)
+
+    async def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        deadline = time.monotonic() + (timeout or 0)
+        while not self.messages and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        return self.messages.popleft() if self.messages else None
+
+    async def aclose(self):
+        self.close()
+
+class AsyncMemoryRedis:
+    """``redis.asyncio``-style view of a MemoryRedis."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def pipeline(self, transaction=True):
+        return AsyncMemoryPipeline(self.client)
+
+    def pubsub(self):
+        return AsyncMemoryPubSub(self.client)
+
+    async def aclose(self):
+        pass
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+        return call
+
+class AsyncMemoryPipeline(MemoryPipeline):
+    async def execute(self):
+        return super().execute()
+
+_memory_clients = {}
+
+def redis_from_url(url, **kwargs):
+    """A Redis client for ``url``; ``memory://`` gives an in-process MemoryRedis."""
+    if url.startswith("memory://"):
+        return _memory_clients.setdefault(url, MemoryRedis())
+    import redis
+    return redis.Redis.from_url(url, decode_responses=True, **kwargs)
+
+def async_redis_from_url(url, max_connections=64):
+    """A pooled ``redis.asyncio`` client for ``url``.
+
+    Requests wait for a free connection once ``max_connections`` are in use.
+    For ``memory://`` it shares the MemoryRedis of ``redis_from_url(url)``.
+    """
+    if url.startswith("memory://"):
+        return AsyncMemoryRedis(redis_from_url(url))
+    import redis.asyncio
+    pool = redis.asyncio.BlockingConnectionPool.from_url(url, max_connections=max_connections,
+                                                         decode_responses=True)
+    return redis.asyncio.Redis(connection_pool=pool)
@@ -1,7 +1,12 @@
 import numpy as np
+import functools
+import hashlib
 import itertools
 import json
 import os
+from dna2music.mapping.sequence import N, PackedSequence, as_packed
+from dna2music.mapping.events import NoteEvents
+from dna2music.mapping.motifs import MotifHits, MotifIndex
 
 # Load config
 CONFIG_PATH = os.path.join(os.path.dirname(__file__), 'configs', 'default.json')
@@ -11,6 +16,8 @@ with open(CONFIG_PATH) as f:
 SCALES = CONFIG.get('scales', {})
 RHYTHM_RULES = CONFIG.get('rhythm_rules', {})
 MOTIFS = CONFIG.get('motifs', {})
+PHRASES = CONFIG.get('phrases', {})
+ALPHABET = CONFIG.get('alphabet', {'A': 60, 'C': 64, 'G': 67, 'T': 69})
 
 # 64 codons
 CODONS = [''.join(c) for c in itertools.product('ACGT', repeat=3)]
@@ -18,6 +25,9 @@ CODONS = [''.join(c) for c in itertools.product('ACGT', repeat=3)]
 # Precompute a simple 3-voice chord table (root, third, fifth)
 BASE_PITCH = 48  # C3
 CHORD_TABLE = {c: [BASE_PITCH + i*4 + j for j in (0, 4, 7)] for i, c in enumerate(CODONS)}
+# Same table indexed by codon number; the extra last row (index -1) is the
+# fallback chord for codons containing N
+CHORD_ARRAY = np.array([CHORD_TABLE[c] for c in CODONS] + [[60, 64, 67]])
 
 # Default scale masks
 PENTATONIC_MASK = SCALES.get('pentatonic', [0, 2, 4, 7, 9])
@@ -31,6 +41,8 @@ def markov_rhythm_prior(seq_len):
     return np.ones(seq_len) / seq_len
 
 def codons(seq):
+    if isinstance(seq, PackedSequence):
+        seq = str(seq)
     return [seq[i:i+3] for i in range(0, len(seq)-2, 3)]
 
 def scale_mask_pitch(pitch, mask, base=60):
@@ -48,20 +60,75 @@ def select_scale(gc):
     else:
         return CINEMATIC_MASK
 
+@functools.lru_cache(maxsize=8)
+def _motif_index(motifs):
+    return MotifIndex(dict(motifs))
+
+def motif_index(motifs):
+    """MotifIndex for a motif -> phrase dict, built once per motif set."""
+    return _motif_index(tuple(sorted(motifs.items())))
+
 def find_motifs(seq, motifs):
-    found = []
-    for motif, phrase in motifs.items():
-        idx = seq.find(motif)
-        if idx != -1:
-            found.append((idx, phrase))
-    return found
-
-def compose_chords(seq):
-    # Motif-to-phrase mapping (stub: just mark motif positions)
-    motifs_found = find_motifs(seq, MOTIFS)
-    chords = [CHORD_TABLE.get(c, [60, 64, 67]) for c in codons(seq)]
-    # Optionally, insert special chords/phrases at motif positions
-    # (left as an exercise for further expansion)
+    """All ``(position, phrase)`` motif hits on either strand, by position."""
+    index = motif_index(motifs)
+    hits = index.find(seq)
+    return [(pos, index.phrases[m]) for pos, m in zip(hits.position.tolist(), hits.motif.tolist())]
+
+def insert_phrases(chords, hits, index, phrases=PHRASES):
+    """Overwrite chords from each hit's codon onwards with its motif's phrase.
+
+    Hits are applied in position order, so a later phrase wins where two
+    overlap.
+    """
+    width = chords.shape[1]
+    rows = [np.asarray(phrases.get(p, []), dtype=chords.dtype).reshape(-1, width) for p in index.phrases]
+    lengths = np.array([len(r) for r in rows])
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    table = np.concatenate(rows) if rows else np.empty((0, width), dtype=chords.dtype)
+    counts = lengths[hits.motif]
+    within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    targets = np.repeat(hits.position // 3, counts) + within
+    sources = np.repeat(offsets[hits.motif], counts) + within
+    keep = targets < len(chords)
+    chords[targets[keep]] = table[sources[keep]]
+    return chords
+
+def chord_codes(seq, motifs=MOTIFS):
+    """Codon numbers (uint8, 64 for codons with N) and motif hits of ``seq``.
+
+    This is all compose_chords needs, in a fraction of the chords' size.
+    """
+    seq = as_packed(seq)
+    codes = (seq.codon_indices() % len(CHORD_ARRAY)).astype(np.uint8)
+    if motifs:
+        hits = motif_index(motifs).find(seq)
+    else:
+        hits = MotifHits(np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.int8))
+    return codes, hits
+
+def chords_from_codes(codes, hits, motifs=MOTIFS):
+    chords = CHORD_ARRAY[codes]
+    # Motif-to-phrase mapping: every hit on either strand starts its phrase
+    if motifs:
+        chords = insert_phrases(chords, hits, motif_index(motifs))
+    return chords
+
+def compose_chords(seq, motifs=MOTIFS):
+    return chords_from_codes(*chord_codes(seq, motifs), motifs)
+
+# Pitch per allele code (A, C, G, T) for genotype calls
+ALLELE_PITCH = np.array([ALPHABET[b] for b in 'ACGT'])
+
+def genotype_chords(calls):
+    """One chord per called genotype: both alleles plus the first an octave up.
+
+    Homozygous calls sound as unison + octave, heterozygous calls as an
+    interval; haploid calls repeat their single allele.
+    """
+    called = calls.allele1 != N
+    first = calls.allele1[called]
+    second = np.where(calls.allele2[called] == N, first, calls.allele2[called])
+    chords = np.stack([ALLELE_PITCH[first], ALLELE_PITCH[second], ALLELE_PITCH[first] + 12], axis=1)
     return chords
 
 def get_note_duration(gc, entropy, rules):
@@ -73,6 +140,96 @@ def get_note_duration(gc, entropy, rules):
     else:
         return rules['gc_content']['high']
 
+# Threshold bins mirroring select_scale and get_note_duration
+SCALE_BINS = (0.4, 0.6, 0.7)
+SCALE_BY_BIN = ('major', 'pentatonic', 'blues', 'cinematic')
+RHYTHM_BINS = (0.4, 0.6)
+RHYTHM_BY_BIN = ('low', 'medium', 'high')
+
+def gc_bins(gc, bins):
+    """Bin of each GC value, compared at float32 as the stage cache stores them.
+
+    GC values are averages of whole-base counts, so none lies within float32
+    rounding of an edge without being on it; the bins match float64 ones.
+    """
+    return np.searchsorted(np.asarray(bins, dtype=np.float32), np.asarray(gc, dtype=np.float32), side='right')
+
+MODE_SCALES = {
+    'beautiful': 'pentatonic',
+    'major': 'major',
+    'blues': 'blues',
+    'cinematic': 'cinematic',
+    'minor': 'minor'
+}
+DEFAULT_SCALES = {
+    'pentatonic': PENTATONIC_MASK,
+    'major': MAJOR_MASK,
+    'blues': BLUES_MASK,
+    'cinematic': CINEMATIC_MASK,
+    'minor': MINOR_MASK
+}
+
+# Quantization tables cover every MIDI pitch and the whole chord table
+PITCH_TABLE_SIZE = max(128, int(CHORD_ARRAY.max()) + 1)
+
+def quantize_table(mask):
+    """Dense pitch -> scale_mask_pitch(pitch, mask) table; identity for an empty mask."""
+    pitches = np.arange(PITCH_TABLE_SIZE)
+    if not mask:
+        return pitches
+    return np.array([scale_mask_pitch(p, mask) for p in pitches])
+
+def config_hash(config):
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+class CompiledMapping:
+    """A mapping config compiled into dense lookup tables.
+
+    ``pitch_tables`` holds one quantization row per scale, ``scale_for_bin``
+    maps GC bins to rows, and ``durations`` maps GC bins to note lengths.
+    """
+
+    def __init__(self, config, digest=None):
+        scales = dict(DEFAULT_SCALES, **config.get('scales', {}))
+        self.digest = digest or config_hash(config)
+        self.scale_names = list(scales)
+        self.pitch_tables = np.stack([quantize_table(scales[name]) for name in self.scale_names])
+        self.mode_rows = {mode: self.scale_names.index(name) for mode, name in MODE_SCALES.items()}
+        self.scale_for_bin = np.array([self.scale_names.index(name) for name in SCALE_BY_BIN])
+        self.rhythm_rules = config.get('rhythm_rules', {})
+        self.durations = self.duration_table(self.rhythm_rules) if 'gc_content' in self.rhythm_rules else None
+
+    @staticmethod
+    def duration_table(rules):
+        return np.array([rules['gc_content'][k] for k in RHYTHM_BY_BIN], dtype=np.float64)
+
+    def durations_for(self, rules):
+        """Note length per GC bin under ``rules``; the compiled table when they are the config's own."""
+        if self.durations is not None and (rules is self.rhythm_rules or rules == self.rhythm_rules):
+            return self.durations
+        return self.duration_table(rules)
+
+    def table_for(self, mode='beautiful', scale_mask=None):
+        if scale_mask is not None:
+            return _mask_table(tuple(scale_mask))
+        return self.pitch_tables[self.mode_rows.get(mode, self.mode_rows['beautiful'])]
+
+    def scale_rows(self, gc):
+        return self.scale_for_bin[gc_bins(gc, SCALE_BINS)]
+
+@functools.lru_cache(maxsize=64)
+def _mask_table(mask):
+    return quantize_table(list(mask))
+
+@functools.lru_cache(maxsize=32)
+def _compile(digest, canonical):
+    return CompiledMapping(json.loads(canonical), digest)
+
+def compile_mapping(config=None):
+    """Compile (and cache by content hash) the lookup tables for a config."""
+    canonical = json.dumps(CONFIG if config is None else config, sort_keys=True)
+    return _compile(hashlib.sha256(canonical.encode()).hexdigest(), canonical)
+
 def to_note_events(
     chords,
     gc_seq=None,
@@ -80,35 +237,44 @@ def to_note_events(
     velocities=None,
     mode='beautiful',
     scale_mask=None,
-    rhythm_rules=None
+    rhythm_rules=None,
+    mapping=None
 ):
-    events = []
-    last_pitch = None
-    # Choose mask based on mode
-    mode_map = {
-        'beautiful': PENTATONIC_MASK,
-        'major': MAJOR_MASK,
-        'blues': BLUES_MASK,
-        'cinematic': CINEMATIC_MASK,
-        'minor': MINOR_MASK
-    }
-    mask = scale_mask if scale_mask is not None else mode_map.get(mode, PENTATONIC_MASK)
-    for i, chord in enumerate(chords):
-        # Dynamic scale selection
-        if gc_seq is not None:
-            mask = select_scale(gc_seq[i])
-        for note in chord:
-            pitch = note
-            if mask:
-                pitch = scale_mask_pitch(pitch, mask)
-            # Dynamic rhythm
-            duration = 1.0
-            if gc_seq is not None and entropy_seq is not None and rhythm_rules is not None:
-                duration = get_note_duration(gc_seq[i], entropy_seq[i], rhythm_rules)
-            velocity = velocities[i] if velocities else 100
-            events.append({'pitch': pitch, 'start': i, 'duration': duration, 'velocity': velocity})
-            last_pitch = pitch
-    return events
+    """Map chords to note events with a single gather per column.
+
+    In ``'beautiful'`` mode with ``gc_seq`` given, the scale is chosen per
+    chord from its GC content; any other mode, or a ``scale_mask``, fixes
+    the scale. Durations follow ``rhythm_rules`` when both feature sequences
+    are given.
+    """
+    mapping = mapping or compile_mapping()
+    chords = np.asarray(chords, dtype=np.int64)
+    if chords.size == 0:
+        return NoteEvents.empty()
+    n, width = chords.shape
+    # Pitches outside the tables are clamped to their edge
+    chords = np.clip(chords, 0, PITCH_TABLE_SIZE - 1)
+    gc = None
+    if gc_seq is not None:
+        gc = np.asarray(gc_seq, dtype=np.float64)[:n]
+        if len(gc) < n:
+            raise ValueError(f"gc_seq has {len(gc)} values for {n} chords")
+    if gc is not None and mode == 'beautiful' and scale_mask is None:
+        # Dynamic scale selection: one table row per chord
+        pitch = mapping.pitch_tables[mapping.scale_rows(gc)[:, None], chords]
+    else:
+        pitch = mapping.table_for(mode, scale_mask)[chords]
+    # Dynamic rhythm
+    duration = np.ones(n)
+    if gc is not None and entropy_seq is not None and rhythm_rules is not None:
+        duration = mapping.durations_for(rhythm_rules)[gc_bins(gc, RHYTHM_BINS)]
+    velocity = np.asarray(velocities[:n]) if velocities else np.full(n, 100)
+    return NoteEvents(
+        pitch.ravel(),
+        np.repeat(np.arange(n), width),
+        np.repeat(duration, width),
+        np.repeat(velocity, width)
+    )
 
 # LSTM smoothing (optional, free, if model available)
 def smooth_melody_with_lstm(notes, lstm_model=None):
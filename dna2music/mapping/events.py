@@ -0,0 +1,79 @@
+import numpy as np
+
+class NoteEvents:
+    """Note events stored as parallel NumPy columns (struct of arrays).
+
+    Slicing returns a NoteEvents view over the same columns; indexing with an
+    int or iterating gives the ``{'pitch', 'start', 'duration', 'velocity'}``
+    dicts the rest of the code and the JSON API have always used.
+    """
+
+    FIELDS = ('pitch', 'start', 'duration', 'velocity')
+    __slots__ = FIELDS
+
+    def __init__(self, pitch, start, duration, velocity):
+        self.pitch = np.asarray(pitch, dtype=np.int16)
+        self.start = np.asarray(start, dtype=np.float64)
+        self.duration = np.asarray(duration, dtype=np.float32)
+        self.velocity = np.asarray(velocity, dtype=np.uint8)
+
+    @classmethod
+    def empty(cls):
+        return cls([], [], [], [])
+
+    @classmethod
+    def from_dicts(cls, notes):
+        notes = list(notes)
+        return cls(
+            [n.get('pitch', 60) for n in notes],
+            [n.get('start', i) for i, n in enumerate(notes)],
+            [n.get('duration', 1.0) for n in notes],
+            [n.get('velocity', 100) for n in notes],
+        )
+
+    @classmethod
+    def concatenate(cls, parts):
+        parts = [as_note_events(p) for p in parts]
+        if not parts:
+            return cls.empty()
+        return cls(*(np.concatenate([getattr(p, f) for p in parts]) for f in cls.FIELDS))
+
+    def __len__(self):
+        return len(self.pitch)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return {
+                'pitch': int(self.pitch[key]),
+                'start': float(self.start[key]),
+                'duration': float(self.duration[key]),
+                'velocity': int(self.velocity[key]),
+            }
+        return NoteEvents(self.pitch[key], self.start[key], self.duration[key], self.velocity[key])
+
+    def __iter__(self):
+        return iter(self.to_dicts())
+
+    def __repr__(self):
+        return f"NoteEvents(n={len(self)})"
+
+    def to_dicts(self):
+        return [
+            {'pitch': p, 'start': s, 'duration': d, 'velocity': v}
+            for p, s, d, v in zip(self.pitch.tolist(), self.start.tolist(),
+                                  self.duration.tolist(), self.velocity.tolist())
+        ]
+
+    def end(self):
+        """Time at which the last note stops sounding."""
+        return float((self.start + self.duration).max()) if len(self) else 0.0
+
+    def shifted(self, offset):
+        return NoteEvents(self.pitch, self.start + offset, self.duration, self.velocity)
+
+    def with_pitch(self, pitch):
+        return NoteEvents(pitch, self.start, self.duration, self.velocity)
+
+def as_note_events(notes):
+    """Accept NoteEvents or a list of note dicts."""
+    return notes if isinstance(notes, NoteEvents) else NoteEvents.from_dicts(notes)
@@ -0,0 +1,104 @@
+import collections
+import itertools
+import numpy as np
+from dna2music.mapping.sequence import N, as_packed
+
+IUPAC = {
+    'A': 'A', 'C': 'C', 'G': 'G', 'T': 'T',
+    'R': 'AG', 'Y': 'CT', 'S': 'CG', 'W': 'AT', 'K': 'GT', 'M': 'AC',
+    'B': 'CGT', 'D': 'AGT', 'H': 'ACT', 'V': 'ACG', 'N': 'ACGT',
+}
+_COMPLEMENT = str.maketrans('ACGTRYSWKMBDHVN', 'TGCAYRSWMKVHDBN')
+_BASE_CODE = {b: i for i, b in enumerate('ACGT')}
+
+MAX_MOTIF_LENGTH = 31  # 2 bits per base must fit in an int64
+MAX_EXPANSIONS = 4096  # exact k-mers a single ambiguous motif may expand to
+SCAN_BLOCK = 1 << 22  # sequence positions encoded per block
+
+MotifHits = collections.namedtuple('MotifHits', 'position motif strand')
+
+def expand_iupac(motif):
+    """All exact sequences matched by an IUPAC motif."""
+    try:
+        choices = [IUPAC[b] for b in motif.upper()]
+    except KeyError as e:
+        raise ValueError(f"Invalid IUPAC code {e.args[0]!r} in motif {motif!r}")
+    if np.prod([len(c) for c in choices], dtype=np.float64) > MAX_EXPANSIONS:
+        raise ValueError(f"Motif {motif!r} is too degenerate")
+    return [''.join(p) for p in itertools.product(*choices)]
+
+def _kmer_code(kmer):
+    code = 0
+    for b in kmer:
+        code = (code << 2) | _BASE_CODE[b]
+    return code
+
+def load_motif_library(path, phrase):
+    """Read motifs from a FASTA file (one record per motif), all mapped to ``phrase``."""
+    from dna2music.mapping.parser import iter_records
+    return {seq: phrase for _, seq in iter_records(path, 'fasta') if seq}
+
+class MotifIndex:
+    """Finds every occurrence of a motif set on both strands in one pass.
+
+    Motifs (IUPAC codes allowed) are expanded to exact k-mers, encoded at 2
+    bits per base and stored in one sorted table per motif length. Scanning
+    encodes each k-mer of the sequence once per distinct length and looks
+    all of them up with a single searchsorted, so the cost is linear in the
+    sequence length whether 5 or 5,000 motifs are loaded.
+    """
+
+    def __init__(self, motifs):
+        self.motifs = list(motifs)
+        self.phrases = [motifs[m] for m in self.motifs] if isinstance(motifs, dict) else None
+        entries = collections.defaultdict(dict)
+        for motif_id, motif in enumerate(self.motifs):
+            if not 0 < len(motif) <= MAX_MOTIF_LENGTH:
+                raise ValueError(f"Motif length must be 1..{MAX_MOTIF_LENGTH}: {motif!r}")
+            reverse = motif.upper().translate(_COMPLEMENT)[::-1]
+            for strand, pattern in ((1, motif), (-1, reverse)):
+                for kmer in expand_iupac(pattern):
+                    # A palindromic k-mer is reported once, on the + strand
+                    entries[len(motif)].setdefault((_kmer_code(kmer), motif_id), strand)
+        self.tables = {}
+        for length, found in entries.items():
+            keys = np.array(list(found), dtype=np.int64).reshape(-1, 2)
+            strands = np.fromiter(found.values(), dtype=np.int8, count=len(found))
+            order = np.lexsort((keys[:, 1], keys[:, 0]))
+            codes, ids, strands = keys[order, 0], keys[order, 1], strands[order]
+            unique, offsets = np.unique(codes, return_index=True)
+            self.tables[length] = (unique, np.append(offsets, len(codes)), ids, strands)
+
+    def find(self, seq):
+        """Return MotifHits arrays (0-based forward-strand start, motif id, strand) by position."""
+        codes = as_packed(seq).codes
+        parts = []
+        for length, table in self.tables.items():
+            for block_start in range(0, max(len(codes) - length + 1, 0), SCAN_BLOCK):
+                block = codes[block_start:block_start + SCAN_BLOCK + length - 1]
+                parts.append(self._scan(block, length, table, block_start))
+        if not parts:
+            return MotifHits(np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.int8))
+        hits = MotifHits(*(np.concatenate(column) for column in zip(*parts)))
+        order = np.lexsort((hits.motif, hits.position))
+        return MotifHits(*(column[order] for column in hits))
+
+    @staticmethod
+    def _scan(block, length, table, offset):
+        unique, offsets, ids, strands = table
+        count = len(block) - length + 1
+        values = np.zeros(count, dtype=np.int64)
+        for j in range(length):
+            values <<= 2
+            values |= block[j:j + count] & 3
+        has_n = np.concatenate(([0], np.cumsum(block == N)))
+        valid = has_n[length:] == has_n[:count]
+        slot = np.minimum(np.searchsorted(unique, values), len(unique) - 1)
+        matched = np.flatnonzero(valid & (unique[slot] == values))
+        slot = slot[matched]
+        # Expand each matched k-mer to all (motif, strand) entries sharing it
+        first, n_entries = offsets[slot], offsets[slot + 1] - offsets[slot]
+        position = np.repeat(matched + offset, n_entries)
+        within = np.arange(n_entries.sum()) - np.repeat(np.cumsum(n_entries) - n_entries, n_entries)
+        entry = np.repeat(first, n_entries) + within
+        return position, ids[entry], strands[entry]
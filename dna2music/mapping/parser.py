@@ -1,7 +1,25 @@
 import pandas as pd
 import numpy as np
 from numba import njit
+import collections
+import io
+import itertools
+import mmap
+import os
 import re
+import string
+import zlib
+from dna2music.mapping.sequence import N, PackedSequence, encode, encode_inplace
+
+CHUNK_SIZE = 1 << 20  # bytes read from a source at a time
+SNIFF_SIZE = 1 << 14  # leading bytes inspected by sniff_format
+GENOTYPE_BATCH = 1 << 18  # rows per read_csv batch for genotype files
+GENOTYPE_FORMATS = ('23andme', 'vcf')
+
+# bytes.translate tables: deletion runs before the upper-casing map
+_UPPER = bytes.maketrans(string.ascii_lowercase.encode(), string.ascii_uppercase.encode())
+_NON_LETTERS = bytes(sorted(set(range(256)) - set(string.ascii_letters.encode())))
+_NON_ACGT = bytes(sorted(set(range(256)) - set(b'ACGTacgt')))
 
 @njit
 def gc_content(seq):
@@ -22,67 +40,648 @@ def shannon_entropy(seq):
             entropy -= p * np.log2(p)
     return entropy
 
-def parse_fasta(f):
-    seq = ''
-    for line in f:
-        if line.startswith('>'):
-            continue
-        seq += line.strip().upper()
-    return seq
+class SequenceBuffer:
+    """Growable uint8 buffer holding one byte per base."""
 
-def parse_fastq(f):
-    seq = ''
-    for i, line in enumerate(f):
-        if i % 4 == 1:
-            seq += line.strip().upper()
-    return seq
+    def __init__(self, capacity=0):
+        self._data = np.empty(max(capacity, 1024), dtype=np.uint8)
+        self._size = 0
 
-def parse_23andme(f):
-    seq = ''
-    for line in f:
-        if line.startswith('#') or line.strip() == '':
+    def __len__(self):
+        return self._size
+
+    def append(self, chunk):
+        n = len(chunk)
+        if n == 0:
+            return
+        end = self._size + n
+        if end > len(self._data):
+            grown = np.empty(max(end, 2 * len(self._data)), dtype=np.uint8)
+            grown[:self._size] = self._data[:self._size]
+            self._data = grown
+        self._data[self._size:end] = np.frombuffer(chunk, dtype=np.uint8)
+        self._size = end
+
+    def view(self):
+        return self._data[:self._size]
+
+    def decode(self):
+        return str(memoryview(self.view()), 'ascii')
+
+    def to_packed(self):
+        # Encodes in place; the buffer must not be appended to afterwards
+        return PackedSequence(encode_inplace(self.view()))
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+def iter_chunks(source, chunk_size=CHUNK_SIZE):
+    """Yield the content of ``source`` as byte chunks.
+
+    ``source`` may be a path, a binary or text file object, a bytes-like
+    object or an iterable of lines. gzip and BGZF input is detected from its
+    magic bytes and inflated chunk by chunk.
+    """
+    head, chunks = _peek(_raw_chunks(source, chunk_size), len(GZIP_MAGIC))
+    if head == GZIP_MAGIC:
+        chunks = _inflate(chunks, chunk_size)
+    yield from chunks
+
+def _inflate(chunks, chunk_size):
+    """Stream-decompress gzip members; BGZF is a series of such members."""
+    d = zlib.decompressobj(wbits=31)
+    for data in chunks:
+        while data:
+            out = d.decompress(data, chunk_size)
+            if out:
+                yield out
+            if d.eof:
+                data = d.unused_data
+                d = zlib.decompressobj(wbits=31)
+            else:
+                data = d.unconsumed_tail
+    tail = d.flush()
+    if tail:
+        yield tail
+
+def is_compressed(source):
+    """True if a path or bytes-like ``source`` starts with the gzip magic."""
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            return f.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source[:len(GZIP_MAGIC)]) == GZIP_MAGIC
+    return False
+
+def _raw_chunks(source, chunk_size):
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            yield from _raw_chunks(f, chunk_size)
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source)
+        for i in range(0, len(view), chunk_size):
+            yield bytes(view[i:i + chunk_size])
+    elif hasattr(source, 'read'):
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk.encode() if isinstance(chunk, str) else chunk
+    else:
+        batch, size = [], 0
+        for line in source:
+            if isinstance(line, str):
+                line = line.encode()
+            batch.append(line)
+            if not line.endswith(b'\n'):
+                batch.append(b'\n')
+            size += len(line) + 1
+            if size >= chunk_size:
+                yield b''.join(batch)
+                batch, size = [], 0
+        if batch:
+            yield b''.join(batch)
+
+def _peek(chunks, size=SNIFF_SIZE):
+    """Read at least ``size`` bytes ahead; return them and the replayable stream."""
+    chunks = iter(chunks)
+    head, total = [], 0
+    for chunk in chunks:
+        head.append(chunk)
+        total += len(chunk)
+        if total >= size:
+            break
+    return b''.join(head)[:size], itertools.chain(head, chunks)
+
+def _line_blocks(chunks):
+    """Regroup chunks so that every block ends on a line boundary."""
+    pending = []
+    for chunk in chunks:
+        cut = chunk.rfind(b'\n')
+        if cut == -1:
+            pending.append(chunk)
             continue
-        parts = line.strip().split('\t')
-        if len(parts) >= 4:
-            base = parts[3].upper()
-            if base in 'ACGT':
-                seq += base
-    return seq
+        pending.append(chunk[:cut + 1])
+        yield b''.join(pending)
+        pending = [chunk[cut + 1:]]
+    if any(pending):
+        yield b''.join(pending)
 
-def parse_raw(f):
-    return ''.join([re.sub(r'[^ACGT]', '', line.upper()) for line in f])
+def _fasta_tokens(chunks):
+    """Yield ``(header, bases)`` pairs from FASTA chunks.
+
+    A record start is reported as ``(name, b'')``; sequence data follows as
+    ``(None, bases)`` pieces that are already upper-cased and stripped.
+    """
+    header = None
+    line_start = True
+    for chunk in chunks:
+        pos, n = 0, len(chunk)
+        while pos < n:
+            if header is not None:
+                nl = chunk.find(b'\n', pos)
+                header.append(chunk[pos:n if nl == -1 else nl])
+                if nl == -1:
+                    break
+                yield b''.join(header).strip(), b''
+                header = None
+                pos = nl + 1
+                line_start = True
+            elif line_start and chunk[pos] == 0x3E:  # '>'
+                header = []
+                pos += 1
+            else:
+                nxt = chunk.find(b'\n>', pos)
+                stop = n if nxt == -1 else nxt + 1
+                bases = chunk[pos:stop].translate(_UPPER, _NON_LETTERS)
+                if bases:
+                    yield None, bases
+                pos = stop
+                line_start = nxt != -1 or chunk.endswith(b'\n')
+    if header is not None:
+        yield b''.join(header).strip(), b''
+
+def _fasta_bases(chunks):
+    for _, bases in _fasta_tokens(chunks):
+        if bases:
+            yield bases
+
+def _fastq_bases(chunks):
+    line_no = 0
+    for block in _line_blocks(chunks):
+        lines = block.split(b'\n')
+        if block.endswith(b'\n'):
+            lines.pop()
+        seq_lines = lines[(1 - line_no) % 4::4]
+        line_no += len(lines)
+        if seq_lines:
+            yield b''.join(seq_lines).translate(_UPPER, _NON_LETTERS)
+
+def _fastq_tokens(chunks):
+    """Yield ``(header, bases)`` pairs from FASTQ chunks, like ``_fasta_tokens``."""
+    line_no = 0
+    for block in _line_blocks(chunks):
+        lines = block.split(b'\n')
+        if block.endswith(b'\n'):
+            lines.pop()
+        for line in lines:
+            phase = line_no % 4
+            if phase == 0:
+                yield line[1:].strip(), b''
+            elif phase == 1:
+                yield None, line.translate(_UPPER, _NON_LETTERS)
+            line_no += 1
 
-def parse_dna(file, fmt='auto'):
-    if hasattr(file, 'read'):
-        lines = file.read().decode().splitlines()
-    elif isinstance(file, str):
-        lines = file.splitlines()
+class _ChunkStream(io.RawIOBase):
+    """Read-only file object over an iterator of byte chunks."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._chunk:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._chunk = memoryview(chunk)
+        n = min(len(b), len(self._chunk))
+        b[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        return n
+
+class GenotypeCalls:
+    """Columnar genotype calls: chromosome, 1-based position and two alleles.
+
+    Alleles hold PackedSequence codes; N marks no-calls, indels and the
+    missing second allele of haploid calls.
+    """
+
+    __slots__ = ('chrom', 'pos', 'allele1', 'allele2')
+
+    def __init__(self, chrom, pos, allele1, allele2):
+        self.chrom = pd.Categorical(chrom)
+        self.pos = np.asarray(pos, dtype=np.int64)
+        self.allele1 = np.asarray(allele1, dtype=np.uint8)
+        self.allele2 = np.asarray(allele2, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.pos)
+
+    def __getitem__(self, key):
+        return GenotypeCalls(self.chrom[key], self.pos[key], self.allele1[key], self.allele2[key])
+
+    def bases(self):
+        """Called alleles flattened in order, both alleles of each call."""
+        alleles = np.stack([self.allele1, self.allele2], axis=1).ravel()
+        return PackedSequence(alleles[alleles != N])
+
+def _allele_codes(values):
+    """Codes for single-base allele strings; anything longer becomes N."""
+    raw = np.asarray(values, dtype='S2').view(np.uint8).reshape(-1, 2)
+    single = (raw[:, 0] != 0) & (raw[:, 1] == 0)
+    return np.where(single, encode(np.ascontiguousarray(raw[:, 0])), N).astype(np.uint8)
+
+def _23andme_calls(df):
+    raw = df['genotype'].fillna('--').to_numpy(dtype='S2').view(np.uint8).reshape(-1, 2)
+    allele1 = encode(np.ascontiguousarray(raw[:, 0]))
+    allele2 = np.where(raw[:, 1] == 0, N, encode(np.ascontiguousarray(raw[:, 1])))
+    return allele1, allele2
+
+def _vcf_calls(df):
+    alleles = pd.concat([df['ref'], df['alt'].str.split(',', expand=True)], axis=1).fillna('')
+    codes = np.stack([_allele_codes(alleles.iloc[:, i]) for i in range(alleles.shape[1])], axis=1)
+    codes = np.concatenate([codes, np.full((len(df), 1), N, dtype=np.uint8)], axis=1)
+    if 'sample' in df:
+        gt = df['sample'].str.extract(r'^([0-9]+|\.)(?:[/|]([0-9]+|\.))?')
+        idx = [pd.to_numeric(gt[i], errors='coerce').to_numpy() for i in (0, 1)]
+    else:
+        idx = [np.zeros(len(df)), np.ones(len(df))]
+    missing = codes.shape[1] - 1
+    rows = np.arange(len(df))
+    picked = []
+    for i in idx:
+        i = np.where(np.isnan(i), missing, np.minimum(i, missing)).astype(np.int64)
+        picked.append(codes[rows, i])
+    return picked[0], picked[1]
+
+def _region_mask(df, region):
+    name, start, end = region
+    bare = name[3:] if name.lower().startswith('chr') else name
+    position = df['position'].to_numpy()
+    mask = df['chromosome'].isin([bare, 'chr' + bare]).to_numpy() & (position > start)
+    if end is not None:
+        mask = mask & (position <= end)
+    return mask
+
+def _read_genotype_chunks(chunks, fmt, region=None, max_rows=None):
+    head, chunks = _peek(chunks)
+    if fmt == 'vcf':
+        header = re.search(rb'(?m)^#CHROM[^\n]*', head)
+        has_sample = header is not None and len(header.group().split(b'\t')) > 9
+        usecols = [0, 1, 3, 4] + ([9] if has_sample else [])
+        names = ['chromosome', 'position', 'ref', 'alt'] + (['sample'] if has_sample else [])
     else:
-        lines = list(file)
+        usecols = [1, 2, 3]
+        names = ['chromosome', 'position', 'genotype']
+    reader = pd.read_csv(
+        io.BufferedReader(_ChunkStream(chunks), CHUNK_SIZE),
+        sep='\t', comment='#', header=None, usecols=usecols, names=names,
+        dtype={n: str for n in names if n != 'position'}, engine='c',
+        chunksize=GENOTYPE_BATCH, nrows=max_rows
+    )
+    parts = []
+    for df in reader:
+        if region is not None:
+            df = df[_region_mask(df, region)]
+        allele1, allele2 = _vcf_calls(df) if fmt == 'vcf' else _23andme_calls(df)
+        parts.append((df['chromosome'].to_numpy(), df['position'].to_numpy(), allele1, allele2))
+    if not parts:
+        return GenotypeCalls([], [], [], [])
+    return GenotypeCalls(*(np.concatenate(column) for column in zip(*parts)))
+
+def read_genotypes(source, fmt='auto', region=None, max_rows=None):
+    """Read 23andMe or VCF genotype calls into columnar arrays.
+
+    Rows are parsed by pandas' C reader in batches; ``region`` (e.g. ``'1'``
+    or ``'chr17:43044295-43125483'``) keeps only calls inside it. For VCF
+    only the first sample's GT is used and non-SNV alleles become N.
+    ``max_rows`` stops reading after that many rows, before any region filter.
+    """
+    chunks = iter_chunks(source)
     if fmt == 'auto':
-        if any(l.startswith('>') for l in lines):
-            fmt = 'fasta'
-        elif any(l.startswith('@') for l in lines):
-            fmt = 'fastq'
-        elif any('23andMe' in l for l in lines):
-            fmt = '23andme'
-        else:
-            fmt = 'raw'
+        head, chunks = _peek(chunks)
+        fmt = sniff_format(head)
+    if fmt not in GENOTYPE_FORMATS:
+        raise ValueError(f"Not a genotype format: {fmt}")
+    if region is not None:
+        region = parse_region(region)
+    return _read_genotype_chunks(chunks, fmt, region, max_rows)
+
+def _genotype_bases(chunks, fmt):
+    yield str(_read_genotype_chunks(chunks, fmt).bases()).encode('ascii')
+
+def _23andme_bases(chunks):
+    return _genotype_bases(chunks, '23andme')
+
+def _vcf_bases(chunks):
+    return _genotype_bases(chunks, 'vcf')
+
+def _raw_bases(chunks):
+    for chunk in chunks:
+        yield chunk.translate(_UPPER, _NON_ACGT)
+
+_BASE_READERS = {
+    'fasta': _fasta_bases,
+    'fastq': _fastq_bases,
+    '23andme': _23andme_bases,
+    'vcf': _vcf_bases,
+    'raw': _raw_bases,
+}
+
+def sniff_format(head):
+    """Guess the format of a DNA file from its leading bytes."""
+    if head.startswith(b'##fileformat=VCF'):
+        return 'vcf'
+    if re.search(rb'^>', head, re.M):
+        return 'fasta'
+    if re.search(rb'^@', head, re.M):
+        return 'fastq'
+    if b'23andMe' in head:
+        return '23andme'
+    return 'raw'
+
+def iter_bases(source, fmt='auto', chunk_size=CHUNK_SIZE):
+    """Stream the bases of ``source`` as upper-case byte chunks."""
+    chunks = iter_chunks(source, chunk_size)
+    if fmt == 'auto':
+        head, chunks = _peek(chunks)
+        fmt = sniff_format(head)
+    return _BASE_READERS.get(fmt, _raw_bases)(chunks)
+
+def detect_format(source):
+    """Sniff the format of a path or bytes-like source."""
+    head, _ = _peek(iter_chunks(source))
+    return sniff_format(head)
+
+def _record_name(header):
+    words = header.split(None, 1)
+    return words[0].decode(errors='replace') if words else ''
+
+def iter_records(source, fmt='auto', chunk_size=CHUNK_SIZE, packed=False):
+    """Yield ``(name, sequence)`` for every record of a FASTA or FASTQ source.
+
+    The name is the first word of the header line. Formats without records
+    (raw, 23andMe) yield a single record named ``''``.
+    """
+    chunks = iter_chunks(source, chunk_size)
+    if fmt == 'auto':
+        head, chunks = _peek(chunks)
+        fmt = sniff_format(head)
     if fmt == 'fasta':
-        seq = parse_fasta(lines)
+        tokens = _fasta_tokens(chunks)
     elif fmt == 'fastq':
-        seq = parse_fastq(lines)
-    elif fmt == '23andme':
-        seq = parse_23andme(lines)
+        tokens = _fastq_tokens(chunks)
     else:
-        seq = parse_raw(lines)
-    return seq
-
-def sliding_features(seq, window=100, step=10):
-    data = []
-    for i in range(0, len(seq) - window + 1, step):
-        w = seq[i:i+window]
-        gc = gc_content(w)
-        ent = shannon_entropy(w)
-        data.append({'start': i, 'end': i+window, 'gc': gc, 'entropy': ent, 'seq': w})
-    return pd.DataFrame(data) 
\ No newline at end of file
+        reader = _BASE_READERS.get(fmt, _raw_bases)
+        tokens = itertools.chain([(b'', b'')], ((None, bases) for bases in reader(chunks)))
+    finish = SequenceBuffer.to_packed if packed else SequenceBuffer.decode
+    name, buffer = None, None
+    for header, bases in tokens:
+        if header is not None:
+            if buffer is not None:
+                yield name, finish(buffer)
+            name, buffer = _record_name(header), SequenceBuffer()
+        elif bases:
+            if buffer is None:
+                name, buffer = '', SequenceBuffer()
+            buffer.append(bases)
+    if buffer is not None:
+        yield name, finish(buffer)
+
+def _size_hint(source):
+    if isinstance(source, (str, os.PathLike)):
+        return os.path.getsize(source)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return len(source)
+    return 0
+
+def read_dna(source, fmt='auto', chunk_size=CHUNK_SIZE, packed=False):
+    """Read a whole sequence from a path or file object in bounded chunks.
+
+    Returns a ``str``, or a ``PackedSequence`` when ``packed`` is set.
+    """
+    buffer = SequenceBuffer(_size_hint(source))
+    for bases in iter_bases(source, fmt, chunk_size):
+        buffer.append(bases)
+    return buffer.to_packed() if packed else buffer.decode()
+
+def _collect(bases):
+    buffer = SequenceBuffer()
+    for chunk in bases:
+        buffer.append(chunk)
+    return buffer.decode()
+
+def parse_fasta(f):
+    return _collect(_fasta_bases(iter_chunks(f)))
+
+def parse_fastq(f):
+    return _collect(_fastq_bases(iter_chunks(f)))
+
+def parse_23andme(f):
+    return _collect(_23andme_bases(iter_chunks(f)))
+
+def parse_raw(f):
+    return _collect(_raw_bases(iter_chunks(f)))
+
+def parse_dna(file, fmt='auto', packed=False):
+    # A plain string is the file content itself, not a path
+    if isinstance(file, str):
+        file = file.encode()
+    return read_dna(file, fmt, packed=packed)
+
+FaiEntry = collections.namedtuple('FaiEntry', 'name length offset line_bases line_width')
+
+_REGION = re.compile(r'^(?P<name>[^:\s]+)(?::(?P<start>[\d,]+)(?:-(?P<end>[\d,]+))?)?$')
+
+def parse_region(region):
+    """Parse ``name[:start[-end]]`` (1-based, inclusive) into 0-based half-open coordinates."""
+    match = _REGION.match(region.strip())
+    if not match:
+        raise ValueError(f"Invalid region: {region!r}")
+    start = int(match['start'].replace(',', '')) - 1 if match['start'] else 0
+    end = int(match['end'].replace(',', '')) if match['end'] else None
+    if start < 0 or (end is not None and end <= start):
+        raise ValueError(f"Invalid region: {region!r}")
+    return match['name'], start, end
+
+def build_fasta_index(data):
+    """Build .fai entries for a FASTA held in a bytes-like object or mmap.
+
+    Like samtools faidx, every record is assumed to use one line width except
+    for its last line.
+    """
+    entries = []
+    headers = [m.start() for m in re.finditer(rb'(?m)^>', data)] + [len(data)]
+    for start, next_start in zip(headers, headers[1:]):
+        header_end = data.find(b'\n', start, next_start)
+        if header_end == -1:
+            header_end = next_start
+        name = bytes(data[start + 1:header_end]).split(None, 1)[0].decode()
+        offset = min(header_end + 1, next_start)
+        end = next_start
+        while end > offset and data[end - 1] in b'\r\n':
+            end -= 1
+        first_nl = data.find(b'\n', offset, next_start)
+        if first_nl == -1:
+            line_width = end - offset + 1
+            line_bases = end - offset
+        else:
+            line_width = first_nl - offset + 1
+            line_bases = line_width - (2 if data[first_nl - 1] == 0x0D else 1)
+        full_lines, last_line = divmod(end - offset, line_width)
+        entries.append(FaiEntry(name, full_lines * line_bases + last_line, offset, line_bases, line_width))
+    return entries
+
+def write_fai(entries, path):
+    with open(path, 'w') as f:
+        for e in entries:
+            f.write(f"{e.name}\t{e.length}\t{e.offset}\t{e.line_bases}\t{e.line_width}\n")
+
+def read_fai(path):
+    with open(path) as f:
+        return [FaiEntry(p[0], *map(int, p[1:5])) for p in (line.split('\t') for line in f if line.strip())]
+
+class IndexedFasta:
+    """Random access to FASTA records through a .fai index.
+
+    ``data`` is any bytes-like object; ``IndexedFasta.open`` memory-maps a
+    file and reuses (or writes) the ``.fai`` next to it, so only the bytes of
+    a requested region are ever read.
+    """
+
+    def __init__(self, data, entries=None):
+        self.data = data
+        if entries is None:
+            entries = build_fasta_index(data)
+        self.index = {e.name: e for e in entries}
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        fai_path = f"{path}.fai"
+        if os.path.exists(fai_path) and os.path.getmtime(fai_path) >= os.path.getmtime(path):
+            return cls(data, read_fai(fai_path))
+        entries = build_fasta_index(data)
+        try:
+            write_fai(entries, fai_path)
+        except OSError:
+            pass  # read-only location: keep the index in memory only
+        return cls(data, entries)
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def fetch(self, name, start=0, end=None, packed=False):
+        if name not in self.index:
+            raise ValueError(f"Sequence {name!r} not found in FASTA index")
+        e = self.index[name]
+        end = e.length if end is None else min(end, e.length)
+        start = max(start, 0)
+        if start >= end:
+            raw = b''
+        else:
+            first = e.offset + start // e.line_bases * e.line_width + start % e.line_bases
+            last = e.offset + (end - 1) // e.line_bases * e.line_width + (end - 1) % e.line_bases + 1
+            raw = bytes(self.data[first:last])
+        bases = raw.translate(_UPPER, _NON_LETTERS)
+        return PackedSequence.from_bytes(bases) if packed else bases.decode('ascii')
+
+def read_region(source, region, packed=False):
+    """Fetch ``region`` (e.g. ``chr17:43,044,295-43,125,483``) from a FASTA path or bytes."""
+    name, start, end = parse_region(region)
+    if is_compressed(source):
+        # No random access into gzip: stream records until the named one
+        for record_name, seq in iter_records(source, 'fasta', packed=packed):
+            if record_name == name:
+                return seq[start:end]
+        raise ValueError(f"Sequence {name!r} not found in FASTA")
+    if isinstance(source, (str, os.PathLike)):
+        with IndexedFasta.open(source) as fasta:
+            return fasta.fetch(name, start, end, packed)
+    return IndexedFasta(source).fetch(name, start, end, packed)
+
+def _prefix_counts(codes, unit):
+    """Cumulative A/C/G/T counts sampled every ``unit`` bases, shape (4, n // unit + 1)."""
+    blocks = codes[:len(codes) // unit * unit].reshape(-1, unit)
+    counts = np.zeros((4, len(blocks) + 1), dtype=np.int64)
+    for base in range(4):
+        np.cumsum((blocks == base).sum(axis=1), out=counts[base, 1:])
+    return counts
+
+def _window_features(counts, unit, n, window, step):
+    starts = np.arange(0, n - window + 1, step)
+    ends = starts + window
+    window_counts = counts[:, ends // unit] - counts[:, starts // unit]
+    gc = (window_counts[1] + window_counts[2]) / window
+    total = window_counts.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        probs = window_counts / total
+        terms = np.where(probs > 0, probs * np.log2(probs), 0.0)
+    entropy = -terms.sum(axis=0)
+    return {'start': starts, 'end': ends, 'gc': gc, 'entropy': entropy}
+
+def sliding_features_multi(seq, windows, include_seq=False):
+    """Compute GC content and Shannon entropy for several (window, step) pairs.
+
+    Cumulative base counts are built once, so every window costs O(1) and the
+    whole pass is O(n) whatever the window size. Returns a dict mapping each
+    (window, step) pair to a DataFrame with start/end/gc/entropy columns; the
+    per-window ``seq`` text is only added when ``include_seq`` is set.
+    """
+    if not isinstance(seq, PackedSequence):
+        seq = PackedSequence.from_string(seq)
+    unit = np.gcd.reduce([v for pair in windows for v in pair])
+    counts = _prefix_counts(seq.codes, unit)
+    results = {}
+    for window, step in windows:
+        columns = _window_features(counts, unit, len(seq), window, step)
+        if include_seq:
+            columns['seq'] = [str(seq[i:i + window]) for i in columns['start']]
+        results[(window, step)] = pd.DataFrame(columns)
+    return results
+
+def sliding_features(seq, window=100, step=10, include_seq=False):
+    return sliding_features_multi(seq, [(window, step)], include_seq)[(window, step)]
+
+def align_to_codons(values, n_codons, window, step, first_codon=0, first_window=0):
+    """Average window values over the windows overlapping each codon.
+
+    Window k covers bases [k*step, k*step + window); codon i covers
+    [3i, 3i + 3). Averages come from a prefix sum, so this is O(windows +
+    codons). Codons no window reaches take the nearest window.
+    ``first_codon``/``first_window`` give the global index of the first
+    codon and of ``values[0]`` when resampling a slice of a longer sequence.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if not len(values) or not n_codons:
+        return np.zeros(n_codons)
+    first_base = 3 * np.arange(first_codon, first_codon + n_codons)
+    last = first_window + len(values) - 1
+    hi = np.clip((first_base + 2) // step, first_window, last)
+    lo = np.clip(-((window - 1 - first_base) // step), first_window, last)
+    lo = np.minimum(lo, hi) - first_window
+    hi = hi - first_window
+    cumulative = np.concatenate(([0.0], np.cumsum(values)))
+    means = (cumulative[hi + 1] - cumulative[lo]) / (hi - lo + 1)
+    # Rounding error depends on where the prefix sum starts; drop it so
+    # slices agree with the whole sequence at exact bin edges like 0.4
+    return np.round(means, 12)
+
+def codon_features(seq, window=100, step=10, features=None):
+    """Per-codon GC content and entropy, one row per codon of compose_chords.
+
+    ``features`` may be passed when sliding_features was already computed
+    with the same window and step. Sequences shorter than one window are
+    treated as a single window.
+    """
+    n_codons = len(seq) // 3
+    if len(seq) and len(seq) < window:
+        window = step = len(seq)
+        features = None
+    if features is None:
+        features = sliding_features(seq, window, step)
+    return pd.DataFrame({
+        'gc': align_to_codons(features['gc'], n_codons, window, step),
+        'entropy': align_to_codons(features['entropy'], n_codons, window, step),
+    })
@@ -0,0 +1,97 @@
+import numpy as np
+
+BASES = 'ACGTN'
+A, C, G, T, N = range(5)
+
+# ASCII -> base code; anything that is not A/C/G/T becomes N
+_ENCODE = np.full(256, N, dtype=np.uint8)
+for _code, _base in enumerate('ACGT'):
+    _ENCODE[ord(_base)] = _code
+    _ENCODE[ord(_base.lower())] = _code
+_DECODE = np.frombuffer(BASES.encode(), dtype=np.uint8)
+_COMPLEMENT = np.array([T, G, C, A, N], dtype=np.uint8)
+
+def encode(data):
+    """Map ASCII bases (bytes or a uint8 array) to base codes."""
+    return _ENCODE[np.frombuffer(data, dtype=np.uint8)]
+
+def encode_inplace(buf, block=1 << 20):
+    """Encode a uint8 ASCII buffer into base codes without a second full copy."""
+    for i in range(0, len(buf), block):
+        buf[i:i + block] = _ENCODE[buf[i:i + block]]
+    return buf
+
+class PackedSequence:
+    """DNA sequence stored as one uint8 code per base (A=0, C=1, G=2, T=3, N=4).
+
+    Slicing returns views over the same buffer, so windows and codons can be
+    taken without copying.
+    """
+
+    __slots__ = ('codes',)
+
+    def __init__(self, codes):
+        self.codes = np.asarray(codes, dtype=np.uint8)
+
+    @classmethod
+    def from_string(cls, seq):
+        return cls(encode(seq.encode('ascii')))
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(encode(data))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return PackedSequence(self.codes[key])
+        return BASES[self.codes[key]]
+
+    def __str__(self):
+        return _DECODE[self.codes].tobytes().decode('ascii')
+
+    def __repr__(self):
+        preview = str(self[:20]) + ('...' if len(self) > 20 else '')
+        return f"PackedSequence('{preview}', length={len(self)})"
+
+    def __eq__(self, other):
+        if isinstance(other, PackedSequence):
+            return np.array_equal(self.codes, other.codes)
+        if isinstance(other, str):
+            return str(self) == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def reverse_complement(self):
+        return PackedSequence(_COMPLEMENT[self.codes[::-1]])
+
+    def codon_indices(self, frame=0):
+        """Codon numbers 0..63 in CODONS order, -1 where a codon contains N."""
+        n = max((len(self) - frame) // 3, 0)
+        triplets = self.codes[frame:frame + 3 * n].reshape(n, 3)
+        idx = (triplets[:, 0].astype(np.int16) << 4) | (triplets[:, 1] << 2) | triplets[:, 2]
+        idx[(triplets == N).any(axis=1)] = -1
+        return idx
+
+    def to_2bit(self):
+        """Pack to 2 bits per base; returns (packed bytes, N positions)."""
+        padded = np.zeros(-(-len(self) // 4) * 4, dtype=np.uint8)
+        padded[:len(self)] = self.codes & 3
+        packed = (padded[0::4] << 6) | (padded[1::4] << 4) | (padded[2::4] << 2) | padded[3::4]
+        return packed, np.flatnonzero(self.codes == N)
+
+    @classmethod
+    def from_2bit(cls, packed, length, n_positions=()):
+        packed = np.asarray(packed, dtype=np.uint8)
+        codes = np.empty(len(packed) * 4, dtype=np.uint8)
+        for i, shift in enumerate((6, 4, 2, 0)):
+            codes[i::4] = (packed >> shift) & 3
+        codes = codes[:length]
+        codes[np.asarray(n_positions, dtype=np.int64)] = N
+        return cls(codes)
+
+def as_packed(seq):
+    return seq if isinstance(seq, PackedSequence) else PackedSequence.from_string(seq)
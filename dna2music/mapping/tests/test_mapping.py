@@ -1,6 +1,11 @@
+import gzip
+import json
 import pytest
 from hypothesis import given, strategies as st
 from dna2music.mapping import parser, composer
+from dna2music.mapping.sequence import PackedSequence
+from dna2music.mapping.events import NoteEvents
+from dna2music.mapping.motifs import MotifIndex
 
 def test_parse_raw():
     seq = parser.parse_raw(['ACGTacgtNNN'])
@@ -16,9 +21,479 @@ def test_codons():
     cods = composer.codons(seq)
     assert cods == ['ACG', 'TGC', 'AAA']
 
+def test_packed_sequence():
+    seq = PackedSequence.from_string('ACGTNACGTAC')
+    assert str(seq[2:5]) == 'GTN'
+    assert seq[2:5].codes.base is seq.codes
+    assert str(seq.reverse_complement()) == 'GTACGTNACGT'
+    assert seq.codon_indices().tolist() == [composer.CODONS.index('ACG'), -1, composer.CODONS.index('CGT')]
+    packed, n_positions = seq.to_2bit()
+    assert PackedSequence.from_2bit(packed, len(seq), n_positions) == seq
+
+def test_compose_chords_packed():
+    packed = parser.parse_dna('>s\nACGTGCAAATTN\n', packed=True)
+    assert (composer.compose_chords(packed) == composer.compose_chords('ACGTGCAAATTN')).all()
+
 @given(st.text(alphabet='ACGT', min_size=100, max_size=200))
 def test_sliding_features(seq):
     df = parser.sliding_features(seq, window=50, step=10)
     assert not df.empty
     assert all(0 <= gc <= 1 for gc in df.gc)
-    assert all(0 <= ent <= 2 for ent in df.entropy) 
\ No newline at end of file
+    assert all(0 <= ent <= 2 for ent in df.entropy) 
+def test_read_dna_across_chunk_boundaries():
+    fasta = b'>seq1 desc\nACGTn\nacgt\n>seq2\nTTTT\n'
+    for chunk_size in (1, 3, 7, 64):
+        assert parser.read_dna(fasta, chunk_size=chunk_size) == 'ACGTNACGTTTTT'
+
+def test_parse_dna_fastq():
+    fastq = '@r1\nACGT\n+\nIIII\n@r2\nGGCC\n+\nIIII\n'
+    assert parser.parse_dna(fastq) == 'ACGTGGCC'
+
+def test_sliding_features_multi_matches_naive():
+    seq = 'ACGTTGCAAGGCNTTACG' * 7
+    results = parser.sliding_features_multi(seq, [(20, 4), (9, 3)], include_seq=True)
+    for (window, step), df in results.items():
+        assert len(df) == len(range(0, len(seq) - window + 1, step))
+        for row in df.itertuples():
+            w = seq[row.start:row.end]
+            assert row.seq == w
+            assert row.gc == pytest.approx((w.count('G') + w.count('C')) / window)
+    assert 'seq' not in parser.sliding_features(seq, window=20, step=4)
+
+def test_indexed_fasta_region():
+    fasta = b'>chr1 test\nACGTACG\nTTGCA\n>chr2\nGGGG\nCC\n'
+    index = parser.IndexedFasta(fasta)
+    assert index.index['chr1'].length == 12
+    assert index.fetch('chr1', 5, 10) == 'CGTTG'
+    assert parser.read_region(fasta, 'chr2:3-6') == 'GGCC'
+    assert parser.parse_region('chr17:43,044,295-43,125,483') == ('chr17', 43044294, 43125483)
+
+def test_iter_records():
+    fasta = b'>r1 first\nACGT\nAC\n>r2\nTT\n'
+    assert list(parser.iter_records(fasta, chunk_size=3)) == [('r1', 'ACGTAC'), ('r2', 'TT')]
+    fastq = b'@a x\nACGT\n+\nIIII\n@b\nGG\n+\nII\n'
+    assert list(parser.iter_records(fastq)) == [('a', 'ACGT'), ('b', 'GG')]
+    assert list(parser.iter_records(b'acgt')) == [('', 'ACGT')]
+
+def test_read_dna_gzip_members():
+    fasta = b'>r1\nACGT\nTTGG\n>r2\nCCAA\n'
+    bgzf_like = gzip.compress(fasta[:9]) + gzip.compress(fasta[9:]) + gzip.compress(b'')
+    for data in (gzip.compress(fasta), bgzf_like):
+        assert parser.read_dna(data, chunk_size=4) == 'ACGTTTGGCCAA'
+        assert parser.read_region(data, 'r2:2-3') == 'CA'
+
+def test_read_genotypes_23andme_and_vcf():
+    calls = parser.read_genotypes(b'# 23andMe\nrs1\t1\t100\tAG\nrs2\tX\t300\tT\nrs3\t2\t50\t--\n')
+    assert str(calls.bases()) == 'AGT'
+    assert composer.genotype_chords(calls).tolist() == [[60, 67, 72], [69, 69, 81]]
+    vcf = (b'##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\n'
+           b'chr1\t10\t.\tA\tG\t.\t.\t.\tGT\t0/1\nchr1\t20\t.\tC\tT,G\t.\t.\t.\tGT\t2|2\n'
+           b'chr2\t5\t.\tG\tC\t.\t.\t.\tGT\t1/1\n')
+    calls = parser.read_genotypes(vcf, region='chr1:15-30')
+    assert calls.pos.tolist() == [20]
+    assert str(calls.bases()) == 'GG'
+
+def test_note_events_columns():
+    notes = composer.to_note_events(composer.compose_chords('ACGTGCAAA'))
+    assert isinstance(notes, NoteEvents)
+    assert len(notes) == 9
+    preview = notes[:4]
+    assert preview.pitch.base is notes.pitch
+    assert preview.to_dicts()[3] == {'pitch': int(notes.pitch[3]), 'start': 1.0, 'duration': 1.0, 'velocity': 100}
+    assert NoteEvents.from_dicts(notes.to_dicts()).to_dicts() == notes.to_dicts()
+
+def test_compiled_mapping_matches_scalar_rules():
+    mapping = composer.compile_mapping()
+    assert composer.compile_mapping(dict(composer.CONFIG)) is mapping
+    table = mapping.table_for('blues')
+    for pitch in range(40, 110):
+        assert table[pitch] == composer.scale_mask_pitch(pitch, composer.BLUES_MASK)
+    chords = composer.compose_chords('ACGTGCAAATTC')
+    notes = composer.to_note_events(chords, gc_seq=[0.1, 0.5, 0.65, 0.9], entropy_seq=[1] * 4,
+                                    rhythm_rules=composer.RHYTHM_RULES)
+    for i, gc in enumerate([0.1, 0.5, 0.65, 0.9]):
+        mask = composer.select_scale(gc)
+        assert notes.pitch[3 * i:3 * i + 3].tolist() == [composer.scale_mask_pitch(p, mask) for p in chords[i]]
+        assert notes.duration[3 * i] == composer.get_note_duration(gc, 1, composer.RHYTHM_RULES)
+    # The config's own rhythm uses the compiled table; others are built from the request
+    assert mapping.durations_for(composer.RHYTHM_RULES) is mapping.durations
+    custom = {"gc_content": {"low": 0.5, "medium": 1, "high": 4}}
+    assert mapping.durations_for(custom).tolist() == [0.5, 1, 4]
+
+def test_motif_index_all_hits_both_strands():
+    index = MotifIndex({'TATA': 'phrase1', 'GAR': 'phrase2'})
+    hits = index.find('TATATANGAGTTCCTC')
+    found = set(zip(hits.position.tolist(), hits.motif.tolist(), hits.strand.tolist()))
+    # TATA is palindromic and reported once per site; YTC is GAR's reverse complement
+    assert found == {(0, 0, 1), (2, 0, 1), (7, 1, 1), (10, 1, -1), (13, 1, -1)}
+
+def test_compose_chords_inserts_phrases():
+    chords = composer.compose_chords('AATATAACGCGAAA')
+    assert chords[:4].tolist() == composer.PHRASES['phrase1'][:2] + composer.PHRASES['phrase2']
+
+def test_codon_features_align_with_chords():
+    for seq in ('ACGTGCA', 'ACGTTGCAAG' * 31):
+        per_codon = parser.codon_features(seq, window=100, step=10)
+        assert len(per_codon) == len(composer.compose_chords(seq))
+        assert per_codon.gc.between(0, 1).all()
+    assert parser.align_to_codons([0.0, 1.0], 4, window=6, step=6).tolist() == [0.0, 0.0, 1.0, 1.0]
+
+def test_stream_note_events_matches_batch():
+    from dna2music import pipeline
+    seq = ('ACGTTATAGCCGCGTTAN' * 40)[:701]
+    batch = pipeline.compose_sequence(seq)
+    chunks = [seq[i:i + 37].encode() for i in range(0, len(seq), 37)]
+    streamed = NoteEvents.concatenate(list(pipeline.stream_note_events(chunks)))
+    assert streamed.to_dicts() == batch.to_dicts()
+
+def test_cache_key_covers_mapping_parameters():
+    from dna2music.cache import cache_key
+    key = cache_key('abc', region='', layout='stitched')
+    assert key == cache_key('abc', layout='stitched', region='')
+    assert key != cache_key('abd', region='', layout='stitched')
+    assert key != cache_key('abc', mode='dark', region='', layout='stitched')
+    assert key != cache_key('abc', region='', layout='tracks')
+    assert key != cache_key('abc', config_digest='other', region='', layout='stitched')
+    assert key != cache_key('abc', model_version='lstm-2', region='', layout='stitched')
+
+def test_result_cache_coalesces_releases_and_evicts(tmp_path):
+    from dna2music.cache import ResultCache
+    from dna2music.jobs import MemoryRedis
+    cache = ResultCache(MemoryRedis(), str(tmp_path), max_bytes=10)
+    assert cache.join('k', 'j1') == 'leader'
+    assert [cache.join('k', j) for j in ('j2', 'j3')] == ['follower', 'follower']
+    assert cache.reap('k') == []  # the leader still holds the lock
+    assert cache.release('k') == ['j2', 'j3']
+    # A released lock is free for the next identical upload
+    assert cache.join('k', 'j4') == 'leader'
+    assert cache.join('k', 'j5') == 'follower'
+    # An expired lock leaves its waiters to reap
+    cache.redis.delete(cache._lock('k'))
+    assert cache.reap('k') == ['j5'] and cache.waiters('k') == []
+    for key in ('a', 'b'):
+        (tmp_path / f'{key}.wav').write_bytes(b'x' * 8)
+        cache.put(key, {'audio_path': f'/files/{key}.wav'})
+    assert cache.get('a') is None and not (tmp_path / 'a.wav').exists()
+    assert cache.get('b') == {'audio_path': '/files/b.wav'}
+
+def test_result_cache_lock_lasts_the_queue_wait_and_is_held_while_running(monkeypatch):
+    import time
+    from dna2music.cache import LOCK_SECONDS, ResultCache
+    from dna2music.jobs import MemoryRedis
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now)
+    cache = ResultCache(MemoryRedis())
+    # Queued behind two hours of work
+    assert cache.join('k', 'leader', 7200 + LOCK_SECONDS) == 'leader'
+    assert cache.join('k', 'follower') == 'follower'
+    now += 7200
+    assert cache.reap('k') == []
+    # The worker holds the lock from then on
+    cache.hold('k')
+    now += LOCK_SECONDS - 1
+    assert cache.reap('k') == []
+    now += 2
+    assert cache.reap('k') == ['follower']
+
+def test_spool_file_hashes_as_it_copies_and_enforces_the_limit(tmp_path, monkeypatch):
+    import hashlib
+    import io
+    from dna2music import uploads
+    monkeypatch.setattr(uploads, 'UPLOAD_CHUNK', 7)
+    data = b'ACGT' * 100
+    assert uploads.spool_file(io.BytesIO(data), tmp_path / 'a') == (hashlib.sha256(data).hexdigest(), len(data))
+    assert (tmp_path / 'a').read_bytes() == data
+    with pytest.raises(uploads.UploadTooLarge):
+        uploads.spool_file(io.BytesIO(data), tmp_path / 'b', max_bytes=len(data) - 1)
+    assert not (tmp_path / 'b').exists()
+
+def test_spool_archive_streams_sequence_members_and_skips_the_rest(tmp_path):
+    import hashlib
+    import io
+    import tarfile
+    import zipfile
+    from dna2music import uploads
+    zipped = tmp_path / 'batch.zip'
+    with zipfile.ZipFile(zipped, 'w') as archive:
+        archive.writestr('samples/a.fasta', b'>a\nACGT\n')
+        archive.writestr('notes.md', b'not DNA')
+        archive.writestr('b.vcf.gz', gzip.compress(b'##fileformat=VCF\n'))
+    spooled = tmp_path / 'spool'
+    spooled.mkdir()
+    samples, skipped = uploads.spool_archive(zipped, str(spooled))
+    assert [(name, digest) for _, name, _, digest, _ in samples] == [
+        ('a.fasta', hashlib.sha256(b'>a\nACGT\n').hexdigest()),
+        ('b.vcf.gz', hashlib.sha256(gzip.compress(b'##fileformat=VCF\n')).hexdigest()),
+    ]
+    assert skipped == ['notes.md']
+    assert sorted(p.name for p in spooled.iterdir()) == sorted(job_id for job_id, *_ in samples)
+    # Past max_files nothing stays spooled
+    tarred = tmp_path / 'batch.tar'
+    with tarfile.open(tarred, 'w') as archive:
+        for name in ('x.fa', 'y.fa', 'z.fa'):
+            info = tarfile.TarInfo(name)
+            info.size = 4
+            archive.addfile(info, io.BytesIO(b'ACGT'))
+    for path in spooled.iterdir():
+        path.unlink()
+    with pytest.raises(uploads.UploadTooLarge):
+        uploads.spool_archive(tarred, str(spooled), max_files=2)
+    assert list(spooled.iterdir()) == []
+    (tmp_path / 'junk.zip').write_bytes(b'not an archive')
+    with pytest.raises(ValueError):
+        uploads.spool_archive(tmp_path / 'junk.zip', str(spooled))
+
+def test_batch_summary_treats_expired_jobs_as_final():
+    from dna2music.jobs import batch_summary
+    children, names = ['j1', 'j2', 'j3'], ['a.fa', 'b.fa', 'c.fa']
+    done = {"status": "completed", "result": json.dumps({"note_count": 3})}
+    failed = {"status": "failed", "error": "bad"}
+    summary = batch_summary(children, names, [done, {"status": "processing"}, failed])
+    assert summary["status"] == "processing" and summary["counts"] == {"completed": 1, "processing": 1, "failed": 1}
+    summary = batch_summary(children, names, [done, {}, failed])
+    assert summary["status"] == "completed" and summary["counts"]["expired"] == 1
+    assert summary["jobs"][0]["result"] == {"note_count": 3} and summary["jobs"][2]["error"] == "bad"
+    assert batch_summary(children, names, [{}, {}, failed])["status"] == "failed"
+
+def test_staged_compose_reuses_stages(tmp_path, monkeypatch):
+    from dna2music import pipeline
+    from dna2music.cache import StageCache
+    data = b'>a\n' + b'ACGTTAGGCATN' * 40 + b'\n>b\nGATTACACCGGT\n'
+    stages = StageCache(str(tmp_path))
+    expected, length = pipeline.compose_upload(data)
+    blues, _ = pipeline.compose_upload(data, mode='blues')
+    reported = []
+    sections, staged_length = pipeline.compose_staged(data, stages, processes=1,
+                                                      on_stage=lambda stage, **info: reported.append(stage))
+    assert staged_length == length
+    assert reported == ['parsed', 'features', 'composed']
+    assert [(n, s.to_dicts()) for n, s in sections] == [(n, s.to_dicts()) for n, s in expected]
+    # A new mode re-maps notes only, without touching the sequence stages
+    monkeypatch.setattr(pipeline, 'load_records', None)
+    monkeypatch.setattr(pipeline, 'sequence_features', None)
+    monkeypatch.setattr(pipeline.composer, 'chord_codes', None)
+    remapped, _ = pipeline.compose_staged(data, stages, mode='blues', processes=1)
+    assert [(n, s.to_dicts()) for n, s in remapped] == [(n, s.to_dicts()) for n, s in blues]
+    assert remapped[0][1].pitch.tolist() != sections[0][1].pitch.tolist()
+    assert all(stages.load('chords', path.stem)['codes'].dtype == 'uint8' for path in (tmp_path / 'chords').iterdir())
+
+def test_stage_cache_evicts_least_recently_used(tmp_path):
+    import os
+    import numpy as np
+    from dna2music.cache import StageCache
+    stages = StageCache(str(tmp_path), max_bytes=3000, grace=0)
+    for i, key in enumerate('abc'):
+        stages.save('chords', key, codes=np.zeros(1000, dtype=np.uint8))
+        os.utime(stages.path('chords', key), (i, i))
+    stages.load('chords', 'a')  # now the most recently used
+    stages.evict()
+    assert [stages.has('chords', key) for key in 'abc'] == [True, False, True]
+    # Entries used within the grace period are kept whatever the size
+    stages.grace = 3600
+    stages.max_bytes = 0
+    stages.evict()
+    assert stages.has('chords', 'a')
+
+def test_synthesize_mixes_notes_at_their_onsets(tmp_path, monkeypatch):
+    import numpy as np
+    import soundfile as sf
+    from dna2music.utils import audio
+    notes = NoteEvents([60, 64, 67, 72], [0, 0, 0, 1.5], [1, 1, 1, 0.5], [100, 100, 100, 80])
+    mixed = audio.synthesize(notes)
+    rate, beat = audio.SAMPLE_RATE, audio.BEAT_SECONDS
+    assert len(mixed) == round(2 * beat * rate)
+    separate = np.zeros_like(mixed)
+    for i in range(len(notes)):
+        part = audio.synthesize(notes[i:i + 1])
+        start = round(notes.start[i] * beat * rate)
+        separate[start:len(part)] += part[start:]
+    assert np.allclose(mixed, separate, atol=1e-5)
+    # Streamed blocks carry sounding tails over and match the one-shot mix
+    path = str(tmp_path / 'stream.wav')
+    monkeypatch.setattr(audio, 'STREAM_BLOCK', 2)
+    assert list(audio.render_stream([notes[:3], notes[3:]], path)) == [2, 3, 4]
+    streamed, _ = sf.read(path)
+    assert np.allclose(streamed, mixed * audio.STREAM_HEADROOM, atol=1e-4)
+
+def test_generate_audio_normalizes_by_peak_bound(tmp_path):
+    import numpy as np
+    import soundfile as sf
+    from dna2music.utils import audio
+    notes = NoteEvents([60, 64, 67, 72], [0, 0, 0, 1], [1, 1, 1, 1], [127, 127, 127, 127])
+    assert audio.peak_bound(notes) == pytest.approx(3.0)
+    path = audio.generate_audio_simple(notes, 'peak', output_dir=str(tmp_path))
+    written, _ = sf.read(path)
+    assert np.allclose(written, audio.synthesize(notes) / 3.0, atol=1e-4)
+
+def test_write_midi_folds_pitches_and_carries_note_offs(tmp_path):
+    from dna2music.utils.midi import write_midi, fold_pitch
+    assert fold_pitch([307, 128, 60, -1]).tolist() == [127, 116, 60, 11]
+    notes = NoteEvents([60, 64, 200, 62], [0, 0, 1, 2], [3, 1, 1, 0.5], [100, 100, 100, 0])
+    chunked, whole = tmp_path / 'chunked.mid', tmp_path / 'whole.mid'
+    assert write_midi([notes[:2], notes[2:]], str(chunked)) == 4
+    write_midi([notes], str(whole))
+    data = chunked.read_bytes()
+    assert data == whole.read_bytes()
+    assert data[:4] == b'MThd' and data[14:18] == b'MTrk'
+    assert int.from_bytes(data[18:22], 'big') == len(data) - 22
+    # Pitch 200 folds to 116, velocity 0 is raised to 1, and the long first
+    # note is released after the notes of the second chunk
+    assert bytes([0x90, 116, 100]) in data and bytes([0x90, 62, 1]) in data
+    assert data.index(bytes([0x80, 60, 0])) > data.index(bytes([0x80, 62, 0]))
+
+def test_render_preview_composes_only_the_first_codons(tmp_path):
+    import soundfile as sf
+    from dna2music import pipeline
+    data = b'>a\n' + b'ACGTTAGGCATC' * 1000 + b'\n'
+    preview = pipeline.render_preview(data, 'job', output_dir=str(tmp_path), codons=20)
+    expected = pipeline.compose_sequence(('ACGTTAGGCATC' * 5)[:60])
+    assert preview['codons'] == 20 and preview['note_count'] == len(expected)
+    info = sf.info(str(tmp_path / f"job_preview.{pipeline.PREVIEW_FORMAT}"))
+    assert info.samplerate == pipeline.PREVIEW_RATE and info.channels == 1
+
+def test_render_preview_composes_the_first_genotype_calls(tmp_path):
+    from dna2music import pipeline
+    rows = ''.join(f'rs{i}\t1\t{i + 1}\t{"ACGT"[i % 4]}{"GT"[i % 2]}\n' for i in range(5000))
+    data = ('# This data file generated by 23andMe\n' + rows).encode()
+    preview = pipeline.render_preview(data, 'geno', output_dir=str(tmp_path), codons=20)
+    expected = pipeline.compose_genotypes(parser.read_genotypes(data.splitlines(keepends=True)[:21]))
+    assert preview['codons'] == 20 and preview['note_count'] == len(expected) == 60
+    # The head saved for the preview task holds enough calls for it
+    assert len(parser.read_genotypes(pipeline.preview_head(data, codons=20))) >= 20
+
+def test_job_store_counts_lists_and_expires(monkeypatch):
+    import time
+    from dna2music.jobs import JobStore, MemoryRedis
+    store = JobStore(MemoryRedis(), ttl=100)
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now)
+    store.create('old', {"status": "pending"})
+    now += 60
+    store.create('a', {"status": "pending"})
+    store.create('b', {"status": "pending"})
+    store.update(['a', 'b'], {"status": "processing"})
+    store.update('b', {"status": "completed", "result": "{}"})
+    assert store.counts() == (3, {"pending": 1, "processing": 1, "completed": 1})
+    assert [job_id for job_id, _ in store.list(limit=2)] == ['b', 'a']
+    assert store.get('b')["result"] == "{}"
+    now += 50
+    # 'old' has expired: its hash is gone, it leaves the indexes, and late writes don't revive it
+    store.update('old', {"status": "failed"})
+    assert store.get('old') == {}
+    assert store.counts() == (2, {"completed": 1, "failed": 0, "pending": 0, "processing": 1})
+    assert [job_id for job_id, _ in store.list(status="processing")] == ['a']
+
+def test_admission_admits_downgrades_then_rejects(monkeypatch):
+    from dna2music import admission
+    monkeypatch.setattr(admission, 'BASES_PER_SECOND', 1000.0)
+    assert admission.estimate_cost(5000) == admission.JOB_SECONDS + 5
+    assert admission.estimate_cost(5000, compressed=True) == admission.JOB_SECONDS + 5 * admission.GZIP_RATIO
+    assert admission.estimate_cost(10 ** 9, region=('chr1', 1000, 3000)) == admission.JOB_SECONDS + 2
+    limits = {"interactive": 10, "bulk": 200, "preview": 1}
+    assert admission.admit(6, {}, limits=limits) == ('admit', 'interactive', 6, 0)
+    # An idle lane takes even a job above its limit
+    assert admission.admit(150, {"interactive": 9}, limits=limits).action == 'admit'
+    assert admission.admit(6, {"interactive": 6}, limits=limits).action == 'preview'
+    assert admission.admit(6, {"interactive": 6}, can_preview=False, limits=limits) == ('reject', 'interactive', 6, 1)
+    rejected = admission.admit(150, {"bulk": 100, "preview": 1}, limits=limits)
+    assert rejected.action == 'reject' and rejected.retry_after == 50
+
+def test_admission_refunds_a_charged_job_once():
+    from dna2music import admission
+    from dna2music.jobs import JobStore, MemoryRedis
+    store = JobStore(MemoryRedis())
+    store.create('j1', {"status": "pending", "lane": "bulk", "cost": "150"})
+    pipe = store.redis.pipeline()
+    admission.charge(pipe, store.key('j1'), "bulk", 150)
+    pipe.execute()
+    # acks_late redelivery runs the task, and releases, a second time
+    for _ in range(2):
+        admission.release(store.redis, store.key('j1'))
+    assert float(store.redis.hget(admission.BACKLOG_KEY, "bulk")) == 0
+
+def _run_job_in_worker(data):
+    from dna2music.jobs import JobStore, MemoryRedis
+    from dna2music.tasks import process_dna_task
+    redis_client = MemoryRedis()
+    JobStore(redis_client).create('job', {"status": "pending"})
+    process_dna_task('job', data, redis_client)
+    job = JobStore(redis_client).get('job')
+    return job["status"], job.get("error"), json.loads(job.get("result") or "{}").get("sections")
+
+def test_task_composes_several_records_in_a_daemonic_worker(tmp_path, monkeypatch):
+    billiard_pool = pytest.importorskip('billiard.pool')
+    monkeypatch.chdir(tmp_path)
+    data = b'>a\n' + b'ACGTTAGGCATC' * 40 + b'\n>b\n' + b'GATTACACCGGT' * 40 + b'\n'
+    # Celery's prefork children are daemonic, so they may not start a process pool
+    pool = billiard_pool.Pool(1)
+    try:
+        status, error, sections = pool.apply(_run_job_in_worker, (data,))
+    finally:
+        pool.terminate()
+    assert (status, error) == ("completed", "")
+    assert [marker['name'] for marker in sections] == ['a', 'b']
+
+def test_batch_runs_the_jobs_queued_by_the_api(tmp_path, monkeypatch):
+    import functools
+    from dna2music.jobs import JobStore, MemoryRedis
+    from dna2music.tasks import dna_task_arguments, process_batch, process_upload
+    monkeypatch.chdir(tmp_path)
+    redis_client = MemoryRedis()
+    store = JobStore(redis_client)
+    children = []
+    for job_id, data in (('a', b'>a\n' + b'ACGTTAGGCATC' * 40 + b'\n'), ('b', b'GATTACACCGGT' * 40)):
+        (tmp_path / job_id).write_bytes(data)
+        store.create(job_id, {"status": "pending"})
+        # As /api/batch queues them
+        children.append(dna_task_arguments(job_id, str(tmp_path / job_id), f'key-{job_id}', None, 'stitched', False,
+                                           'midi', 'major', None, with_preview=False))
+    statuses = process_batch(children, redis_client, functools.partial(process_upload, redis_client=redis_client))
+    assert statuses == {'a': 'success', 'b': 'success'}
+    for job_id in ('a', 'b'):
+        job = store.get(job_id)
+        assert (job["status"], job["error"]) == ("completed", "")
+        assert json.loads(job["result"])["midi_path"] == f"/files/key-{job_id}.mid"
+        assert not (tmp_path / job_id).exists()
+
+def test_redelivered_task_leaves_a_completed_job_alone(tmp_path):
+    from dna2music.jobs import JobStore, MemoryRedis
+    from dna2music.tasks import process_dna_task
+    redis_client = MemoryRedis()
+    store = JobStore(redis_client)
+    store.create('job', {"status": "completed", "result": "{}"})
+    # Its spool is gone once the first delivery finished
+    process_dna_task('job', str(tmp_path / 'removed'), redis_client)
+    assert store.get('job')["status"] == "completed"
+
+def test_transcode_task_renames_the_encoding_into_place_and_lifts_its_lock(tmp_path):
+    import numpy as np
+    import soundfile as sf
+    from dna2music.jobs import MemoryRedis
+    from dna2music.tasks import TRANSCODE_LOCK, process_transcode_task
+    redis_client = MemoryRedis()
+    source, target = str(tmp_path / 'a.wav'), str(tmp_path / 'a.flac')
+    sf.write(source, np.zeros(1000, dtype=np.float32), 8000)
+    redis_client.set(TRANSCODE_LOCK.format(target), 1, nx=True, ex=60)
+    process_transcode_task(source, target, redis_client)
+    assert sf.info(target).frames == 1000
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['a.flac', 'a.wav']
+    assert redis_client.get(TRANSCODE_LOCK.format(target)) is None
+
+def test_stream_falls_back_for_genotypes_and_tracks(tmp_path, monkeypatch):
+    from dna2music.jobs import JobStore, MemoryRedis
+    from dna2music.tasks import process_dna_task
+    monkeypatch.chdir(tmp_path)
+    redis_client = MemoryRedis()
+    store = JobStore(redis_client)
+    genotypes = b'# 23andMe\n' + b''.join(b'rs%d\t1\t%d\tAG\n' % (i, 100 + i) for i in range(9))
+    records = b'>a\n' + b'ACGTTAGGCATC' * 40 + b'\n>b\n' + b'GATTACACCGGT' * 40 + b'\n'
+    for data, layout in ((genotypes, 'stitched'), (records, 'tracks')):
+        results = []
+        for stream in (False, True):
+            job_id = f'{layout}-{stream}'
+            store.create(job_id, {"status": "pending"})
+            process_dna_task(job_id, data, redis_client, layout=layout, stream=stream, fmt='midi', with_preview=False)
+            result = json.loads(store.get(job_id)["result"])
+            results.append((result["note_count"], len(result.get("tracks", []))))
+        assert results[0] == results[1]
+    assert results[0][1] == 2
@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from dna2music.mapping.events import as_note_events
 
 class LSTMMelody(nn.Module):
     def __init__(self, vocab_size=128, embedding_dim=64, lstm_units=256, num_layers=2, dropout=0.2):
@@ -24,12 +25,8 @@ class LSTMMelody(nn.Module):
 def encode_abc_style(notes):
     """Convert note events to ABC-like string encoding"""
     # Simple encoding: "A60 C64 E67 ..." (note + pitch)
-    encoded = []
-    for note in notes:
-        pitch = note.get('pitch', 60)
-        duration = note.get('duration', 1.0)
-        encoded.append(f"{chr(65 + (pitch % 12))}{pitch}")
-    return ' '.join(encoded)
+    pitches = as_note_events(notes).pitch.tolist()
+    return ' '.join(f"{chr(65 + (pitch % 12))}{pitch}" for pitch in pitches)
 
 def decode_abc_style(encoded):
     """Convert ABC-like string back to note events"""
@@ -5,11 +5,11 @@ import tensorflow as tf
 from magenta.models.music_vae import configs
 from magenta.models.music_vae.trained_model import TrainedModel
 from dna2music.mapping import parser, composer
+from dna2music.mapping.sequence import PackedSequence
 
 def reverse_complement(seq):
     """DNA reverse complement ↔ retrograde melody"""
-    complement = {'A': 'T', 'T': 'A', 'C': 'G', 'G': 'C'}
-    return ''.join(complement[base] for base in reversed(seq))
+    return str(PackedSequence.from_string(seq).reverse_complement())
 
 def snp_mutation(seq, mutation_rate=0.01):
     """Random SNP mutation ↔ pitch jitter ±1 semitone"""
@@ -45,7 +45,7 @@ def dna_to_melody_sequence(seq, config):
     melody = []
     for i, chord in enumerate(chords):
         # Take first note of each chord as melody
-        melody.append(chord[0] if chord else 60)
+        melody.append(chord[0] if len(chord) else 60)
     
     # Pad/truncate to config max_seq_len
     max_len = config.hparams.max_seq_len
@@ -0,0 +1,417 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from dna2music.mapping import parser, composer
+from dna2music.mapping.events import NoteEvents, as_note_events
+from dna2music.mapping.motifs import MotifHits
+from dna2music.cache import source_digest
+from dna2music.mapping.sequence import PackedSequence, as_packed, encode
+from dna2music.utils.audio import generate_audio_simple, render_stream
+from dna2music.utils.midi import MidiWriter, write_midi
+
+SECTION_GAP = 4  # beats of silence between stitched records
+WINDOW, STEP = 100, 10  # feature window used by every composing stage
+PREVIEW_CODONS = 256  # codons composed for the quick preview
+PREVIEW_RATE = 11025  # sample rate of the preview render
+PREVIEW_FORMAT = 'flac'  # encodes ~10x faster than Ogg/Vorbis at these lengths
+
+def sequence_features(seq):
+    """Per-codon GC content and entropy arrays for compose_chords' codons."""
+    # Generate features, then resample them onto codons so each chord reads
+    # the windows that actually cover it
+    features = parser.sliding_features(seq, window=WINDOW, step=STEP)
+    per_codon = parser.codon_features(seq, window=WINDOW, step=STEP, features=features)
+    return {'gc': per_codon['gc'].to_numpy(), 'entropy': per_codon['entropy'].to_numpy()}
+
+def compose_sequence(seq, mode='beautiful', rhythm_rules=None):
+    """Run features -> chords -> note events for a single sequence."""
+    if rhythm_rules is None:
+        rhythm_rules = composer.RHYTHM_RULES
+    features = sequence_features(seq)
+    # Compose chords
+    chords = composer.compose_chords(seq)
+    # Convert to note events with dynamic mapping
+    return composer.to_note_events(
+        chords,
+        gc_seq=features['gc'],
+        entropy_seq=features['entropy'],
+        mode=mode,
+        rhythm_rules=rhythm_rules
+    )
+
+def _compose_record(args):
+    name, seq, mode, rhythm_rules = args
+    return name, compose_sequence(seq, mode, rhythm_rules)
+
+def _pool_workers(processes):
+    """Size of a record pool; 1 (compose inline) inside a daemonic process.
+
+    Daemonic processes, such as the prefork children of a Celery worker,
+    may not start children of their own; there the worker's concurrency
+    provides the parallelism instead.
+    """
+    if multiprocessing.current_process().daemon:
+        return 1
+    return processes or os.cpu_count() or 1
+
+def compose_records(records, mode='beautiful', rhythm_rules=None, processes=None):
+    """Compose every ``(name, seq)`` record independently.
+
+    Records are spread over a process pool (``processes`` workers, default one
+    per core) and the ``(name, notes)`` results come back in input order.
+    """
+    tasks = [(name, seq, mode, rhythm_rules) for name, seq in records]
+    workers = _pool_workers(processes)
+    if len(tasks) < 2 or workers == 1:
+        return [_compose_record(t) for t in tasks]
+    chunksize = max(1, len(tasks) // (4 * workers))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_compose_record, tasks, chunksize=chunksize))
+
+def stitch_sections(sections, gap=SECTION_GAP):
+    """Join per-record notes into one track, one section after another.
+
+    Returns the shifted notes and a list of ``{'name', 'start', 'note_count'}``
+    section markers.
+    """
+    parts, markers, offset = [], [], 0.0
+    for name, section in sections:
+        section = as_note_events(section)
+        markers.append({'name': name, 'start': offset, 'note_count': len(section)})
+        parts.append(section.shifted(offset))
+        offset += section.end() + gap
+    notes = NoteEvents.concatenate(parts)
+    return notes, markers
+
+def compose_genotypes(calls, mode='beautiful'):
+    """Note events for genotype calls (23andMe/VCF), one chord per call."""
+    return composer.to_note_events(composer.genotype_chords(calls), mode=mode)
+
+def _report(on_stage, stage, **info):
+    if on_stage is not None:
+        on_stage(stage, **info)
+
+def compose_upload(file_content, region=None, mode='beautiful', stages=None, on_stage=None, processes=None,
+                   rhythm_rules=None):
+    """Parse and compose an upload; returns ``(sections, sequence_length)``.
+
+    Genotype files are composed from their calls, sequence files record by
+    record. With a StageCache as ``stages``, sequence files reuse whatever
+    intermediate results an earlier render of the same input left behind.
+    ``on_stage(stage, **info)`` is called as each stage (``'parsed'``,
+    ``'features'``, ``'composed'``) completes. ``rhythm_rules`` apply to
+    sequence files only; genotype calls have no GC content to follow.
+    """
+    if parser.detect_format(file_content) in parser.GENOTYPE_FORMATS:
+        calls = parser.read_genotypes(file_content, region=region)
+        _report(on_stage, 'parsed', records=1, sequence_length=len(calls))
+        sections = [('genotypes', compose_genotypes(calls, mode))]
+        _report(on_stage, 'composed', note_count=len(sections[0][1]))
+        return sections, len(calls)
+    if stages is not None:
+        return compose_staged(file_content, stages, region, mode, rhythm_rules, processes=processes,
+                              on_stage=on_stage)
+    records = load_records(file_content, region)
+    sequence_length = sum(len(seq) for _, seq in records)
+    _report(on_stage, 'parsed', records=len(records), sequence_length=sequence_length)
+    sections = compose_records(records, mode=mode, rhythm_rules=rhythm_rules, processes=processes)
+    _report(on_stage, 'composed', note_count=sum(len(notes) for _, notes in sections))
+    return sections, sequence_length
+
+def _record_arrays(seq):
+    packed, n_positions = as_packed(seq).to_2bit()
+    return {'packed': packed, 'n_positions': n_positions, 'length': np.int64(len(seq))}
+
+def parse_stage(file_content, stages, region=None):
+    """Key of the parsed upload, parsing and storing it on first use.
+
+    The ``parse`` entry holds the record names and lengths; each record's
+    bases are kept 2-bit packed under ``record`` keys derived from it.
+    """
+    key = stages.key('parse', source_digest(file_content), region or '')
+    manifest = stages.load('parse', key)
+    # Eviction may have taken some records but left the manifest
+    if manifest is None or not all(
+        stages.has('record', stages.key('record', key, index)) for index in range(len(manifest['names']))
+    ):
+        records = load_records(file_content, region)
+        for index, (_, seq) in enumerate(records):
+            stages.save('record', stages.key('record', key, index), **_record_arrays(seq))
+        stages.save('parse', key,
+                    names=np.array([name for name, _ in records], dtype=str),
+                    lengths=np.array([len(seq) for _, seq in records], dtype=np.int64))
+    return key
+
+def _stage_keys(stages, parse_key, index):
+    feature_key = stages.key('features', parse_key, index, WINDOW, STEP)
+    chord_key = stages.key('chords', parse_key, index, composer.compile_mapping().digest)
+    return feature_key, chord_key
+
+def _feature_arrays(seq):
+    # Stored at float32, the precision composer.gc_bins compares at
+    return {name: values.astype(np.float32) for name, values in sequence_features(seq).items()}
+
+def _chord_arrays(seq):
+    # Codon numbers and motif hits rebuild the chords at a third of their size
+    codes, hits = composer.chord_codes(seq)
+    return {'codes': codes, 'hit_position': hits.position, 'hit_motif': hits.motif, 'hit_strand': hits.strand}
+
+def _staged_features(args):
+    """Features and chord codes of one record, computed and stored on first use."""
+    stages, parse_key, index = args
+    feature_key, chord_key = _stage_keys(stages, parse_key, index)
+    record = []
+
+    def seq():
+        if not record:
+            arrays = stages.load('record', stages.key('record', parse_key, index))
+            record.append(PackedSequence.from_2bit(arrays['packed'], int(arrays['length']), arrays['n_positions']))
+        return record[0]
+
+    features = stages.cached('features', feature_key, lambda: _feature_arrays(seq()))
+    codes = stages.cached('chords', chord_key, lambda: _chord_arrays(seq()))
+    return features, codes
+
+def _prepare_staged_record(args):
+    # Run on the pool; only the stored files are needed back
+    _staged_features(args)
+
+def _compose_staged_record(args, mode, rhythm_rules):
+    features, codes = _staged_features(args)
+    hits = MotifHits(codes['hit_position'], codes['hit_motif'], codes['hit_strand'])
+    return composer.to_note_events(
+        composer.chords_from_codes(codes['codes'], hits),
+        gc_seq=features['gc'],
+        entropy_seq=features['entropy'],
+        mode=mode,
+        rhythm_rules=rhythm_rules
+    )
+
+def compose_staged(file_content, stages, region=None, mode='beautiful', rhythm_rules=None, processes=None,
+                   on_stage=None):
+    """compose_upload for sequence files through the stage cache.
+
+    Parsing is keyed by the upload hash and region, features by the window
+    and chords by the mapping config; only stages with a changed key are
+    recomputed. Notes are mapped from the stored stages for ``mode`` and
+    ``rhythm_rules`` on every call, and the cache is trimmed to its size
+    limit afterwards.
+    """
+    if rhythm_rules is None:
+        rhythm_rules = composer.RHYTHM_RULES
+    parse_key = parse_stage(file_content, stages, region)
+    manifest = stages.load('parse', parse_key)
+    sequence_length = int(manifest['lengths'].sum())
+    _report(on_stage, 'parsed', records=len(manifest['names']), sequence_length=sequence_length)
+    tasks = [(stages, parse_key, index) for index in range(len(manifest['names']))]
+    # Features and chords are the heavy stages and go to the pool; mapping
+    # them to notes is too quick to be worth one
+    missing = [
+        task for task, (f, c) in zip(tasks, (_stage_keys(*task) for task in tasks))
+        if not (stages.has('features', f) and stages.has('chords', c))
+    ]
+    workers = _pool_workers(processes)
+    if len(missing) < 2 or workers == 1:
+        for task in missing:
+            _prepare_staged_record(task)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(_prepare_staged_record, missing, chunksize=max(1, len(missing) // (4 * workers))))
+    _report(on_stage, 'features', records=len(tasks))
+    sections = [_compose_staged_record(task, mode, rhythm_rules) for task in tasks]
+    _report(on_stage, 'composed', note_count=sum(len(notes) for notes in sections))
+    stages.evict()
+    return list(zip(manifest['names'].tolist(), sections)), sequence_length
+
+def load_records(file_content, region=None):
+    """Parse an upload into ``(name, seq)`` records, or just ``region`` of it."""
+    if region:
+        return [(region, parser.read_region(file_content, region))]
+    return list(parser.iter_records(file_content))
+
+def render_sections(sections, job_id, layout='stitched', on_progress=None, fmt='wav', output_dir="outputs"):
+    """Write audio for composed sections and describe it for the job result.
+
+    ``layout='stitched'`` renders one multi-section track; ``'tracks'`` renders
+    one file per record. Every track is written as MIDI and, unless ``fmt``
+    is ``'midi'``, also rendered to audio in that format. Returns
+    ``(notes, result)`` where ``notes`` are the notes of the (first) track.
+    ``on_progress`` receives the running note count while a stitched track
+    is rendered.
+    """
+    def render(notes, name, progress=None):
+        write_midi([notes], f"{output_dir}/{name}.mid")
+        track = {"midi_path": f"/files/{name}.mid", "note_count": len(notes)}
+        if fmt != 'midi':
+            generate_audio_simple(notes, name, output_dir, on_progress=progress, fmt=fmt)
+            track["audio_path"] = f"/files/{name}.{fmt}"
+        return track
+
+    os.makedirs(output_dir, exist_ok=True)
+    if layout == 'tracks' and len(sections) > 1:
+        tracks = [dict(render(section, f"{job_id}_{i}"), name=name) for i, (name, section) in enumerate(sections)]
+        result = {k: v for k, v in tracks[0].items() if k.endswith("_path")}
+        result.update(format=fmt, note_count=sum(t["note_count"] for t in tracks), tracks=tracks)
+        return sections[0][1], result
+    notes, markers = stitch_sections(sections)
+    result = render(notes, job_id, on_progress)
+    result.update(format=fmt, sections=markers)
+    return notes, result
+
+def render_preview(source, output_id, output_dir="outputs", codons=PREVIEW_CODONS, sample_rate=PREVIEW_RATE,
+                   mode='beautiful', rhythm_rules=None):
+    """Compose the first ``codons`` codons and render them as low-rate mono audio.
+
+    Genotype files are composed like compose_upload does, from their first
+    ``codons`` calls. Only the start of ``source`` is read, so the cost does
+    not depend on its size. Returns the preview's description for the job
+    result.
+    """
+    if parser.detect_format(source) in parser.GENOTYPE_FORMATS:
+        calls = parser.read_genotypes(source, max_rows=codons)
+        notes, composed = compose_genotypes(calls, mode), len(calls)
+    else:
+        wanted = 3 * codons
+        bases = bytearray()
+        for chunk in parser.iter_bases(source, chunk_size=max(wanted, parser.SNIFF_SIZE)):
+            bases += chunk[:wanted - len(bases)]
+            if len(bases) >= wanted:
+                break
+        notes, composed = compose_sequence(PackedSequence(encode(bytes(bases))), mode, rhythm_rules), len(bases) // 3
+    name = f"{output_id}_preview"
+    generate_audio_simple(notes, name, output_dir, fmt=PREVIEW_FORMAT, sample_rate=sample_rate)
+    return {
+        "audio_path": f"/files/{name}.{PREVIEW_FORMAT}",
+        "note_count": len(notes),
+        "codons": composed,
+        "sample_rate": sample_rate
+    }
+
+def _preview_codons(head, fmt):
+    if fmt in parser.GENOTYPE_FORMATS:
+        return sum(1 for line in head.splitlines() if line and not line.startswith(b'#'))
+    return sum(len(chunk) for chunk in parser.iter_bases(head, fmt)) // 3
+
+def preview_head(source, codons=PREVIEW_CODONS):
+    """The leading lines of ``source``, inflated, enough for render_preview.
+
+    Saved aside, they let the preview be rendered apart from the upload,
+    which the main task may have removed by then.
+    """
+    fmt = parser.detect_format(source)
+    head = b''
+    for chunk in parser.iter_chunks(source, parser.SNIFF_SIZE):
+        head += chunk
+        lines = head[:head.rfind(b'\n') + 1]
+        if _preview_codons(lines, fmt) >= codons:
+            return lines
+    return head
+
+def _first_window(codon):
+    """Lowest window index overlapping ``codon``."""
+    return max(0, -((WINDOW - 1 - 3 * codon) // STEP))
+
+def _compose_codons(codes, offset, c0, c1, n_windows, mode, rhythm_rules, lookback, motif_span):
+    """Notes for global codons [c0, c1) of a buffer that starts at base ``offset``.
+
+    This reproduces compose_sequence on the whole sequence: window features
+    are computed for exactly the windows overlapping those codons, and motif
+    phrases are applied over ``lookback`` earlier codons so phrases started
+    before ``c0`` still reach into the range.
+    """
+    seq = PackedSequence(codes)
+    k0 = _first_window(c0)
+    k1 = min((3 * c1 - 1) // STEP, n_windows - 1)
+    features = parser.sliding_features(seq[k0 * STEP - offset:k1 * STEP + WINDOW - offset], WINDOW, STEP)
+    gc = parser.align_to_codons(features['gc'], c1 - c0, WINDOW, STEP, c0, k0)
+    entropy = parser.align_to_codons(features['entropy'], c1 - c0, WINDOW, STEP, c0, k0)
+    back = min(lookback, c0)
+    start = 3 * (c0 - back) - offset
+    chords = composer.compose_chords(seq[start:3 * c1 + motif_span - offset])[back:back + c1 - c0]
+    notes = composer.to_note_events(chords, gc_seq=gc, entropy_seq=entropy, mode=mode, rhythm_rules=rhythm_rules)
+    return notes.shifted(c0)
+
+def stream_note_events(base_chunks, mode='beautiful', rhythm_rules=None):
+    """Compose note events incrementally from a stream of base chunks.
+
+    ``base_chunks`` are upper-case ASCII chunks such as parser.iter_bases
+    yields. Each chunk emits every codon whose feature windows and motif
+    matches are complete; only the window overlap, the unfinished codon
+    phase and a few codons of motif lookback are carried over, so memory is
+    bounded by the chunk size. The concatenated output equals
+    compose_sequence on the whole sequence.
+    """
+    if rhythm_rules is None:
+        rhythm_rules = composer.RHYTHM_RULES
+    index = composer.motif_index(composer.MOTIFS) if composer.MOTIFS else None
+    motif_span = max(index.tables, default=1) - 1 if index else 0
+    lookback = max((len(p) for p in composer.PHRASES.values()), default=1) - 1
+    codes = np.empty(0, dtype=np.uint8)
+    offset = 0  # global position of codes[0]
+    next_codon = 0
+    for chunk in base_chunks:
+        codes = np.concatenate([codes, encode(chunk)])
+        end = offset + len(codes)
+        n_windows = (end - WINDOW) // STEP + 1 if end >= WINDOW else 0
+        # Codons whose windows all exist and whose motif hits are complete
+        ready = min(n_windows * STEP // 3, (end - motif_span) // 3)
+        if ready <= next_codon:
+            continue
+        yield _compose_codons(codes, offset, next_codon, ready, n_windows, mode, rhythm_rules, lookback, motif_span)
+        next_codon = ready
+        keep_from = min(_first_window(next_codon) * STEP, 3 * max(next_codon - lookback, 0))
+        codes = codes[keep_from - offset:]
+        offset = keep_from
+    end = offset + len(codes)
+    if end < WINDOW:
+        # Shorter than one window: nothing was emitted, compose it whole
+        if end:
+            yield compose_sequence(PackedSequence(codes), mode, rhythm_rules)
+        return
+    if end // 3 > next_codon:
+        n_windows = (end - WINDOW) // STEP + 1
+        yield _compose_codons(codes, offset, next_codon, end // 3, n_windows, mode, rhythm_rules, lookback, motif_span)
+
+def stream_pipeline(source, job_id, output_dir="outputs", mode='beautiful', chunk_size=parser.CHUNK_SIZE,
+                    on_progress=None, fmt='wav', rhythm_rules=None):
+    """Parse, compose and render ``source`` as chained generators.
+
+    Notes are appended to ``{output_dir}/{job_id}.mid`` and, unless ``fmt``
+    is ``'midi'``, to ``{output_dir}/{job_id}.{fmt}`` chunk by chunk; the
+    audio can be played while the rest of the input is processed.
+    ``on_progress`` is called with the running note count after each chunk
+    is written.
+    """
+    preview = []
+    sequence_length = 0
+
+    def counted(chunks):
+        nonlocal sequence_length
+        for chunk in chunks:
+            sequence_length += len(chunk)
+            yield chunk
+
+    def keep_preview(note_chunks):
+        for notes in note_chunks:
+            if len(preview) < 50:
+                preview.extend(notes[:50 - len(preview)].to_dicts())
+            midi.write(notes)
+            yield notes
+
+    os.makedirs(output_dir, exist_ok=True)
+    bases = counted(parser.iter_bases(source, chunk_size=chunk_size))
+    result = {"midi_path": f"/files/{job_id}.mid", "format": fmt}
+    with MidiWriter(f"{output_dir}/{job_id}.mid") as midi:
+        note_chunks = keep_preview(stream_note_events(bases, mode, rhythm_rules))
+        if fmt == 'midi':
+            progress = (midi.written for _ in note_chunks)
+        else:
+            progress = render_stream(note_chunks, f"{output_dir}/{job_id}.{fmt}")
+            result["audio_path"] = f"/files/{job_id}.{fmt}"
+        note_count = 0
+        for note_count in progress:
+            if on_progress is not None:
+                on_progress(note_count)
+    result.update(note_count=note_count, sequence_length=sequence_length, notes=preview)
+    return result
@@ -1,49 +1,238 @@
 import os
-import numpy as np
-import soundfile as sf
-from dna2music.mapping import parser, composer
-from dna2music.utils.audio import generate_audio_simple
+import threading
+import time
+from dna2music.mapping import parser
+from dna2music.pipeline import PREVIEW_FORMAT, compose_upload, render_preview, render_sections, stream_pipeline
+from dna2music.cache import HOLD_SECONDS, ResultCache, StageCache
+from dna2music import admission
+from dna2music.jobs import JobStore
+from dna2music.utils.audio import transcode
 import json
 
-def process_dna_task(job_id, file_content, redis_client):
+PROGRESS_SECONDS = 0.25  # least time between two rendering progress updates
+TRANSCODE_LOCK = "transcode:{}"  # set while a worker encodes a download into this path
+TRANSCODE_LOCK_SECONDS = 600
+
+def process_preview_task(job_id, source, redis_client, cache_key=None, preview_only=False, mode='beautiful',
+                         rhythm_rules=None):
+    """Render the quick preview of an upload and put it on the job.
+
+    ``source`` is usually the head of the upload that the API saved with
+    preview_head, so this runs on its own queue, well before the full job.
+    The preview is also published to the jobs queued behind this one.
+    ``preview_only`` jobs, downgraded by admission control, are completed
+    with the preview as their result; for others a failed preview is only
+    a missing preview.
+    """
+    store = JobStore(redis_client)
+    cache = ResultCache(redis_client) if cache_key else None
+    jobs = [job_id]
     try:
-        # Parse DNA
-        seq = parser.parse_dna(file_content.decode())
-        # Generate features
-        features = parser.sliding_features(seq, window=100, step=10)
-        gc_seq = features['gc'].tolist() if 'gc' in features else None
-        entropy_seq = features['entropy'].tolist() if 'entropy' in features else None
-        # Compose chords
-        chords = composer.compose_chords(seq)
-        # Convert to note events with dynamic mapping
-        from dna2music.mapping.composer import RHYTHM_RULES
-        notes = composer.to_note_events(
-            chords,
-            gc_seq=gc_seq,
-            entropy_seq=entropy_seq,
-            mode='beautiful',
-            rhythm_rules=RHYTHM_RULES
-        )
-        # Generate audio
-        audio_path = generate_audio_simple(notes, job_id)
-        # Update job status in Redis
-        redis_client.hset(f"job:{job_id}", mapping={
+        preview = render_preview(source, cache_key or job_id, mode=mode, rhythm_rules=rhythm_rules)
+        jobs += cache.waiters(cache_key) if cache else []
+        store.update(jobs, {"preview": json.dumps(preview)}, event={"stage": "preview", "preview": preview})
+        if not preview_only:
+            return
+        result = {"audio_path": preview["audio_path"], "format": PREVIEW_FORMAT,
+                  "note_count": preview["note_count"], "preview_only": True, "preview": preview}
+        if cache:
+            cache.put(cache_key, result)
+            jobs = [job_id] + cache.release(cache_key)
+        store.update(jobs, {
             "status": "completed",
-            "result": json.dumps({
-                "audio_path": f"/files/{job_id}.wav",
-                "note_count": len(notes),
-                "sequence_length": len(seq),
-                "notes": notes[:50]
-            }),
+            "result": json.dumps(result),
             "error": ""
-        })
-    except UnicodeDecodeError:
-        redis_client.hset(f"job:{job_id}", mapping={
-            "status": "failed",
-            "error": "File could not be decoded. Please upload a valid text file."
-        })
+        }, event={"stage": "done", "status": "completed", "result": result})
     except Exception as e:
-        redis_client.hset(f"job:{job_id}", mapping={
-            "status": "failed",
-            "error": f"Processing error: {str(e)}"
-        }) 
\ No newline at end of file
+        if not preview_only:
+            return
+        if cache:
+            jobs = [job_id] + cache.release(cache_key)
+        error = f"Processing error: {str(e)}"
+        store.update(jobs, {"status": "failed", "error": error},
+                     event={"stage": "failed", "status": "failed", "error": error})
+    finally:
+        if preview_only:
+            admission.release(redis_client, store.key(job_id))
+
+def process_dna_task(job_id, file_content, redis_client, region=None, layout='stitched', stream=False,
+                     cache_key=None, fmt='wav', enhance=None, processes=None, mode='beautiful', rhythm_rules=None,
+                     with_preview=True):
+    """Compose and render an upload, then record the outcome on the job.
+
+    ``file_content`` is the upload's bytes or the path it was spooled to.
+    With a ``cache_key`` the audio is named by that key, the result is stored
+    in the result cache and handed to every job that queued behind this one.
+    ``enhance`` optionally rewrites each section's notes before rendering
+    (not applied in streaming mode). ``processes`` sizes the pool records are composed on (1: inline).
+    ``stream`` renders a stitched sequence upload chunk by chunk; regions,
+    genotype calls and one-track-per-record layouts are always composed whole.
+    ``mode`` and ``rhythm_rules`` are passed on to the composer.
+    ``with_preview`` renders the quick preview first; it is turned off when
+    process_preview_task renders it separately. A job already completed is
+    left as it is.
+
+    Progress events (``processing``, ``preview``, ``parsed``, ``features``,
+    ``composed``, ``rendering``, then ``done`` or ``failed``) are published
+    on the job's channel, and on those of the jobs queued behind it.
+    """
+    store = JobStore(redis_client)
+    if (store.get(job_id) or {}).get("status") == "completed":
+        # A redelivered copy of a job that already finished
+        return
+    cache = ResultCache(redis_client) if cache_key else None
+    output_id = cache_key or job_id
+    jobs = [job_id]
+    followers = []
+    total_notes = []
+    last_report = [0.0]
+
+    def stage(name, mapping=None, **info):
+        followers[:] = cache.waiters(cache_key) if cache else []
+        if name == 'composed':
+            total_notes.append(info["note_count"])
+        store.update([job_id] + followers, mapping or {}, event=dict(info, stage=name))
+
+    # The audio is playable (/api/stream) from its first flushed block
+    def report(note_count):
+        now = time.monotonic()
+        if now - last_report[0] < PROGRESS_SECONDS:
+            return
+        last_report[0] = now
+        progress = {"status": "rendering", "note_count": note_count}
+        if fmt != 'midi':
+            progress["audio_path"] = f"/files/{output_id}.{fmt}"
+        event = {"stage": "rendering", "note_count": note_count}
+        if total_notes and total_notes[-1]:
+            event["percent"] = round(100 * note_count / total_notes[-1], 1)
+        store.update(job_id, progress, event=event)
+        if followers:
+            store.update(followers, {}, event=event)
+
+    store.update(job_id, {"status": "processing"}, event={"stage": "processing"})
+    done = threading.Event()
+    if cache:
+        # Followers are reaped if the lock lapses, so keep it while running
+        threading.Thread(target=_hold_lock, args=(cache, cache_key, done), daemon=True).start()
+    try:
+        preview = None
+        if with_preview and not region:
+            # A few hundred codons at low quality, ready well before the full render
+            preview = render_preview(file_content, output_id, mode=mode, rhythm_rules=rhythm_rules)
+            stage('preview', {"preview": json.dumps(preview)}, preview=preview)
+        if stream and _streamable(file_content, region, layout):
+            # Incremental mode: parsing and composing also run chunk by chunk
+            result = stream_pipeline(file_content, output_id, mode=mode, on_progress=report, fmt=fmt,
+                                     rhythm_rules=rhythm_rules)
+        else:
+            result = _compose_and_render(file_content, output_id, region, layout, report, fmt, enhance, stage,
+                                         processes, mode, rhythm_rules)
+        if preview is None:
+            # Rendered by process_preview_task, if it got there first
+            stored = store.get(job_id).get("preview")
+            preview = json.loads(stored) if stored else None
+        if preview:
+            result["preview"] = preview
+        if cache:
+            cache.put(cache_key, result)
+            jobs += cache.release(cache_key)
+        store.update(jobs, {
+            "status": "completed",
+            "result": json.dumps(result),
+            "error": ""
+        }, event={"stage": "done", "status": "completed", "result": result})
+    except Exception as e:
+        if cache:
+            jobs += cache.release(cache_key)
+        error = f"Processing error: {str(e)}"
+        store.update(jobs, {"status": "failed", "error": error},
+                     event={"stage": "failed", "status": "failed", "error": error})
+    finally:
+        done.set()
+        # This job's share of the queued work estimate is done
+        admission.release(redis_client, store.key(job_id))
+
+def _hold_lock(cache, key, done, every=HOLD_SECONDS):
+    while True:
+        cache.hold(key)
+        if done.wait(every):
+            return
+
+def process_transcode_task(source, target, redis_client):
+    """Encode the audio at ``source`` into the format of ``target`` for a download.
+
+    The API queues one encoding per file under TRANSCODE_LOCK; it is lifted
+    when done, so a failed encoding can be asked for again.
+    """
+    try:
+        transcode(source, target)
+    finally:
+        redis_client.delete(TRANSCODE_LOCK.format(target))
+
+def dna_task_arguments(job_id, upload_path, cache_key, region=None, layout='stitched', stream=False, fmt='wav',
+                       mode='beautiful', rhythm_rules=None, with_preview=True):
+    """Keyword arguments of the worker's process_dna_task for a spooled upload.
+
+    The API queues these for single jobs and batch groups alike, so both
+    stay in step with the task's signature.
+    """
+    return dict(job_id=job_id, upload_path=upload_path, region=region, layout=layout, stream=stream,
+                cache_key=cache_key, fmt=fmt, mode=mode, rhythm_rules=rhythm_rules, with_preview=with_preview)
+
+def process_upload(job_id, upload_path, redis_client, region=None, layout='stitched', stream=False, cache_key=None,
+                   fmt='wav', mode='beautiful', rhythm_rules=None, with_preview=True, enhance=None):
+    """process_dna_task on an upload the API spooled, which is removed afterwards.
+
+    Records are composed inline: prefork children may not start a pool,
+    and Celery's concurrency already keeps the cores busy.
+    """
+    try:
+        process_dna_task(job_id, upload_path, redis_client, region, layout, stream, cache_key, fmt, enhance=enhance,
+                         processes=1, mode=mode, rhythm_rules=rhythm_rules, with_preview=with_preview)
+        status = JobStore(redis_client).get(job_id).get("status")
+        return {"status": "success" if status == "completed" else status, "job_id": job_id}
+    finally:
+        # The FASTA index is built next to the upload for region requests
+        for path in (upload_path, f"{upload_path}.fai"):
+            if os.path.exists(path):
+                os.remove(path)
+
+def process_batch(children, redis_client, run):
+    """Run a group of a batch's jobs back to back; returns each job's status.
+
+    ``children`` holds keyword arguments of ``run``, as made by
+    dna_task_arguments.
+    """
+    store = JobStore(redis_client)
+    statuses = {}
+    for arguments in children:
+        job_id = arguments["job_id"]
+        try:
+            statuses[job_id] = run(**arguments)["status"]
+        except Exception as e:
+            # One sample's failure must not strand the rest of the group
+            error = f"Processing error: {str(e)}"
+            store.update(job_id, {"status": "failed", "error": error},
+                         event={"stage": "failed", "status": "failed", "error": error})
+            statuses[job_id] = "failed"
+    return statuses
+
+def _streamable(file_content, region, layout):
+    # stream_pipeline reads the upload as one run of bases: genotype calls
+    # would lose their chords and tracks their records
+    return not region and layout == 'stitched' and parser.detect_format(file_content) not in parser.GENOTYPE_FORMATS
+
+def _compose_and_render(file_content, output_id, region=None, layout='stitched', on_progress=None, fmt='wav',
+                        enhance=None, on_stage=None, processes=None, mode='beautiful', rhythm_rules=None):
+    # Parse and compose: genotype calls, or each sequence record on the
+    # process pool (only the requested region when one is given), reusing
+    # the stages of earlier renders of the same upload
+    sections, sequence_length = compose_upload(file_content, region, mode, stages=StageCache(), on_stage=on_stage,
+                                                processes=processes, rhythm_rules=rhythm_rules)
+    if enhance is not None:
+        sections = [(name, enhance(notes)) for name, notes in sections]
+    # Generate MIDI and audio, stitched or one track per record
+    notes, result = render_sections(sections, output_id, layout, on_progress, fmt)
+    result["sequence_length"] = sequence_length
+    result["notes"] = notes[:50].to_dicts()
+    return result
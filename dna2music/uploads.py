@@ -0,0 +1,104 @@
+import hashlib
+import os
+import tarfile
+import uuid
+import zipfile
+
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 1 << 30))
+UPLOAD_CHUNK = 1 << 20  # bytes per read when spooling an upload
+MAX_BATCH_FILES = int(os.environ.get("MAX_BATCH_FILES", 200))
+ALLOWED_TYPES = ('.fasta', '.fastq', '.txt', '.fa', '.fq', '.vcf')
+ARCHIVE_TYPES = ('.zip', '.tar', '.tar.gz', '.tgz')
+
+class UploadTooLarge(ValueError):
+    """An upload, or a batch of them, is over one of its limits."""
+
+class Spool:
+    """An upload written to ``path`` chunk by chunk, hashed as it arrives.
+
+    ``write`` raises UploadTooLarge once more than ``max_bytes`` came in;
+    leaving the ``with`` block on an error removes the partial file.
+    """
+
+    def __init__(self, path, max_bytes=MAX_UPLOAD_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, 'wb')
+        return self
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise UploadTooLarge(f"Upload exceeds the {self.max_bytes} byte limit")
+        self.digest.update(chunk)
+        self.file.write(chunk)
+
+    def __exit__(self, kind, error, traceback):
+        self.file.close()
+        if kind is not None:
+            os.remove(self.path)
+
+    @property
+    def sha256(self):
+        return self.digest.hexdigest()
+
+def spool_file(file, path, max_bytes=MAX_UPLOAD_BYTES):
+    """Copy a readable binary file to ``path``; returns its sha256 and size."""
+    with Spool(path, max_bytes) as spool:
+        while chunk := file.read(UPLOAD_CHUNK):
+            spool.write(chunk)
+    return spool.sha256, spool.size
+
+def allowed_file(filename):
+    # gzip/BGZF uploads are inflated in a streaming fashion by the parser
+    for suffix in ('.gz', '.bgz'):
+        if filename.endswith(suffix):
+            filename = filename[:-len(suffix)]
+    return filename.endswith(ALLOWED_TYPES)
+
+def archive_members(path):
+    """``(name, file object)`` for each regular file of a zip or tar archive."""
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    with archive.open(info) as member:
+                        yield info.filename, member
+    else:
+        with tarfile.open(path, "r:*") as archive:
+            for info in archive:
+                if info.isfile():
+                    yield info.name, archive.extractfile(info)
+
+def spool_archive(path, directory, max_files=MAX_BATCH_FILES):
+    """Spool each sequence file in an archive under a new job id.
+
+    Returns ``(samples, skipped)`` where samples are ``(job_id, name, path,
+    sha256, size)``; members are streamed, never extracted by name. Raises
+    ValueError for an unreadable archive and UploadTooLarge beyond
+    ``max_files`` sequence files, removing whatever was spooled.
+    """
+    samples, skipped = [], []
+    try:
+        try:
+            for name, member in archive_members(path):
+                if not allowed_file(name):
+                    skipped.append(name)
+                    continue
+                if len(samples) == max_files:
+                    raise UploadTooLarge(f"Batches are limited to {max_files} files")
+                job_id = str(uuid.uuid4())
+                upload_path = os.path.join(directory, job_id)
+                samples.append((job_id, os.path.basename(name), upload_path, *spool_file(member, upload_path)))
+        except (zipfile.BadZipFile, tarfile.TarError):
+            raise ValueError("Not a readable zip or tar archive")
+    except BaseException:
+        for sample in samples:
+            os.remove(sample[2])
+        raise
+    return samples, skipped
@@ -1,20 +1,166 @@
 import numpy as np
 import soundfile as sf
 import os
+from numba import njit
+from dna2music.mapping.events import NoteEvents, as_note_events
 
-def generate_audio_simple(notes, job_id, output_dir="outputs"):
-    sample_rate = 44100
-    duration = 0.1  # seconds per note
-    audio_samples = []
-    for note in notes:
-        frequency = 440 * (2 ** ((note['pitch'] - 69) / 12))
-        t = np.linspace(0, duration, int(sample_rate * duration))
-        wave = np.sin(2 * np.pi * frequency * t)
-        wave *= note['velocity'] / 127.0
-        audio_samples.append(wave)
-    audio = np.concatenate(audio_samples)
-    audio = audio / np.max(np.abs(audio))
+SAMPLE_RATE = 44100
+BEAT_SECONDS = 0.3  # seconds per beat of note start/duration
+STREAM_BLOCK = 1024  # notes synthesized per write in render_stream
+WRITE_FRAMES = 1 << 18  # libsndfile's Vorbis encoder crashes on much larger single writes
+ATTACK_SECONDS, RELEASE_SECONDS = 0.01, 0.05
+STREAM_HEADROOM = 0.25  # fixed gain for render_stream, which cannot normalize
+# Encodings by file extension: (soundfile format, subtype)
+AUDIO_FORMATS = {'wav': ('WAV', 'PCM_16'), 'flac': ('FLAC', 'PCM_16'), 'ogg': ('OGG', 'VORBIS')}
+
+# One cycle of a sine, read by a per-note phase accumulator
+WAVETABLE_SIZE = 4096
+WAVETABLE = np.sin(2 * np.pi * np.arange(WAVETABLE_SIZE) / WAVETABLE_SIZE).astype(np.float32)
+
+@njit(cache=True)
+def _overlap_add(out, onsets, lengths, increments, gains, table, attack, release):
+    size = table.shape[0]
+    for i in range(onsets.shape[0]):
+        onset, length = onsets[i], lengths[i]
+        # Linear attack and release, shortened for very short notes
+        a = min(attack, length // 2)
+        r = min(release, length - a)
+        phase = 0.0
+        increment = increments[i] % size
+        for k in range(length):
+            gain = gains[i]
+            if k < a:
+                gain *= k / a
+            elif k >= length - r:
+                gain *= (length - k) / r
+            out[onset + k] += gain * table[int(phase)]
+            phase += increment
+            if phase >= size:
+                phase -= size
+
+def note_spans(notes, sample_rate=SAMPLE_RATE, beat_seconds=BEAT_SECONDS):
+    """Onset and length of each note in samples."""
+    onsets = np.round(notes.start * beat_seconds * sample_rate).astype(np.int64)
+    lengths = np.maximum(np.round(notes.duration * beat_seconds * sample_rate).astype(np.int64), 1)
+    return onsets, lengths
+
+def mix_notes(out, notes, origin=0, sample_rate=SAMPLE_RATE, beat_seconds=BEAT_SECONDS):
+    """Overlap-add ``notes`` into ``out``, whose first sample is at ``origin``.
+
+    Every note is read from the wavetable at its own phase increment and
+    summed in place, so chord tones and overlapping notes sound together.
+    """
+    notes = as_note_events(notes)
+    onsets, lengths = note_spans(notes, sample_rate, beat_seconds)
+    increments = 440 * (2 ** ((notes.pitch - 69) / 12)) * WAVETABLE_SIZE / sample_rate
+    _overlap_add(out, onsets - origin, lengths, increments, (notes.velocity / 127.0).astype(np.float32),
+                 WAVETABLE, int(ATTACK_SECONDS * sample_rate), int(RELEASE_SECONDS * sample_rate))
+    return out
+
+def warm_up():
+    """Load the compiled mixing kernel so the first real render is fast."""
+    mix_notes(np.zeros(1, dtype=np.float32), NoteEvents([60], [0.0], [0.0], [0]))
+
+def synthesize(notes, sample_rate=SAMPLE_RATE, beat_seconds=BEAT_SECONDS):
+    """Render notes at their start and duration into one buffer, unnormalized."""
+    notes = as_note_events(notes)
+    if not len(notes):
+        return np.zeros(0, dtype=np.float32)
+    onsets, lengths = note_spans(notes, sample_rate, beat_seconds)
+    out = np.zeros(int((onsets + lengths).max()), dtype=np.float32)
+    return mix_notes(out, notes, 0, sample_rate, beat_seconds)
+
+def peak_bound(notes, sample_rate=SAMPLE_RATE, beat_seconds=BEAT_SECONDS):
+    """Upper bound on the mixed peak: the largest summed gain of notes sounding at once.
+
+    Computed from note spans alone, so audio can be normalized before any of
+    it is synthesized.
+    """
+    notes = as_note_events(notes)
+    if not len(notes):
+        return 0.0
+    onsets, lengths = note_spans(notes, sample_rate, beat_seconds)
+    gains = notes.velocity / 127.0
+    times = np.concatenate([onsets, onsets + lengths])
+    steps = np.concatenate([gains, -gains])
+    # Note ends sort before onsets at the same sample
+    order = np.lexsort((steps, times))
+    return float(np.cumsum(steps[order]).max())
+
+def generate_audio_simple(notes, job_id, output_dir="outputs", on_progress=None, fmt='wav',
+                          sample_rate=SAMPLE_RATE):
+    """Render notes to ``{output_dir}/{job_id}.{fmt}``, normalized to full scale.
+
+    Written in blocks with bounded memory: the first pass bounds the peak
+    from the note spans, the second synthesizes and writes. ``on_progress``
+    is called with the running note count after each flushed block.
+    """
+    notes = as_note_events(notes)
+    notes = notes[np.argsort(notes.start, kind='stable')]
+    peak = peak_bound(notes, sample_rate)
     os.makedirs(output_dir, exist_ok=True)
-    output_path = f"{output_dir}/{job_id}.wav"
-    sf.write(output_path, audio, sample_rate)
-    return output_path 
\ No newline at end of file
+    output_path = f"{output_dir}/{job_id}.{fmt}"
+    for written in render_stream([notes], output_path, sample_rate, gain=1 / peak if peak > 0 else 1.0):
+        if on_progress is not None:
+            on_progress(written)
+    return output_path
+
+def _write_frames(out, samples):
+    for i in range(0, len(samples), WRITE_FRAMES):
+        out.write(np.clip(samples[i:i + WRITE_FRAMES], -1, 1))
+
+def render_stream(note_chunks, output_path, sample_rate=SAMPLE_RATE, gain=STREAM_HEADROOM):
+    """Synthesize and append each chunk of notes to an audio file as it arrives.
+
+    The encoding follows the extension of ``output_path`` (see AUDIO_FORMATS).
+
+    Notes must arrive in start order. Samples before the latest onset seen
+    are final and written out; the tails of notes still sounding are
+    carried into the next block. The header is rewritten after every block,
+    so the file is playable while later chunks are still being composed.
+    Samples are scaled by ``gain``; without all notes up front the peak is
+    unknown, so the default is a fixed headroom. Yields the number of notes
+    written after each block.
+    """
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    container, subtype = AUDIO_FORMATS[os.path.splitext(output_path)[1][1:].lower()]
+    written = 0
+    pending = np.zeros(0, dtype=np.float32)
+    origin = 0  # sample index of pending[0]
+    with sf.SoundFile(output_path, 'w', samplerate=sample_rate, channels=1, format=container, subtype=subtype) as out:
+        for notes in note_chunks:
+            for i in range(0, len(notes), STREAM_BLOCK):
+                block = notes[i:i + STREAM_BLOCK]
+                onsets, lengths = note_spans(block, sample_rate)
+                end = int((onsets + lengths).max()) - origin
+                if end > len(pending):
+                    pending = np.concatenate([pending, np.zeros(end - len(pending), dtype=np.float32)])
+                mix_notes(pending, block, origin, sample_rate)
+                ready = int(onsets.max()) - origin
+                _write_frames(out, pending[:ready] * gain)
+                out.flush()
+                pending = pending[ready:]
+                origin += ready
+                written += len(block)
+                yield written
+        _write_frames(out, pending * gain)
+
+def transcode(input_path, output_path, block=1 << 16):
+    """Re-encode an audio file block by block into the format of ``output_path``.
+
+    The encoding is written aside and renamed into place, so ``output_path``
+    only ever exists complete.
+    """
+    container, subtype = AUDIO_FORMATS[os.path.splitext(output_path)[1][1:].lower()]
+    tmp = f"{output_path}.{os.getpid()}.tmp"
+    try:
+        with sf.SoundFile(input_path) as source:
+            with sf.SoundFile(tmp, 'w', samplerate=source.samplerate, channels=source.channels,
+                              format=container, subtype=subtype) as out:
+                for data in source.blocks(blocksize=min(block, WRITE_FRAMES)):
+                    out.write(data)
+        os.replace(tmp, output_path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return output_path
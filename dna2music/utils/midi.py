@@ -0,0 +1,94 @@
+import struct
+import numpy as np
+from dna2music.mapping.events import as_note_events
+from dna2music.utils.audio import BEAT_SECONDS
+
+TICKS_PER_BEAT = 480
+
+def fold_pitch(pitch):
+    """Move pitches into MIDI's 0-127 range by whole octaves."""
+    pitch = np.asarray(pitch, dtype=np.int64)
+    pitch = np.where(pitch > 127, pitch - 12 * -(-(pitch - 127) // 12), pitch)
+    return np.where(pitch < 0, pitch - 12 * (pitch // 12), pitch)
+
+def _encode_events(ticks, status, data1, data2, last_tick):
+    """Track bytes for sorted channel events, delta times as variable-length quantities."""
+    deltas = np.diff(ticks, prepend=last_tick)
+    n_vlq = 1 + (deltas >= 1 << 7) + (deltas >= 1 << 14) + (deltas >= 1 << 21)
+    ends = np.cumsum(n_vlq + 3)
+    starts = ends - n_vlq - 3
+    out = np.zeros(int(ends[-1]) if len(ends) else 0, dtype=np.uint8)
+    for k in range(4):
+        # Group k of 7 bits, least significant last; all but the last byte flag continuation
+        has = n_vlq > k
+        byte = (deltas[has] >> (7 * k)) & 0x7F
+        out[starts[has] + n_vlq[has] - 1 - k] = byte | (0x80 if k else 0)
+    out[ends - 3], out[ends - 2], out[ends - 1] = status, data1, data2
+    return out.tobytes()
+
+class MidiWriter:
+    """Incremental single-track Standard MIDI File writer.
+
+    Notes are written chunk by chunk in start order. Note-offs that fall
+    after the last onset of a chunk are carried into the next one, and the
+    track length is patched in on close.
+    """
+
+    def __init__(self, path, beat_seconds=BEAT_SECONDS):
+        self.file = open(path, 'wb')
+        self.file.write(b'MThd' + struct.pack('>IHHH', 6, 0, 1, TICKS_PER_BEAT))
+        self.file.write(b'MTrk\0\0\0\0')
+        self.track_start = self.file.tell()
+        tempo = int(round(beat_seconds * 1e6))  # microseconds per beat
+        self.file.write(b'\x00\xff\x51\x03' + tempo.to_bytes(3, 'big'))
+        self.pending = np.empty((0, 4), dtype=np.int64)  # tick, status, pitch, velocity
+        self.last_tick = 0
+        self.written = 0
+
+    def write(self, notes):
+        notes = as_note_events(notes)
+        if not len(notes):
+            return
+        on = np.round(notes.start * TICKS_PER_BEAT).astype(np.int64)
+        off = on + np.maximum(np.round(notes.duration * TICKS_PER_BEAT).astype(np.int64), 1)
+        pitch = fold_pitch(notes.pitch)
+        velocity = np.clip(notes.velocity, 1, 127).astype(np.int64)
+        events = np.concatenate([
+            self.pending,
+            np.stack([on, np.full_like(on, 0x90), pitch, velocity], axis=1),
+            np.stack([off, np.full_like(off, 0x80), pitch, np.zeros_like(off)], axis=1),
+        ])
+        # By time, note-offs (0x80) before note-ons (0x90) on the same tick
+        events = events[np.lexsort((events[:, 1], events[:, 0]))]
+        ready = events[:, 0] <= on.max()
+        self._emit(events[ready])
+        self.pending = events[~ready]
+        self.written += len(notes)
+
+    def _emit(self, events):
+        if len(events):
+            self.file.write(_encode_events(*events.T, self.last_tick))
+            self.last_tick = int(events[-1, 0])
+
+    def close(self):
+        if self.file.closed:
+            return
+        self._emit(self.pending)
+        self.file.write(b'\x00\xff\x2f\x00')  # end of track
+        length = self.file.tell() - self.track_start
+        self.file.seek(self.track_start - 4)
+        self.file.write(struct.pack('>I', length))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def write_midi(note_chunks, path, beat_seconds=BEAT_SECONDS):
+    """Write chunks of notes (in start order) to ``path``; returns the note count."""
+    with MidiWriter(path, beat_seconds) as writer:
+        for notes in note_chunks:
+            writer.write(notes)
+    return writer.written
@@ -28,7 +28,7 @@ export default function Home() {
       setDnaSeq(text.replace(/[^ACGTacgt]/g, ''));
       const formData = new FormData();
       formData.append('file', file);
-      formData.append('beautiful', beautifulMode ? '1' : '0');
+      formData.append('mode', beautifulMode ? 'beautiful' : 'major');
       const backendUrl = process.env.NEXT_PUBLIC_BACKEND_URL;
       const response = await axios.post(`${backendUrl}/api/submit`, formData, {
         headers: { 'Content-Type': 'multipart/form-data' },
@@ -36,43 +36,62 @@ export default function Home() {
       const { job_id } = response.data;
       setJobId(job_id);
       setStatus('processing');
-      pollStatus(job_id);
+      followJob(job_id);
     } catch (err) {
       setError('Upload failed. Please try again.');
       setStatus('idle');
     }
   }, [beautifulMode]);
 
-  const pollStatus = async (jobId: string) => {
-    const interval = setInterval(async () => {
-      try {
-        const backendUrl = process.env.NEXT_PUBLIC_BACKEND_URL;
-        const response = await axios.get(`${backendUrl}/api/status/${jobId}`);
-        const { status: jobStatus } = response.data;
-        if (jobStatus === 'completed') {
-          const resultResponse = await axios.get(`${backendUrl}/api/result/${jobId}`);
-          setResult(resultResponse.data);
-          setStatus('completed');
-          setProgress(100);
-          clearInterval(interval);
-        } else if (jobStatus === 'failed') {
-          setError('Processing failed. Please try again.');
-          setStatus('idle');
-          clearInterval(interval);
-        } else {
-          setProgress(Math.min(progress + 10, 90));
-        }
-      } catch (err) {
+  // Progress is pushed by the backend (Server-Sent Events) until the job ends
+  const STAGE_PROGRESS: Record<string, number> = {
+    processing: 5, preview: 15, parsed: 25, features: 40, composed: 50,
+  };
+  const followJob = (jobId: string) => {
+    const backendUrl = process.env.NEXT_PUBLIC_BACKEND_URL;
+    const events = new EventSource(`${backendUrl}/api/events/${jobId}`);
+    events.onmessage = (message) => {
+      const event = JSON.parse(message.data);
+      if (event.stage === 'done') {
+        setResult({
+          job_id: jobId,
+          status: 'completed',
+          result: event.result,
+          preview: event.preview ?? event.result?.preview,
+          download_url: `/api/download/${jobId}`,
+        });
+        setStatus('completed');
+        setProgress(100);
+        events.close();
+      } else if (event.stage === 'failed') {
+        setError('Processing failed. Please try again.');
+        setStatus('idle');
+        events.close();
+      } else if (event.stage === 'rendering') {
+        setProgress(50 + Math.round((event.percent ?? 0) * 0.45));
+      } else if (event.stage in STAGE_PROGRESS) {
+        setProgress(STAGE_PROGRESS[event.stage]);
+      }
+    };
+    // The browser reconnects on its own after dropped connections; a closed
+    // source means the backend refused the stream
+    events.onerror = () => {
+      if (events.readyState === EventSource.CLOSED) {
         setError('Status check failed.');
         setStatus('idle');
-        clearInterval(interval);
       }
-    }, 2000);
+    };
   };
 
   // Download MIDI and Sheet Music (to be implemented)
   const downloadMidi = () => {
-    if (!result || !result.result || !result.result.notes) return;
+    if (!result || !result.result) return;
+    // The backend writes the full track as MIDI; fall back to the preview notes
+    if (result.result.midi_path) {
+      window.open(`${process.env.NEXT_PUBLIC_BACKEND_URL}${result.result.midi_path}`, '_blank');
+      return;
+    }
+    if (!result.result.notes) return;
     const notes: Note[] = result.result.notes;
     const midi = new Midi();
     const track = midi.addTrack();
@@ -12,6 +12,7 @@ export interface ApiResult {
   result: {
     notes: Note[];
     audio_path: string;
+    midi_path?: string;
     [key: string]: any; // for any extra fields
   };
   download_url?: string;
@@ -1,42 +1,53 @@
 import os
-import json
-import numpy as np
+import functools
+import redis
 from celery import Celery
-from dna2music.mapping import parser, composer
-from dna2music.models.lstm_melody import LSTMMelody, encode_abc_style, decode_abc_style
+from celery.signals import worker_process_init
+from dna2music.mapping import composer
+from dna2music.models.lstm_melody import LSTMMelody
+from dna2music.mapping.events import as_note_events
 import torch
-from dna2music.utils.audio import generate_audio_simple
+from dna2music.cache import LSTM_CHECKPOINT
+from dna2music.tasks import (process_batch, process_preview_task as run_preview, process_transcode_task as run_transcode,
+                             process_upload)
+from dna2music.utils.audio import warm_up
 
 # Initialize Celery
 celery_app = Celery('dna2music')
 celery_app.config_from_object('celeryconfig')
+redis_client = redis.Redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379/0'), decode_responses=True)
 
-def enhance_with_lstm(notes):
-    model_path = "dna2music/models/checkpoints/lstm/final_model.pt"
-    if not os.path.exists(model_path):
-        return notes  # fallback
+@worker_process_init.connect
+def load_synthesizer(**kwargs):
+    # Load the compiled mixing kernel before the first job's preview
+    warm_up()
+
+@functools.lru_cache(maxsize=1)
+def _load_lstm(model_path, mtime):
     model = LSTMMelody(vocab_size=128, embedding_dim=64, lstm_units=256)
     model.load_state_dict(torch.load(model_path, map_location='cpu'))
     model.eval()
-    # Convert notes to ABC-like encoding
-    abc_encoded = encode_abc_style(notes)
-    # Tokenize: convert ABC string to integer indices (simple mapping: pitch only)
-    tokens = [int(tok[1:]) for tok in abc_encoded.split()]
-    input_tensor = torch.tensor(tokens, dtype=torch.long).unsqueeze(0)  # shape (1, seq_len)
+    return model
+
+def load_lstm(model_path=LSTM_CHECKPOINT):
+    """The LSTM, loaded once per worker process (again if the checkpoint changes); None without one."""
+    if not os.path.exists(model_path):
+        return None
+    return _load_lstm(model_path, os.path.getmtime(model_path))
+
+def enhance_with_lstm(notes):
+    model = load_lstm()
+    if model is None:
+        return notes  # fallback
+    notes = as_note_events(notes)
+    # Tokens are the MIDI pitches themselves
+    input_tensor = torch.as_tensor(notes.pitch, dtype=torch.long).unsqueeze(0)  # shape (1, seq_len)
     with torch.no_grad():
         output, _ = model(input_tensor)
         # Get predicted pitches (argmax over vocab)
-        pred_indices = output.argmax(dim=-1).squeeze(0).tolist()
-    # Decode back to note events
-    enhanced_notes = []
-    for idx, orig_note in enumerate(notes):
-        pitch = pred_indices[idx] if idx < len(pred_indices) else orig_note.get('pitch', 60)
-        enhanced_notes.append({
-            'pitch': pitch,
-            'duration': orig_note.get('duration', 1.0),
-            'velocity': orig_note.get('velocity', 100)
-        })
-    return enhanced_notes
+        pred = output.argmax(dim=-1).squeeze(0).numpy()
+    # Keep timing and dynamics, replace the pitches
+    return notes.with_pitch(pred[:len(notes)])
 
 def enhance_with_musicvae(notes):
     # Stub for MusicVAE integration
@@ -44,49 +55,43 @@ def enhance_with_musicvae(notes):
     # For now, just return notes
     return notes
 
+def enhance(notes):
+    # LSTM enhancement, then MusicVAE enhancement (stub)
+    return enhance_with_musicvae(enhance_with_lstm(notes))
+
+@celery_app.task
+def process_dna_task(job_id: str, upload_path: str, region: str = None, layout: str = 'stitched',
+                     stream: bool = False, cache_key: str = None, fmt: str = 'wav', mode: str = 'beautiful',
+                     rhythm_rules: dict = None, with_preview: bool = True):
+    """Main DNA processing task; the upload is read from where the API spooled it"""
+    # Writes progress, then the result or error, to the job through the JobStore
+    return process_upload(job_id, upload_path, redis_client, region, layout, stream, cache_key, fmt, mode,
+                          rhythm_rules, with_preview, enhance=enhance)
+
 @celery_app.task
-def process_dna_task(job_id: str, file_content: bytes):
-    """Main DNA processing task"""
+def process_preview_task(job_id: str, head_path: str, cache_key: str = None, preview_only: bool = False,
+                         mode: str = 'beautiful', rhythm_rules: dict = None):
+    """Quick preview from the head of an upload the API saved aside (dna_preview queue)"""
     try:
-        # Parse DNA
-        seq = parser.parse_dna(file_content.decode())
-        # Generate features
-        features = parser.sliding_features(seq, window=100, step=10)
-        gc_seq = features['gc'].tolist() if 'gc' in features else None
-        entropy_seq = features['entropy'].tolist() if 'entropy' in features else None
-        # Compose chords
-        chords = composer.compose_chords(seq)
-        # Convert to note events with dynamic mapping
-        from dna2music.mapping.composer import RHYTHM_RULES
-        notes = composer.to_note_events(
-            chords,
-            gc_seq=gc_seq,
-            entropy_seq=entropy_seq,
-            mode='beautiful',
-            rhythm_rules=RHYTHM_RULES
-        )
-        # LSTM enhancement
-        enhanced_notes = enhance_with_lstm(notes)
-        # MusicVAE enhancement (stub)
-        final_notes = enhance_with_musicvae(enhanced_notes)
-        # Generate audio (shared util)
-        audio_path = generate_audio_simple(final_notes, job_id)
-        # Update job status
-        update_job_status(job_id, "completed", {
-            "audio_path": audio_path,
-            "note_count": len(final_notes),
-            "sequence_length": len(seq)
-        })
-        return {"status": "success", "job_id": job_id}
-    except Exception as e:
-        update_job_status(job_id, "failed", {"error": str(e)})
-        raise
+        run_preview(job_id, head_path, redis_client, cache_key, preview_only, mode, rhythm_rules)
+    finally:
+        if os.path.exists(head_path):
+            os.remove(head_path)
+
+@celery_app.task
+def transcode_task(source: str, target: str):
+    """Another audio encoding of a finished result, asked for on download"""
+    run_transcode(source, target, redis_client)
+
+@celery_app.task
+def process_batch_task(batch_id: str, children: list):
+    """Run a group of a batch's jobs back to back; ``children`` holds process_dna_task keyword arguments.
 
-def update_job_status(job_id: str, status: str, result: dict):
-    """Update job status (in production, use Redis/DB)"""
-    # This would update the job status in Redis or database
-    # For now, just print
-    print(f"Job {job_id}: {status} - {result}")
+    The mapping tables and the LSTM are set up once for the whole group.
+    """
+    composer.compile_mapping()
+    load_lstm()
+    return {"batch_id": batch_id, "jobs": process_batch(children, redis_client, process_dna_task)}
 
 if __name__ == '__main__':
     celery_app.start() 
\ No newline at end of file